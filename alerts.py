@@ -0,0 +1,363 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Alert rules, checked as samples arrive.  Each [ALERT:<name>] section is a
+# rule on one field, for one station and sensor or any of them:
+#
+#   [ALERT:freeze]
+#   sensor = outside
+#   field = temperature_f
+#   below = 32
+#   for = 600
+#
+# below and above are thresholds, and clear is where a firing alert
+# resolves (the threshold itself by default), so noise around it doesn't
+# flap.  for makes the condition have to hold that many seconds first.
+# With rate = <seconds>, below and above apply to the field's rate of
+# change per hour over roughly that window instead of its value.  silent =
+# <seconds> fires when the sensor (or just the field, if there is one)
+# hasn't been heard from for that long; that's checked every few seconds
+# rather than per sample, and only for sensors the subscriber still tracks.
+#
+# Rules are indexed by field, station and sensor when they're loaded, so a
+# sample only looks at rules on the fields it carries, and all the state a
+# rule keeps per sensor is a few numbers on its stations.SensorState: the
+# rate is an exponential moving average, which lags a steady trend by
+# exactly its window, so (value - average) / window is the trend.
+#
+# A notification goes out when an alert starts firing, again every repeat
+# seconds while it keeps firing (never by default), and when it resolves.
+# They go to the rule's notify, a [NOTIFIER:<name>] section or the built-in
+# log notifier, each with its own queue and thread like a sink.  When the
+# subscriber stops tracking a sensor, its firing alerts are resolved.
+
+from prometheus_client import Counter, Gauge
+import json
+import math
+import os
+import shlex
+import subprocess
+import sinks
+import threading
+import time
+
+firing_gauge = Gauge('alerts_firing', 'Station sensors an alert rule is firing for', ['rule'])
+notifications_counter = Counter('alert_notifications', 'Alert notifications sent', ['rule', 'state'])
+evaluated_counter = Counter('alert_rules_evaluated', 'Rule checks made against incoming samples')
+
+FIRING = 'firing'
+RESOLVED = 'resolved'
+
+class Rule:
+    def __init__(self, name, field=None, station=None, sensor=None, below=None, above=None, clear=None,
+                 rate=None, sustain=0, silent=None, repeat=0, notify='log'):
+        if silent is None:
+            if field is None:
+                raise ValueError("Alert %s needs a field"% (name,))
+            if below is None and above is None:
+                raise ValueError("Alert %s needs below or above"% (name,))
+            if below is not None and above is not None:
+                raise ValueError("Alert %s can only have one of below and above"% (name,))
+        self.name = name
+        self.field = field
+        self.station = station
+        self.sensor = sensor
+        self.below = below
+        self.above = above
+        if clear is None:
+            clear = below if below is not None else above
+        self.clear = clear
+        self.rate = rate
+        self.sustain = sustain
+        self.silent = silent
+        self.repeat = repeat
+        self.notify = notify
+        self.firing = firing_gauge.labels(name)
+
+    def matches(self, station, sensor):
+        return (self.station is None or self.station == station) and (self.sensor is None or self.sensor == sensor)
+
+    def breached(self, value):
+        if self.below is not None:
+            return value < self.below
+        return value > self.above
+
+    def cleared(self, value):
+        if self.below is not None:
+            return value >= self.clear
+        return value <= self.clear
+
+    def describe(self, value, status=FIRING):
+        what = "%s rate %.2f/h"% (self.field, value) if self.rate else "%s %.2f"% (self.field, value)
+        if status == RESOLVED:
+            return what
+        if self.below is not None:
+            return "%s below %s"% (what, self.below)
+        return "%s above %s"% (what, self.above)
+
+# What one rule knows about one station sensor
+class RuleState:
+    __slots__ = ('since', 'firing', 'notified', 'average', 'last', 'started')
+
+    def __init__(self):
+        self.since = None
+        self.firing = False
+        self.notified = 0
+        self.average = None
+        self.last = None
+        self.started = None
+
+class AlertEngine:
+    def __init__(self, rules, notifiers, check_interval=10):
+        self.rules = rules
+        self.notifiers = notifiers
+        self.check_interval = check_interval
+        # Held while rule states change, since the ingest workers, the silence
+        # check and eviction all get at them
+        self.lock = threading.Lock()
+        self.by_name = {rule.name: rule for rule in rules}
+        # Rules by (station, sensor, field), with None for any
+        self.index = {}
+        self.fields = set()
+        self.silent = []
+        for rule in rules:
+            if rule.notify not in notifiers:
+                raise ValueError("Alert %s notifies %s, which isn't a notifier"% (rule.name, rule.notify))
+            if rule.silent is not None:
+                self.silent.append(rule)
+                continue
+            self.index.setdefault((rule.station, rule.sensor, rule.field), []).append(rule)
+            self.fields.add(rule.field)
+
+    # Check the rules on the fields in a sample.  state is the sample's
+    # stations.SensorState and data the sample with derived values added.
+    # Rules go by when the sample was taken, so a batch of samples that
+    # arrives all at once is still timed the way it was measured.
+    def evaluate(self, state, data, now=None):
+        if not self.fields:
+            return
+        if now is None:
+            now = data.get('ts')
+            if now is None:
+                now = time.time()
+        station = state.station
+        sensor = state.sensor
+        for field, value in data.items():
+            if field not in self.fields or value is None:
+                continue
+            for key in ((station, sensor, field), (station, None, field), (None, sensor, field), (None, None, field)):
+                rules = self.index.get(key)
+                if rules is None:
+                    continue
+                for rule in rules:
+                    evaluated_counter.inc()
+                    with self.lock:
+                        self._check(rule, state, value, now)
+
+    # Only called with the lock held
+    def _rule_state(self, rule, state):
+        if state.alerts is None:
+            state.alerts = {}
+        rule_state = state.alerts.get(rule.name)
+        if rule_state is None:
+            rule_state = state.alerts[rule.name] = RuleState()
+        return rule_state
+
+    def _check(self, rule, state, value, now):
+        rule_state = self._rule_state(rule, state)
+
+        if rule.rate:
+            if rule_state.average is None:
+                rule_state.average = value
+                rule_state.started = now
+            else:
+                alpha = 1 - math.exp(-max(0, now - rule_state.last) / rule.rate)
+                rule_state.average += alpha * (value - rule_state.average)
+            rule_state.last = now
+            # Not enough history yet for the average to mean anything
+            if now - rule_state.started < rule.rate:
+                return
+            value = (value - rule_state.average) / rule.rate * 3600
+
+        self._update(rule, state, rule_state, value, now)
+
+    # Move an alert along given the latest value
+    def _update(self, rule, state, rule_state, value, now):
+        if rule_state.firing:
+            if rule.cleared(value):
+                rule_state.firing = False
+                rule_state.since = None
+                rule.firing.dec()
+                self._notify(rule, state, rule_state, RESOLVED, value, now)
+            elif rule.repeat and now - rule_state.notified >= rule.repeat:
+                self._notify(rule, state, rule_state, FIRING, value, now)
+            return
+
+        if not rule.breached(value):
+            rule_state.since = None
+            return
+        if rule_state.since is None:
+            rule_state.since = now
+        if now - rule_state.since >= rule.sustain:
+            rule_state.firing = True
+            rule.firing.inc()
+            self._notify(rule, state, rule_state, FIRING, value, now)
+
+    def _notify(self, rule, state, rule_state, status, value, now, message=None):
+        rule_state.notified = now
+        if message is None and rule.silent is not None:
+            message = "%s/%s %s: %s for %.0f seconds"% (
+                state.station, state.sensor, rule.name,
+                "not heard from" if status == FIRING else "heard from again", value)
+        elif message is None:
+            message = "%s/%s %s %s: %s"% (state.station, state.sensor, rule.name, status, rule.describe(value, status))
+        notifications_counter.labels(rule.name, status).inc()
+        self.notifiers[rule.notify].offer(state.station, state.sensor, {
+            'rule': rule.name,
+            'state': status,
+            'field': rule.field,
+            'value': value,
+            'message': message,
+            'time': now,
+        })
+
+    # Silence rules, over a list of every stations.SensorState
+    def check_silence(self, states, now=None):
+        if now is None:
+            now = time.time()
+        for rule in self.silent:
+            for state in states:
+                if not rule.matches(state.station, state.sensor):
+                    continue
+                if rule.field is None:
+                    quiet = now - state.updated
+                else:
+                    quiet = state.snapshot.age(rule.field, now)
+                    if quiet is None:
+                        continue
+                with self.lock:
+                    rule_state = self._rule_state(rule, state)
+                    if quiet >= rule.silent and not rule_state.firing:
+                        rule_state.firing = True
+                        rule.firing.inc()
+                        self._notify(rule, state, rule_state, FIRING, quiet, now)
+                    elif quiet < rule.silent and rule_state.firing:
+                        rule_state.firing = False
+                        rule.firing.dec()
+                        self._notify(rule, state, rule_state, RESOLVED, quiet, now)
+                    elif rule_state.firing and rule.repeat and now - rule_state.notified >= rule.repeat:
+                        self._notify(rule, state, rule_state, FIRING, quiet, now)
+
+    # The subscriber has stopped tracking a stations.SensorState, so nothing
+    # will resolve its alerts any more.  Resolve the ones still firing.
+    def forget(self, state, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            rule_states, state.alerts = state.alerts, None
+            for name, rule_state in (rule_states or {}).items():
+                rule = self.by_name.get(name)
+                if rule is None or not rule_state.firing:
+                    continue
+                rule_state.firing = False
+                rule.firing.dec()
+                quiet = now - state.updated
+                self._notify(rule, state, rule_state, RESOLVED, quiet, now,
+                             "%s/%s %s resolved: no longer tracked, nothing heard for %.0f seconds"% (
+                                 state.station, state.sensor, rule.name, quiet))
+
+    # Check silence rules every check_interval seconds until stop is set.
+    # get_states() returns the sensors being tracked.
+    def run(self, stop, get_states):
+        if not self.silent:
+            return
+        while not stop.wait(self.check_interval):
+            self.check_silence(get_states())
+
+    def start(self):
+        for notifier in self.notifiers.values():
+            notifier.start()
+
+    def stop(self):
+        for notifier in self.notifiers.values():
+            notifier.stop()
+
+# Prints notifications, which is where they end up without any notifiers
+class LogNotifier(sinks.Sink):
+    def send(self, items):
+        for station, sensor, notification in items:
+            print("ALERT %s"% (notification['message'],))
+
+# Runs a command for every notification, with the details in ALERT_*
+# environment variables
+class CommandNotifier(sinks.Sink):
+    def __init__(self, name, command, timeout=30, **options):
+        super().__init__(name, **options)
+        self.command = shlex.split(command)
+        self.timeout = timeout
+
+    def send(self, items):
+        for station, sensor, notification in items:
+            env = dict(os.environ)
+            env.update({
+                'ALERT_RULE': notification['rule'],
+                'ALERT_STATE': notification['state'],
+                'ALERT_STATION': station,
+                'ALERT_SENSOR': sensor,
+                'ALERT_FIELD': notification['field'] or '',
+                'ALERT_VALUE': "%.2f"% (notification['value'],),
+                'ALERT_MESSAGE': notification['message'],
+                'ALERT_JSON': json.dumps(notification),
+            })
+            subprocess.run(self.command, env=env, timeout=self.timeout, check=True)
+
+def _log(name, section):
+    return LogNotifier(name, **sinks._options(section))
+
+def _command(name, section):
+    return CommandNotifier(name, section['command'], timeout=section.getfloat('timeout', 30), **sinks._options(section))
+
+def _file(name, section):
+    return sinks.FileSink(name, section['path'], **sinks._options(section))
+
+NOTIFIERS = {
+    'log': _log,
+    'command': _command,
+    'file': _file,
+}
+
+def _float(section, option):
+    value = section.get(option)
+    return float(value) if value else None
+
+def from_config(config):
+    notifiers = {'log': LogNotifier('alert-log', retries=0)}
+    for name in config.sections():
+        if name.startswith('NOTIFIER:'):
+            section = config[name]
+            kind = section.get('type', '').lower()
+            if kind not in NOTIFIERS:
+                raise ValueError("Unknown notifier type %s in [%s]"% (kind, name))
+            notifier_name = name[len('NOTIFIER:'):]
+            notifiers[notifier_name] = NOTIFIERS[kind]('alert-%s'% (notifier_name,), section)
+
+    rules = []
+    for name in config.sections():
+        if name.startswith('ALERT:'):
+            section = config[name]
+            rules.append(Rule(
+                name[len('ALERT:'):],
+                field=section.get('field') or None,
+                station=section.get('station') or None,
+                sensor=section.get('sensor') or None,
+                below=_float(section, 'below'),
+                above=_float(section, 'above'),
+                clear=_float(section, 'clear'),
+                rate=_float(section, 'rate'),
+                sustain=section.getfloat('for', 0),
+                silent=_float(section, 'silent'),
+                repeat=section.getfloat('repeat', 0),
+                notify=section.get('notify', 'log')))
+    if rules:
+        print("Loaded %d alert rules"% (len(rules),))
+    return AlertEngine(rules, notifiers)
@@ -0,0 +1,341 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Long-term archive of every sample the subscriber sees, kept as one
+# directory of columns per station, sensor and UTC day:
+#
+#   <path>/<station>/<sensor>/2024-06-01/segment.json
+#                                        ts.f64
+#                                        temperature_f.f64
+#                                        humidity.f64 ...
+#
+# Each column is a flat file of native doubles (array('d')), NaN where a
+# sample didn't have that field, so it can be mmapped and scanned without
+# loading it.  Samples are buffered and appended in bulk every flush_rows
+# rows or flush_interval seconds.  segment.json holds the row count and
+# columns that have been committed, and is only replaced (atomically) after
+# the columns are written, so a crash leaves at most some uncommitted rows
+# at the end of the files.  They're truncated away the next time the
+# segment is opened, and readers never look past the committed count.
+#
+# To query it:
+#
+#   python archive.py list
+#   python archive.py query home outside temperature_f --start 2023-01-01 --step 1d
+#
+# dewpoint_f and heat_index_f can be queried from days archived before they
+# were stored too.
+
+from array import array
+import argparse
+import datetime
+import derived
+import json
+import math
+import mmap
+import os
+import re
+import threading
+import time
+
+SEGMENT_FILE = 'segment.json'
+SUFFIX = '.f64'
+DAY_FORMAT = '%Y-%m-%d'
+
+# Stamps that aren't worth archiving
+SKIP = ('seq', 'boot')
+
+def safe_name(name):
+    return re.sub(r'[^A-Za-z0-9._-]', '_', str(name)).lstrip('.') or '_'
+
+def day_of(t):
+    return datetime.datetime.fromtimestamp(t, datetime.timezone.utc).strftime(DAY_FORMAT)
+
+def load_segment(path):
+    try:
+        with open(os.path.join(path, SEGMENT_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"rows": 0, "columns": []}
+
+# One station, sensor and day
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.meta = load_segment(path)
+        self.columns = list(self.meta['columns'])
+        self._recover()
+        self.buffers = {column: array('d') for column in self.columns}
+        self.pending = 0
+
+    def _column_path(self, column):
+        return os.path.join(self.path, column + SUFFIX)
+
+    # Cut anything written after the last commit
+    def _recover(self):
+        size = self.meta['rows'] * 8
+        for name in os.listdir(self.path):
+            if not name.endswith(SUFFIX):
+                continue
+            column_path = os.path.join(self.path, name)
+            if name[:-len(SUFFIX)] not in self.columns:
+                print("Removing uncommitted column %s"% (column_path,))
+                os.remove(column_path)
+            elif os.path.getsize(column_path) != size:
+                print("Truncating %s to %d committed rows"% (column_path, self.meta['rows']))
+                with open(column_path, 'r+b') as f:
+                    if os.fstat(f.fileno()).st_size < size:
+                        f.seek(0, os.SEEK_END)
+                        # Lost in a crash without fsync, fill the gap with NaN
+                        (array('d', [math.nan]) * ((size - f.tell()) // 8)).tofile(f)
+                    f.truncate(size)
+
+        # A committed column can go missing altogether in a crash, put it
+        # back as NaN so it still lines up with ts
+        for column in self.columns:
+            column_path = self._column_path(column)
+            if not os.path.exists(column_path):
+                print("Recreating missing column %s"% (column_path,))
+                with open(column_path, 'wb') as f:
+                    (array('d', [math.nan]) * self.meta['rows']).tofile(f)
+
+    def append(self, row):
+        for column in row:
+            if column not in self.buffers:
+                # Earlier rows didn't have it
+                self.columns.append(column)
+                self.buffers[column] = array('d', [math.nan]) * (self.meta['rows'] + self.pending)
+        for column, buffer in self.buffers.items():
+            buffer.append(row.get(column, math.nan))
+        self.pending += 1
+
+    def flush(self, fsync=False):
+        if not self.pending:
+            return 0
+        for column, buffer in self.buffers.items():
+            with open(self._column_path(column), 'ab') as f:
+                buffer.tofile(f)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        # Commit by replacing segment.json
+        written = self.pending
+        meta = {"rows": self.meta['rows'] + written, "columns": self.columns}
+        tmp = os.path.join(self.path, SEGMENT_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, SEGMENT_FILE))
+
+        self.meta = meta
+        self.buffers = {column: array('d') for column in self.columns}
+        self.pending = 0
+        return written
+
+class Archive:
+    def __init__(self, path, flush_rows=1000, flush_interval=60, fsync=False):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.segments = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def append(self, station, sensor, data, now=None):
+        t = data.get('ts')
+        if t is None:
+            t = time.time() if now is None else now
+        row = {'ts': float(t)}
+        for field, value in data.items():
+            if field in SKIP or isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            row[safe_name(field)] = float(value)
+
+        key = (safe_name(station), safe_name(sensor), day_of(t))
+        with self.lock:
+            segment = self.segments.get(key)
+            if segment is None:
+                segment = self.segments[key] = Segment(os.path.join(self.path, *key))
+            segment.append(row)
+            self.pending += 1
+            if self.pending >= self.flush_rows:
+                self._flush()
+
+    def _flush(self):
+        written = 0
+        for segment in self.segments.values():
+            written += segment.flush(self.fsync)
+        # Segments are cheap to reopen, so don't hold on to quiet stations
+        self.segments = {}
+        self.pending = 0
+        return written
+
+    def flush(self):
+        with self.lock:
+            return self._flush()
+
+    def run(self, stop):
+        while not stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        written = self.flush()
+        print("Archived %d samples on shutdown"% (written,))
+
+# Returns None when no archive path is configured
+def from_config(config):
+    path = config.get('ARCHIVE', 'path', fallback=None)
+    if not path:
+        return None
+    return Archive(
+        path,
+        flush_rows=config.getint('ARCHIVE', 'flush_rows', fallback=1000),
+        flush_interval=config.getfloat('ARCHIVE', 'flush_interval', fallback=60),
+        fsync=config.getboolean('ARCHIVE', 'fsync', fallback=False))
+
+# A committed column mapped read-only, as a sequence of doubles
+class Column:
+    def __init__(self, path, rows):
+        self.file = open(path, 'rb')
+        size = min(rows * 8, os.fstat(self.file.fileno()).st_size)
+        self.map = None
+        self.view = memoryview(b'')
+        if size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)[:size]
+        self.values = self.view.cast('d')
+
+    def close(self):
+        self.values.release()
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.strptime(value, DAY_FORMAT).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+def days_between(start, end):
+    day = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).date()
+    last = datetime.datetime.fromtimestamp(end, datetime.timezone.utc).date()
+    while day <= last:
+        yield day.strftime(DAY_FORMAT)
+        day += datetime.timedelta(days=1)
+
+# (ts, value) for every archived sample of field in [start, end).  Derived
+# fields that weren't stored are worked out from their inputs.
+def scan(path, station, sensor, field, start, end):
+    base = os.path.join(path, safe_name(station), safe_name(sensor))
+    field = safe_name(field)
+    for day in days_between(start, end):
+        segment_path = os.path.join(base, day)
+        meta = load_segment(segment_path)
+        if not meta['rows']:
+            continue
+        if field in meta['columns']:
+            inputs = (field,)
+        elif field in derived.SERIES and all(c in meta['columns'] for c in derived.SERIES[field][0]):
+            inputs = derived.SERIES[field][0]
+        else:
+            continue
+
+        columns = [Column(os.path.join(segment_path, column + SUFFIX), meta['rows']) for column in ('ts',) + inputs]
+        try:
+            times = columns[0].values
+            rows = min(len(column.values) for column in columns)
+            if len(inputs) == 1 and inputs[0] == field:
+                values = columns[1].values
+            else:
+                # The whole derived column at once, rather than row by row
+                values = derived.series(field, *[column.values[:rows] for column in columns[1:]])
+            for i in range(rows):
+                t = times[i]
+                if start <= t < end:
+                    value = values[i]
+                    if value == value:
+                        yield t, value
+        finally:
+            for column in columns:
+                column.close()
+
+STEPS = {'raw': 0, '1m': 60, '1h': 3600, '1d': 86400}
+
+def query(path, station, sensor, field, start, end, step):
+    if not step:
+        return [{"t": t, "value": value} for t, value in scan(path, station, sensor, field, start, end)]
+    buckets = {}
+    for t, value in scan(path, station, sensor, field, start, end):
+        bucket = buckets.get(t - t % step)
+        if bucket is None:
+            buckets[t - t % step] = [1, value, value, value]
+        else:
+            bucket[0] += 1
+            bucket[1] = min(bucket[1], value)
+            bucket[2] = max(bucket[2], value)
+            bucket[3] += value
+    return [{"t": t, "count": count, "min": low, "max": high, "mean": total / count}
+            for t, (count, low, high, total) in sorted(buckets.items())]
+
+def list_segments(path):
+    for station in sorted(os.listdir(path)):
+        for sensor in sorted(os.listdir(os.path.join(path, station))):
+            days = sorted(os.listdir(os.path.join(path, station, sensor)))
+            if not days:
+                continue
+            rows = sum(load_segment(os.path.join(path, station, sensor, day))['rows'] for day in days)
+            columns = set()
+            for day in days:
+                columns.update(load_segment(os.path.join(path, station, sensor, day))['columns'])
+            print("%s/%s: %d rows from %s to %s, %s"% (station, sensor, rows, days[0], days[-1], ", ".join(sorted(columns))))
+
+def main():
+    import configparser
+    config = configparser.ConfigParser()
+    config.read('weather-station.ini')
+
+    parser = argparse.ArgumentParser(description="Query the subscriber's archive")
+    parser.add_argument('--path', default=config.get('ARCHIVE', 'path', fallback=None) or 'archive', help="archive directory")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help="show what's archived")
+    query_parser = commands.add_parser('query', help="scan a field over a time range")
+    query_parser.add_argument('station')
+    query_parser.add_argument('sensor')
+    query_parser.add_argument('field')
+    query_parser.add_argument('--start', default='0', help="epoch seconds or YYYY-MM-DD (UTC)")
+    query_parser.add_argument('--end', default=None, help="epoch seconds or YYYY-MM-DD (UTC), default now")
+    query_parser.add_argument('--step', default='1h', choices=list(STEPS), help="raw samples, or min/max/mean per bucket")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        print("Nothing archived in %s"% (args.path,))
+        return
+
+    if args.command == 'list':
+        list_segments(args.path)
+        return
+
+    base = os.path.join(args.path, safe_name(args.station), safe_name(args.sensor))
+    if not os.path.isdir(base):
+        print("Nothing archived for %s/%s in %s"% (args.station, args.sensor, args.path))
+        return
+
+    start = parse_time(args.start)
+    end = parse_time(args.end) if args.end else time.time()
+    if start == 0:
+        # Don't walk every day since 1970
+        days = sorted(os.listdir(base))
+        if days:
+            start = parse_time(days[0])
+    for point in query(args.path, args.station, args.sensor, args.field, start, end, STEPS[args.step]):
+        print(json.dumps(point))
+
+if __name__ == '__main__':
+    main()
@@ -5,27 +5,61 @@
 
 import configparser
 from awscrt import mqtt, http
-from awsiot import mqtt_connection_builder
 import sys
 import time
-import json
+import wal
+import batching
+import deadband
+import instrumentation
+import signal
+import sensors
+import transport
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+import concurrent.futures
 
 config = configparser.ConfigParser()
 config.read('weather-station.ini')
 
-endpoint=config['AWS']['endpoint']
-cert_filepath=config['AWS']['cert_filepath']
-pri_key_filepath=config['AWS']['pri_key_filepath']
-ca_filepath=config['AWS']['ca_filepath']
 clientId=config['AWS']['clientId']
 message_topic=config['AWS']['message_topic']
 
-url=config['DEVICES']['awair_url']
+class AwairDevice:
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.last_success = time.monotonic()
+        self.stale = False
+        self.future = None
+        self.sensor = sensors.AwairSensor(url, timeout, session)
+        # Each device has its own deadband, so one busy room doesn't hide another
+        self.changes = deadband.from_config(config, interval, sensors.AwairSensor.min_interval)
+
+# Each device is "name url" on its own line. A bare URL is named after its host.
+def parse_devices(value):
+    devices = []
+    for line in value.splitlines():
+        parts = line.split()
+        if len(parts) == 1:
+            devices.append(AwairDevice(urlparse(parts[0]).hostname, parts[0]))
+        elif len(parts) >= 2:
+            devices.append(AwairDevice(parts[0], parts[1]))
+    return devices
+
+interval = config.getfloat('DEVICES', 'awair_interval', fallback=5)
+timeout = config.getfloat('DEVICES', 'awair_timeout', fallback=2)
+stale_after = config.getfloat('DEVICES', 'awair_stale_after', fallback=60)
+session = requests.Session()
+devices = parse_devices(config.get('DEVICES', 'awair_devices', fallback=config.get('DEVICES', 'awair_url', fallback='')))
+
+# Keep a connection open to every device instead of reconnecting each poll
+session.mount('http://', HTTPAdapter(pool_connections=max(1, len(devices)), pool_maxsize=max(1, len(devices))))
 
 # Callback when connection is accidentally lost.
 def on_connection_interrupted(connection, error, **kwargs):
     print("Connection interrupted. error: {}".format(error))
+    store.connection_interrupted()
 
 # Callback when an interrupted connection is re-established.
 def on_connection_resumed(connection, return_code, session_present, **kwargs):
@@ -38,6 +72,10 @@ def on_connection_resumed(connection, return_code, session_present, **kwargs):
         # Cannot synchronously wait for resubscribe result because we're on the connection's event-loop thread,
         # evaluate result with a callback instead.
         resubscribe_future.add_done_callback(on_resubscribe_complete)
+
+    if return_code == mqtt.ConnectReturnCode.ACCEPTED:
+        # Replay anything that was queued on disk while we were offline
+        store.connection_resumed()
     
 
 def on_resubscribe_complete(resubscribe_future):
@@ -63,56 +101,106 @@ def on_connection_failure(connection, callback_data):
 def on_connection_closed(connection, callback_data):
     print("Connection closed")
 
-def read_awair(url):
-    data = {}
-    
-    r = requests.get(url)
-    if r.status_code == 200:
-        data = json.loads(r.text)
-        temperature_c = data['temp']
-        data['temperature_f'] = temperature_c * (9 / 5) + 32
-    else:
-        print("Got an error querying the web server %d"% (r.status_code))
-
+def poll_device(device):
+    data = instrumentation.timed_read(device.name, device.sensor.read)
+    now = time.monotonic()
+    if data.get('temperature_f') is not None:
+        data['device'] = device.name
+        device.last_success = now
+        if device.stale:
+            print("Awair %s is answering again"% (device.name,))
+            device.stale = False
+    elif not device.stale and now - device.last_success >= stale_after:
+        print("Awair %s hasn't answered for %d seconds"% (device.name, now - device.last_success))
+        device.stale = True
     return data
+
+# Poll every device at once and return (device, reading) for the readings
+# that came back in time.
+# A device whose last poll is still hung is skipped rather than queued up.
+def poll_devices(executor):
+    polled = []
+    for device in devices:
+        if device.future is None or device.future.done():
+            device.future = executor.submit(poll_device, device)
+            polled.append(device)
+
+    done, _ = concurrent.futures.wait([d.future for d in polled], timeout=interval)
+    readings = []
+    for device in polled:
+        if device.future in done and device.future.exception() is None:
+            data = device.future.result()
+            if data.get('temperature_f') is not None:
+                readings.append((device, data))
+        elif device.future in done:
+            print("Error polling Awair %s: %s"% (device.name, device.future.exception()))
+    return readings
         
 if __name__ == '__main__':
-    # Create a MQTT connection from the command line data
-    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-        endpoint=endpoint,
-        cert_filepath=cert_filepath,
-        pri_key_filepath=pri_key_filepath,
-        ca_filepath=ca_filepath,
+    # Connect to AWS IoT, the local broker, or both ([LOCAL] transport)
+    mqtt_connection = transport.from_config(
+        config,
+        clientId,
         on_connection_interrupted=on_connection_interrupted,
         on_connection_resumed=on_connection_resumed,
-        client_id=clientId,
-        clean_session=False,
-        keep_alive_secs=30,
         on_connection_success=on_connection_success,
         on_connection_failure=on_connection_failure,
         on_connection_closed=on_connection_closed)
 
+    # Every reading goes through the on-disk queue so nothing is lost during an outage
+    store = wal.from_config(config, mqtt_connection, message_topic, "%s.wal"% (clientId,))
+
     connect_future = mqtt_connection.connect()
 
     # Future.result() waits until a result is available
     connect_future.result()
     print("Connected!")
-
-    while True:
-        data = read_awair(url)
-        message = json.dumps(data)
-        if data['temperature_f'] is not None:
-            print("Publishing message to topic '{}': {}".format(message_topic, message))
-            mqtt_connection.publish(
-                topic=message_topic,
-                payload=message,
-                qos=mqtt.QoS.AT_LEAST_ONCE)
-        else:
-            print("Failed to retrieve data from sensors")
-        time.sleep(5)
-
-    # Disconnect
-    print("Disconnecting...")
-    disconnect_future = mqtt_connection.disconnect()
-    disconnect_future.result()
-    print("Disconnected!")
+    store.connection_resumed()
+
+    # Metrics endpoint and profiler toggle
+    instrumentation.start(config)
+
+    batcher = batching.from_config(config)
+
+    # Stop cleanly on SIGTERM so a partial batch is flushed to the queue
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(devices)))
+    next_poll = time.monotonic()
+
+    try:
+        while True:
+            readings = poll_devices(executor)
+            if not readings:
+                print("Failed to retrieve data from sensors")
+                message = batcher.poll()
+                if message is not None:
+                    print("Publishing message to topic '{}': {}".format(message_topic, message))
+                    store.publish(message)
+            for device, data in readings:
+                if device.changes.check(data):
+                    with instrumentation.serialize_histogram.time():
+                        message = batcher.add(data)
+                else:
+                    message = batcher.poll()
+                if message is not None:
+                    print("Publishing message to topic '{}': {}".format(message_topic, message))
+                    store.publish(message)
+
+            # Poll on a fixed cadence no matter how long the devices took,
+            # as fast as the quickest changing device wants
+            next_poll = max(next_poll + min([d.changes.next_interval() for d in devices] or [interval]), time.monotonic())
+            time.sleep(max(0, next_poll - time.monotonic()))
+    finally:
+        # Don't lose a partially filled batch on shutdown
+        message = batcher.flush()
+        if message is not None:
+            store.publish(message)
+        executor.shutdown(wait=False)
+
+        # Disconnect
+        print("Disconnecting...")
+        disconnect_future = mqtt_connection.disconnect()
+        disconnect_future.result()
+        print("Disconnected!")
+        store.wal.close()
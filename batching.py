@@ -0,0 +1,85 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Collects several samples into one MQTT payload so a station sends one
+# message every N samples or T seconds instead of one per reading.
+#
+# A batch looks like:
+#   {"ts": 1700000000.0, "samples": [{"ts": 1699999995.0, "temperature_f": 71.2, ...}, ...]}
+# with samples oldest first.
+#
+# Every sample is stamped with the time it was taken (ts), a sequence number
+# (seq) and the time this publisher started (boot), so the subscriber can
+# spot delayed, lost and duplicated readings. seq starts again from 0 with
+# each new boot.
+#
+# With encoding = binary the same samples are packed with codec.py instead.
+
+import codec
+import json
+import time
+
+class Batcher:
+    def __init__(self, max_samples=1, max_age=60, encoding='json'):
+        if encoding not in codec.ENCODINGS:
+            raise ValueError("Unknown payload encoding %s"% (encoding,))
+        self.encoding = encoding
+        if encoding == 'binary':
+            # A binary payload holds at most 255 samples
+            max_samples = min(max_samples, 255)
+        self.max_samples = max_samples
+        self.max_age = max_age
+        self.samples = []
+        self.started = None
+        self.boot = int(time.time())
+        self.seq = 0
+
+    def enabled(self):
+        return self.max_samples > 1
+
+    def stamp(self, data):
+        sample = dict(data)
+        sample['ts'] = time.time()
+        sample['seq'] = self.seq
+        sample['boot'] = self.boot
+        self.seq += 1
+        return sample
+
+    # Add a sample and return a payload if the batch should go out now.
+    def add(self, data):
+        sample = self.stamp(data)
+        if not self.enabled():
+            if self.encoding == 'binary':
+                return codec.encode([sample])
+            return json.dumps(sample)
+
+        if not self.samples:
+            self.started = time.monotonic()
+        self.samples.append(sample)
+
+        if len(self.samples) >= self.max_samples:
+            return self.flush()
+        return self.poll()
+
+    # Return a payload if the oldest sample has waited long enough.
+    def poll(self):
+        if self.samples and time.monotonic() - self.started >= self.max_age:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self.samples:
+            return None
+        if self.encoding == 'binary':
+            message = codec.encode(self.samples)
+        else:
+            message = json.dumps({"ts": time.time(), "samples": self.samples})
+        self.samples = []
+        self.started = None
+        return message
+
+def from_config(config):
+    return Batcher(
+        max_samples=config.getint('BATCH', 'max_samples', fallback=1),
+        max_age=config.getfloat('BATCH', 'max_age', fallback=60),
+        encoding=config.get('BATCH', 'encoding', fallback='json'))
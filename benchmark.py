@@ -0,0 +1,251 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Benchmarks for the hot paths: subscriber message handling, the
+# Wunderground conversions and upload, and publisher payload serialization.
+# Network sinks are replaced with fakes, and sensors and MQTT come from
+# simulation/fakes, so this runs anywhere.
+#
+#   python benchmark.py                        # run everything, compare to the baseline
+#   python benchmark.py ingest --rate 200      # replay at 200 messages/s
+#   python benchmark.py --save-baseline        # record the current numbers as the baseline
+#   python benchmark.py --replay payloads.jsonl
+#
+# Reports messages/s, p50/p99 latency per message, and the memory each
+# message allocates (peak bytes allocated while handling it, and blocks
+# still held afterwards).
+
+import argparse
+import contextlib
+import gc
+import itertools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulation', 'fakes'))
+
+from simulation.weather import SyntheticWeather
+import batching
+import sensors
+import wunderground
+
+DEFAULT_BASELINE = 'benchmark-baseline.json'
+
+# How much worse than the baseline counts as a regression
+REGRESSION_THRESHOLD = 1.2
+
+def generate_payloads(count, seed=0):
+    weather = SyntheticWeather(seed)
+    payloads = []
+    for i in range(count):
+        reading = weather.sample(1700000000 + i * 5)
+        data = {
+            "temperature_f": sensors.celsius_to_fahrenheit(reading['temperature_c']),
+            "humidity": reading['humidity'],
+        }
+        # Every other message comes from the BME680 inside
+        if i % 2:
+            data['pressure'] = reading['pressure']
+            data['gas'] = reading['gas']
+        payloads.append(json.dumps(data).encode('utf-8'))
+    return payloads
+
+def load_payloads(path):
+    with open(path, 'rb') as f:
+        return [line.strip() for line in f if line.strip()]
+
+# Stands in for requests.Session so uploads never leave the box
+class FakeResponse:
+    status_code = 200
+    text = "success"
+
+class FakeSession:
+    def __init__(self):
+        self.requests = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.requests += 1
+        return FakeResponse()
+
+    def close(self):
+        pass
+
+# Each benchmark returns a function that handles message i.  run_benchmark()
+# sets one up afresh for each pass it makes over the messages.
+def bench_ingest(subscriber, payloads):
+    def step(i):
+        subscriber.process_message("bench", payloads[i], False, 1, False)
+    return step
+
+# The same messages, packed the way a publisher with encoding = binary sends them.
+# Every pass gets its own boot, or the subscriber would drop its samples as
+# duplicates of the last pass's.
+boots = itertools.count(int(time.time()))
+
+def bench_ingest_binary(subscriber, payloads):
+    batcher = batching.Batcher(encoding='binary')
+    batcher.boot = next(boots)
+    payloads = [batcher.add(json.loads(payload)) for payload in payloads]
+    def step(i):
+        subscriber.process_message("bench", payloads[i], False, 1, False)
+    return step
+
+def bench_wunderground(subscriber, payloads):
+    uploader = wunderground.from_config(subscriber.config)
+    uploader.session = FakeSession()
+    samples = [json.loads(payload) for payload in payloads]
+    state = subscriber.stations.SensorState('bench', 'outside')
+    subscriber.home_sensors['outside'] = state
+    def step(i):
+        sample = dict(samples[i])
+        sample.setdefault('sea_level_pressure', 1013.25)
+        state.update(sample, time.time())
+        observation = subscriber.wunderground_observation()
+        if observation is not None:
+            uploader.upload(observation)
+    return step
+
+def bench_serialize(subscriber, payloads):
+    batcher = batching.Batcher()
+    samples = [json.loads(payload) for payload in payloads]
+    def step(i):
+        batcher.add(samples[i])
+    return step
+
+def bench_serialize_batch(subscriber, payloads):
+    batcher = batching.Batcher(max_samples=12, max_age=60)
+    samples = [json.loads(payload) for payload in payloads]
+    def step(i):
+        batcher.add(samples[i])
+    return step
+
+def bench_serialize_binary(subscriber, payloads):
+    batcher = batching.Batcher(encoding='binary')
+    samples = [json.loads(payload) for payload in payloads]
+    def step(i):
+        batcher.add(samples[i])
+    return step
+
+BENCHMARKS = {
+    'ingest': bench_ingest,
+    'ingest-binary': bench_ingest_binary,
+    'wunderground': bench_wunderground,
+    'serialize': bench_serialize,
+    'serialize-batch': bench_serialize_batch,
+    'serialize-binary': bench_serialize_binary,
+}
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run_benchmark(setup, count, rate):
+    # Warm up caches and lazily created state first
+    step = setup()
+    for i in range(min(count, 100)):
+        step(i)
+
+    step = setup()
+    gc.collect()
+    latencies = []
+    interval = 1.0 / rate if rate else 0
+    started = time.perf_counter()
+    for i in range(count):
+        if interval:
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        t0 = time.perf_counter_ns()
+        step(i)
+        latencies.append(time.perf_counter_ns() - t0)
+    elapsed = time.perf_counter() - started
+
+    # Memory is measured in a separate pass, tracemalloc slows everything down
+    step = setup()
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    peak = 0
+    sample = min(count, 1000)
+    for i in range(sample):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        step(i)
+        _, high = tracemalloc.get_traced_memory()
+        peak += high - start
+    tracemalloc.stop()
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks
+
+    latencies.sort()
+    return {
+        "messages_per_second": count / elapsed,
+        "p50_us": percentile(latencies, 0.50) / 1000,
+        "p99_us": percentile(latencies, 0.99) / 1000,
+        "alloc_bytes_per_message": peak / sample,
+        "retained_blocks_per_message": retained / sample,
+    }
+
+def compare(name, result, baseline):
+    previous = baseline.get(name)
+    if previous is None:
+        return []
+    regressions = []
+    if result['messages_per_second'] * REGRESSION_THRESHOLD < previous['messages_per_second']:
+        regressions.append("throughput %.0f msg/s, was %.0f"% (result['messages_per_second'], previous['messages_per_second']))
+    for key in ('p50_us', 'p99_us', 'alloc_bytes_per_message'):
+        if result[key] > previous[key] * REGRESSION_THRESHOLD:
+            regressions.append("%s %.1f, was %.1f"% (key, result[key], previous[key]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the subscriber and publisher hot paths")
+    parser.add_argument('benchmarks', nargs='*', help="benchmarks to run: %s (default all)"% (", ".join(BENCHMARKS),))
+    parser.add_argument('--count', type=int, default=10000, help="messages per benchmark")
+    parser.add_argument('--rate', type=float, default=0, help="messages per second (default as fast as possible)")
+    parser.add_argument('--replay', help="file of recorded payloads, one JSON message per line")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="baseline results file")
+    parser.add_argument('--save-baseline', action='store_true', help="save these results as the new baseline")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s"% (name,))
+
+    payloads = load_payloads(args.replay) if args.replay else generate_payloads(args.count)
+    payloads = (payloads * (args.count // len(payloads) + 1))[:args.count]
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = False
+    report = sys.stdout
+    print("%-16s %12s %10s %10s %14s %14s"% ("benchmark", "msg/s", "p50 us", "p99 us", "alloc B/msg", "retained/msg"), file=report)
+    # The code under test prints a lot, keep it out of the report
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        import subscriber
+        subscriber.setup_worker()
+        for name in args.benchmarks or BENCHMARKS:
+            result = run_benchmark(lambda: BENCHMARKS[name](subscriber, payloads), args.count, args.rate)
+            results[name] = result
+            print("%-16s %12.0f %10.1f %10.1f %14.0f %14.2f"% (
+                name, result['messages_per_second'], result['p50_us'], result['p99_us'],
+                result['alloc_bytes_per_message'], result['retained_blocks_per_message']), file=report)
+            for regression in compare(name, result, baseline):
+                failed = True
+                print("  REGRESSION: %s"% (regression,), file=report)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("Saved baseline to %s"% (args.baseline,), file=report)
+
+    sys.exit(1 if failed and not args.save_baseline else 0)
+
+if __name__ == '__main__':
+    main()
@@ -5,26 +5,26 @@
 
 import configparser
 from awscrt import mqtt, http
-from awsiot import mqtt_connection_builder
 import sys
 import time
-import board
-import json
-import adafruit_bme680
+import wal
+import batching
+import deadband
+import instrumentation
+import signal
+import sensors
+import transport
 
 config = configparser.ConfigParser()
 config.read('weather-station.ini')
 
-endpoint=config['AWS']['endpoint']
-cert_filepath=config['AWS']['cert_filepath']
-pri_key_filepath=config['AWS']['pri_key_filepath']
-ca_filepath=config['AWS']['ca_filepath']
 clientId=config['AWS']['clientId']
 message_topic=config['AWS']['message_topic']
 
 # Callback when connection is accidentally lost.
 def on_connection_interrupted(connection, error, **kwargs):
     print("Connection interrupted. error: {}".format(error))
+    store.connection_interrupted()
 
 # Callback when an interrupted connection is re-established.
 def on_connection_resumed(connection, return_code, session_present, **kwargs):
@@ -37,6 +37,10 @@ def on_connection_resumed(connection, return_code, session_present, **kwargs):
         # Cannot synchronously wait for resubscribe result because we're on the connection's event-loop thread,
         # evaluate result with a callback instead.
         resubscribe_future.add_done_callback(on_resubscribe_complete)
+
+    if return_code == mqtt.ConnectReturnCode.ACCEPTED:
+        # Replay anything that was queued on disk while we were offline
+        store.connection_resumed()
     
 
 def on_resubscribe_complete(resubscribe_future):
@@ -62,70 +66,69 @@ def on_connection_failure(connection, callback_data):
 def on_connection_closed(connection, callback_data):
     print("Connection closed")
 
-def read_bme680(bme680):
-    data = {
-        "temperature_f": None,
-        "gas": None,
-        "humidity": None,
-        "pressure": None
-        }
-    
-    try:
-        temperature_c = bme680.temperature - 5
-        data['temperature_f'] = temperature_c * (9 / 5) + 32
-        data['gas'] = bme680.gas
-        data['humidity'] = bme680.relative_humidity
-        data['pressure'] = bme680.pressure
-    except RuntimeError as error:
-        # If we get an error, let's log it and return empty data.
-        print(error.args[0])
-
-    return data
-        
-# Create sensor object, communicating over the board's default I2C bus
-i2c = board.I2C()   # uses board.SCL and board.SDA
-bme680 = adafruit_bme680.Adafruit_BME680_I2C(i2c)
-
-# change this to match the location's pressure (hPa) at sea level
-bme680.sea_level_pressure = 1013.25
+bme680 = sensors.BME680Sensor.from_config(config['DEVICES'])
 
 if __name__ == '__main__':
-    # Create a MQTT connection from the command line data
-    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-        endpoint=endpoint,
-        cert_filepath=cert_filepath,
-        pri_key_filepath=pri_key_filepath,
-        ca_filepath=ca_filepath,
+    # Connect to AWS IoT, the local broker, or both ([LOCAL] transport)
+    mqtt_connection = transport.from_config(
+        config,
+        clientId,
         on_connection_interrupted=on_connection_interrupted,
         on_connection_resumed=on_connection_resumed,
-        client_id=clientId,
-        clean_session=False,
-        keep_alive_secs=30,
         on_connection_success=on_connection_success,
         on_connection_failure=on_connection_failure,
         on_connection_closed=on_connection_closed)
 
+    # Every reading goes through the on-disk queue so nothing is lost during an outage
+    store = wal.from_config(config, mqtt_connection, message_topic, "%s.wal"% (clientId,))
+
     connect_future = mqtt_connection.connect()
 
     # Future.result() waits until a result is available
     connect_future.result()
     print("Connected!")
+    store.connection_resumed()
+
+    # Metrics endpoint and profiler toggle
+    instrumentation.start(config)
 
-    while True:
-        data = read_bme680(bme680)
-        message = json.dumps(data)
-        if data['temperature_f'] is not None:
-            print("Publishing message to topic '{}': {}".format(message_topic, message))
-            mqtt_connection.publish(
-                topic=message_topic,
-                payload=message,
-                qos=mqtt.QoS.AT_LEAST_ONCE)
-        else:
-            print("Failed to retrieve data from sensors")
-        time.sleep(5)
-
-    # Disconnect
-    print("Disconnecting...")
-    disconnect_future = mqtt_connection.disconnect()
-    disconnect_future.result()
-    print("Disconnected!")
+    batcher = batching.from_config(config)
+
+    # Only publish readings that have moved, sampling faster while they move quickly
+    changes = deadband.from_config(config, 5, bme680.min_interval)
+
+    # Stop cleanly on SIGTERM so a partial batch is flushed to the queue
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    next_poll = time.monotonic()
+
+    try:
+        while True:
+            data = instrumentation.timed_read('bme680', bme680.read)
+            if data['temperature_f'] is None:
+                print("Failed to retrieve data from sensors")
+                message = batcher.poll()
+            elif changes.check(data):
+                with instrumentation.serialize_histogram.time():
+                    message = batcher.add(data)
+            else:
+                message = batcher.poll()
+            if message is not None:
+                print("Publishing message to topic '{}': {}".format(message_topic, message))
+                store.publish(message)
+
+            # Keep a steady cadence however long the read and publish took
+            next_poll = max(next_poll + changes.next_interval(), time.monotonic())
+            time.sleep(max(0, next_poll - time.monotonic()))
+    finally:
+        # Don't lose a partially filled batch on shutdown
+        message = batcher.flush()
+        if message is not None:
+            store.publish(message)
+
+        # Disconnect
+        print("Disconnecting...")
+        disconnect_future = mqtt_connection.disconnect()
+        disconnect_future.result()
+        print("Disconnected!")
+        store.wal.close()
@@ -0,0 +1,170 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# A compact binary payload for the publishers, as an alternative to JSON.
+# A 127-byte JSON DHT22 reading packs into 25 bytes.
+#
+#   version   B      VERSION, in BINARY_VERSIONS, which a JSON payload can
+#                    never start with
+#   count     B      number of samples, oldest first
+#   boot      I
+#   then count samples of
+#     seq       I
+#     ts        I H  seconds and milliseconds
+#     fields    B    number of fields that follow
+#     then fields of an id byte and a value in that field's format
+#
+# Numbers are fixed point, scaled by the field's scale.  Strings are a
+# length byte and UTF-8.  Anything the schema doesn't know, or that doesn't
+# fit its field, goes in one EXTRA field of length-prefixed JSON, so nothing
+# is ever lost.
+#
+# Field ids are never reused.  A change that existing subscribers couldn't
+# decode needs a new VERSION.  A payload starting with any byte in
+# BINARY_VERSIONS is binary, so a subscriber reports a version newer than
+# it knows as just that, not as malformed JSON.
+
+import json
+import struct
+
+VERSION = 1
+# Bytes below tab, the first JSON whitespace
+BINARY_VERSIONS = range(1, 9)
+
+HEADER = struct.Struct('<BBI')
+SAMPLE = struct.Struct('<IIHB')
+FIELD_ID = struct.Struct('<B')
+STRING_LENGTH = struct.Struct('<B')
+EXTRA_LENGTH = struct.Struct('<H')
+
+STRING = 's'
+EXTRA = 255
+
+# id: (name, format, scale)
+FIELDS = {
+    1: ('temperature_f', 'h', 100),
+    2: ('humidity', 'H', 100),
+    3: ('pressure', 'I', 100),
+    4: ('gas', 'I', 1),
+    5: ('quality', 'B', 100),
+    6: ('co2', 'H', 1),
+    7: ('voc', 'H', 1),
+    8: ('pm25', 'H', 10),
+    9: ('score', 'H', 10),
+    20: ('device', STRING, None),
+    21: ('station', STRING, None),
+}
+
+# name: (id, struct of the id and value, scale)
+ENCODERS = {}
+# id: (name, struct of the value, scale)
+DECODERS = {}
+for field_id, (name, fmt, scale) in FIELDS.items():
+    if fmt == STRING:
+        ENCODERS[name] = (field_id, None, None)
+        DECODERS[field_id] = (name, None, None)
+    else:
+        ENCODERS[name] = (field_id, struct.Struct('<B' + fmt), scale)
+        DECODERS[field_id] = (name, struct.Struct('<' + fmt), scale)
+
+# Fields every sample carries in its header rather than as fields
+STAMPS = ('seq', 'ts', 'boot')
+
+ENCODINGS = ('json', 'binary')
+
+def _encode_sample(sample, parts):
+    fields = []
+    extra = {}
+    for name, value in sample.items():
+        if name in STAMPS or value is None:
+            continue
+        encoder = ENCODERS.get(name)
+        if encoder is None:
+            extra[name] = value
+            continue
+        field_id, packer, scale = encoder
+        try:
+            if packer is None:
+                value = value.encode('utf-8')
+                fields.append(FIELD_ID.pack(field_id) + STRING_LENGTH.pack(len(value)) + value)
+            else:
+                fields.append(packer.pack(field_id, round(value * scale)))
+        except (struct.error, TypeError, AttributeError, ValueError, OverflowError):
+            # NaN and infinity don't scale, so they go as JSON too
+            extra[name] = value
+    if extra:
+        value = json.dumps(extra, separators=(',', ':')).encode('utf-8')
+        fields.append(FIELD_ID.pack(EXTRA) + EXTRA_LENGTH.pack(len(value)) + value)
+
+    ts = sample.get('ts', 0)
+    seconds = int(ts)
+    parts.append(SAMPLE.pack(sample.get('seq', 0), seconds, int((ts - seconds) * 1000), len(fields)))
+    parts.extend(fields)
+
+# Pack samples stamped by batching.Batcher into one binary payload
+def encode(samples):
+    if not samples or len(samples) > 255:
+        raise ValueError("Can't encode %d samples in one payload"% (len(samples),))
+    parts = [HEADER.pack(VERSION, len(samples), samples[0].get('boot', 0))]
+    for sample in samples:
+        _encode_sample(sample, parts)
+    return b''.join(parts)
+
+def _decode_binary(payload):
+    version, count, boot = HEADER.unpack_from(payload, 0)
+    if version != VERSION:
+        raise ValueError("Unsupported payload version %d, this subscriber only knows %d"% (version, VERSION))
+    offset = HEADER.size
+    samples = []
+    for _ in range(count):
+        seq, seconds, millis, fields = SAMPLE.unpack_from(payload, offset)
+        offset += SAMPLE.size
+        sample = {'seq': seq, 'ts': seconds + millis / 1000, 'boot': boot}
+        for _ in range(fields):
+            field_id = payload[offset]
+            offset += 1
+            if field_id == EXTRA:
+                length, = EXTRA_LENGTH.unpack_from(payload, offset)
+                offset += EXTRA_LENGTH.size
+                sample.update(json.loads(payload[offset:offset + length]))
+                offset += length
+                continue
+            decoder = DECODERS.get(field_id)
+            if decoder is None:
+                raise ValueError("Unknown field id %d"% (field_id,))
+            name, unpacker, scale = decoder
+            if unpacker is None:
+                length = payload[offset]
+                offset += 1
+                sample[name] = payload[offset:offset + length].decode('utf-8')
+                offset += length
+            else:
+                value, = unpacker.unpack_from(payload, offset)
+                offset += unpacker.size
+                sample[name] = value / scale
+        samples.append(sample)
+    return samples
+
+# Returns the samples in a binary or JSON payload, oldest first.  Raises
+# ValueError if it's neither.
+def decode(payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if payload and payload[0] in BINARY_VERSIONS:
+        try:
+            return _decode_binary(payload)
+        except (struct.error, IndexError, UnicodeDecodeError) as error:
+            raise ValueError("Malformed binary payload: %s"% (error,))
+
+    data = json.loads(payload)
+    # Batched payloads carry a list of samples, oldest first
+    if isinstance(data, dict) and 'samples' in data:
+        samples = data['samples']
+        if not isinstance(samples, list):
+            raise ValueError("Batched payload's samples aren't a list")
+    else:
+        samples = [data]
+    for sample in samples:
+        if not isinstance(sample, dict):
+            raise ValueError("Sample %r isn't an object"% (sample,))
+    return samples
@@ -0,0 +1,112 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Decides which readings are worth publishing.  A reading goes out when any
+# field with a threshold has moved by at least that much since the last one
+# we sent, or when heartbeat seconds have passed so the subscriber knows we
+# are still alive.  With no thresholds configured every reading goes out.
+#
+# It also picks how long to wait for the next reading: while a field moves
+# past its threshold every interval (a pressure drop ahead of a storm, the
+# sun coming out) we sample every fast_interval seconds instead, until
+# nothing has moved that fast for fast_hold seconds.
+
+from prometheus_client import Counter
+import time
+
+# Options in [DEADBAND] that aren't field thresholds
+OPTIONS = ('heartbeat', 'fast_interval', 'fast_hold')
+
+suppressed_counter = Counter('publish_suppressed', 'Readings not published because nothing moved past its deadband')
+
+class Deadband:
+    def __init__(self, thresholds=None, heartbeat=300, interval=5, fast_interval=None, fast_hold=60):
+        self.thresholds = thresholds or {}
+        self.heartbeat = heartbeat
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.fast_hold = fast_hold
+
+        self.last_sent = {}
+        self.last_publish = None
+        self.previous = None
+        self.fast_until = 0
+
+    def enabled(self):
+        return bool(self.thresholds)
+
+    # Returns True if the reading should be published.  Call it once for
+    # every good reading, published or not.
+    def check(self, data, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._track_rate(data, now)
+        if not self.enabled():
+            return True
+
+        publish = self.last_publish is None or now - self.last_publish >= self.heartbeat
+        for field, threshold in self.thresholds.items():
+            value = data.get(field)
+            if value is None:
+                continue
+            last = self.last_sent.get(field)
+            if last is None or abs(value - last) >= threshold:
+                publish = True
+
+        if not publish:
+            suppressed_counter.inc()
+            return False
+
+        for field in self.thresholds:
+            if data.get(field) is not None:
+                self.last_sent[field] = data[field]
+        self.last_publish = now
+        return True
+
+    # Would a field at its current rate cross its threshold within one
+    # normal interval?  Then keep sampling fast for a while.
+    def _track_rate(self, data, now):
+        if self.fast_interval is None or not self.thresholds:
+            return
+        values = {field: data[field] for field in self.thresholds if data.get(field) is not None}
+        if self.previous is not None:
+            then, previous = self.previous
+            elapsed = now - then
+            for field, value in values.items():
+                if field in previous and elapsed > 0:
+                    rate = abs(value - previous[field]) / elapsed
+                    if rate * self.interval >= self.thresholds[field]:
+                        if now >= self.fast_until:
+                            print("%s is changing quickly, sampling every %s seconds"% (field, self.fast_interval))
+                        self.fast_until = now + self.fast_hold
+        self.previous = (now, values)
+
+    # Seconds to wait before the next reading
+    def next_interval(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.fast_interval is not None and now < self.fast_until:
+            return self.fast_interval
+        return self.interval
+
+# interval is the publisher's normal reading interval, and min_interval the
+# fastest its sensors can be read.
+def from_config(config, interval, min_interval=0):
+    thresholds = {}
+    if config.has_section('DEADBAND'):
+        for field, value in config.items('DEADBAND'):
+            if field not in OPTIONS and value:
+                thresholds[field] = float(value)
+
+    fast_interval = config.getfloat('DEADBAND', 'fast_interval', fallback=None)
+    if fast_interval is not None:
+        fast_interval = max(fast_interval, min_interval)
+        if fast_interval >= interval:
+            fast_interval = None
+
+    return Deadband(
+        thresholds,
+        heartbeat=config.getfloat('DEADBAND', 'heartbeat', fallback=300),
+        interval=interval,
+        fast_interval=fast_interval,
+        fast_hold=config.getfloat('DEADBAND', 'fast_hold', fallback=60))
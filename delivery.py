@@ -0,0 +1,154 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Tracks how well each station's samples are getting to us, from the ts,
+# seq and boot every publisher stamps on them (see batching.py).  Each
+# sensor of a station is tracked separately, since every publisher keeps
+# its own sequence: the inside and outside publishers share a topic, and
+# can even share a boot if they start in the same second.
+#
+#  - message_latency_seconds is the time from a sample being taken to us
+#    receiving it, so it includes time spent queued on the publisher
+#  - messages_gap counts sequence numbers we skipped over, and
+#    messages_late the ones that turned up afterwards, so lost messages are
+#    gap - late
+#  - messages_duplicate counts samples we'd already seen, which are dropped,
+#    and messages_redelivered the samples in messages the broker marked dup
+#  - publisher_restarts counts new boots
+#
+# A bitmap of the last WINDOW sequence numbers per sensor is all it takes
+# to tell a late sample from a duplicate.  Sensors are evicted along with
+# their series when they go quiet, like in stations.py.
+
+from prometheus_client import Counter, Histogram
+import collections
+import threading
+import time
+
+WINDOW = 1024
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, float('inf'))
+
+latency_histogram = Histogram('message_latency_seconds', 'Time from a sample being taken to it being received', ['station', 'sensor'], buckets=LATENCY_BUCKETS)
+gap_counter = Counter('messages_gap', 'Sequence numbers skipped over', ['station', 'sensor'])
+late_counter = Counter('messages_late', 'Samples that arrived after a later one', ['station', 'sensor'])
+duplicate_counter = Counter('messages_duplicate', 'Samples received more than once', ['station', 'sensor'])
+redelivered_counter = Counter('messages_redelivered', 'Samples in messages the broker redelivered with the dup flag', ['station', 'sensor'])
+restarts_counter = Counter('publisher_restarts', 'Publisher restarts seen', ['station', 'sensor'])
+
+METRICS = (latency_histogram, gap_counter, late_counter, duplicate_counter, redelivered_counter, restarts_counter)
+
+class SensorDelivery:
+    __slots__ = ('station', 'sensor', 'boot', 'highest', 'seen', 'updated', 'latency', 'gap', 'late', 'duplicate', 'redelivered', 'restarts')
+
+    def __init__(self, station, sensor):
+        self.station = station
+        self.sensor = sensor
+        self.boot = None
+        self.highest = None
+        # Bit n is set if we've seen highest - n
+        self.seen = 0
+        self.updated = 0
+        self.latency = latency_histogram.labels(station, sensor)
+        self.gap = gap_counter.labels(station, sensor)
+        self.late = late_counter.labels(station, sensor)
+        self.duplicate = duplicate_counter.labels(station, sensor)
+        self.redelivered = redelivered_counter.labels(station, sensor)
+        self.restarts = restarts_counter.labels(station, sensor)
+
+    # Returns False if the sample is a duplicate
+    def record(self, boot, seq):
+        if self.boot is not None and boot is not None and boot < self.boot:
+            # Left over from before the publisher restarted
+            self.late.inc()
+            return True
+        # A publisher that doesn't send boot starts its sequence here too
+        if boot != self.boot or self.highest is None:
+            if self.boot is not None:
+                self.restarts.inc()
+            self.boot = boot
+            self.highest = seq
+            self.seen = 1
+            return True
+
+        if seq > self.highest:
+            skipped = seq - self.highest - 1
+            if skipped:
+                self.gap.inc(skipped)
+            if seq - self.highest < WINDOW:
+                self.seen = ((self.seen << (seq - self.highest)) | 1) & ((1 << WINDOW) - 1)
+            else:
+                self.seen = 1
+            self.highest = seq
+            return True
+
+        distance = self.highest - seq
+        if distance >= WINDOW:
+            # Too old to tell a late sample from a duplicate, call it late
+            self.late.inc()
+            return True
+        bit = 1 << distance
+        if self.seen & bit:
+            self.duplicate.inc()
+            return False
+        self.seen |= bit
+        self.late.inc()
+        return True
+
+    def remove(self):
+        for metric in METRICS:
+            metric.remove(self.station, self.sensor)
+
+class DeliveryTracker:
+    def __init__(self, stale_after=3600, max_sensors=10000):
+        self.stale_after = stale_after
+        self.max_sensors = max_sensors
+        # By (station, sensor), least recently updated first, so eviction
+        # only looks at the front
+        self.sensors = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    # Record a sample from a station's sensor.  Returns False if it's a
+    # duplicate and should be dropped.
+    def record(self, station, sensor, data, dup=False, now=None):
+        if now is None:
+            now = time.time()
+        key = (station, sensor)
+        with self.lock:
+            state = self.sensors.get(key)
+            if state is None:
+                state = self.sensors[key] = SensorDelivery(station, sensor)
+                if len(self.sensors) > self.max_sensors:
+                    self.sensors.popitem(last=False)[1].remove()
+            else:
+                self.sensors.move_to_end(key)
+            state.updated = now
+
+            if dup:
+                state.redelivered.inc()
+
+            sample_time = data.get('ts')
+            if sample_time is not None:
+                state.latency.observe(max(0, now - sample_time))
+
+            seq = data.get('seq')
+            if seq is None:
+                return True
+            return state.record(data.get('boot'), seq)
+
+    # Drop everything that hasn't reported in stale_after seconds
+    def evict_stale(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            while self.sensors:
+                state = next(iter(self.sensors.values()))
+                if now - state.updated < self.stale_after:
+                    break
+                del self.sensors[(state.station, state.sensor)]
+                state.remove()
+
+def from_config(config):
+    return DeliveryTracker(
+        stale_after=config.getfloat('SUBSCRIBER', 'stale_after', fallback=3600),
+        max_sensors=config.getint('SUBSCRIBER', 'max_sensors', fallback=10000))
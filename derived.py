@@ -0,0 +1,185 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Values worked out from the raw readings: dewpoint, heat index, wind chill,
+# sea level pressure and an air quality score from the BME680's gas
+# resistance.  The subscriber adds them to each sample as it arrives, so
+# the gauges, the archive and Wunderground all see the same numbers, and
+# keeps the last inputs and results per station and sensor so a repeated
+# reading (a deadband heartbeat) isn't worked out again.
+#
+# SERIES lets the archive work them out over columns of older history that
+# was stored without them.
+
+from array import array
+import collections
+import math
+import time
+
+# Standard atmosphere at sea level, in hPa
+STANDARD_PRESSURE = 1013.25
+
+def f_to_c(temperature_f):
+    return (temperature_f - 32) * 5/9
+
+def c_to_f(temperature_c):
+    return temperature_c * 9/5 + 32
+
+# Magnus formula, good to about 0.1C from -45C to 60C
+# https://en.wikipedia.org/wiki/Dew_point#Calculating_the_dew_point
+def dewpoint_f(temperature_f, humidity):
+    if humidity <= 0:
+        return None
+    temperature_c = f_to_c(temperature_f)
+    gamma = math.log(humidity / 100) + 17.62 * temperature_c / (243.12 + temperature_c)
+    return c_to_f(243.12 * gamma / (17.62 - gamma))
+
+# NWS heat index (Rothfusz regression with its adjustments)
+# https://www.wpc.ncep.noaa.gov/html/heatindex_equation.shtml
+def heat_index_f(temperature_f, humidity):
+    t, rh = temperature_f, humidity
+    simple = 0.5 * (t + 61.0 + (t - 68.0) * 1.2 + rh * 0.094)
+    if (simple + t) / 2 < 80:
+        return simple
+    hi = (-42.379 + 2.04901523 * t + 10.14333127 * rh - 0.22475541 * t * rh
+          - 6.83783e-3 * t * t - 5.481717e-2 * rh * rh + 1.22874e-3 * t * t * rh
+          + 8.5282e-4 * t * rh * rh - 1.99e-6 * t * t * rh * rh)
+    if rh < 13 and 80 <= t <= 112:
+        hi -= (13 - rh) / 4 * math.sqrt((17 - abs(t - 95)) / 17)
+    elif rh > 85 and 80 <= t <= 87:
+        hi += (rh - 85) / 10 * (87 - t) / 5
+    return hi
+
+# NWS wind chill, only defined at or below 50F with wind of at least 3 mph
+def wind_chill_f(temperature_f, wind_mph):
+    if temperature_f > 50 or wind_mph < 3:
+        return temperature_f
+    v = wind_mph ** 0.16
+    return 35.74 + 0.6215 * temperature_f - 35.75 * v + 0.4275 * temperature_f * v
+
+# Reduce station pressure (hPa) at altitude (m) to sea level
+def sea_level_pressure(pressure, altitude, temperature_f):
+    if not altitude:
+        return pressure
+    temperature_k = f_to_c(temperature_f) + 273.15
+    return pressure * (1 - 0.0065 * altitude / (temperature_k + 0.0065 * altitude)) ** -5.257
+
+# Air quality from gas resistance and humidity, 0 (bad) to 100 (good).
+# Clean air has the highest resistance, so the baseline is the average over
+# the burn-in period, raised whenever the air gets cleaner than that.
+# Humidity away from humidity_baseline counts against the score too.
+class GasBaseline:
+    def __init__(self, burn_in=300, humidity_baseline=40, humidity_weighting=0.25):
+        self.burn_in = burn_in
+        self.humidity_baseline = humidity_baseline
+        self.humidity_weighting = humidity_weighting
+        self.started = None
+        self.samples = collections.deque(maxlen=50)
+        self.baseline = None
+
+    def update(self, gas, humidity, t):
+        if self.baseline is None:
+            if self.started is None:
+                self.started = t
+            self.samples.append(gas)
+            if t - self.started < self.burn_in:
+                return None
+            self.baseline = sum(self.samples) / len(self.samples)
+            print("Gas baseline is %.0f ohms"% (self.baseline,))
+        elif gas > self.baseline:
+            self.baseline += 0.1 * (gas - self.baseline)
+
+        weight = self.humidity_weighting * 100
+        offset = humidity - self.humidity_baseline
+        if offset > 0:
+            humidity_score = (100 - self.humidity_baseline - offset) / (100 - self.humidity_baseline) * weight
+        else:
+            humidity_score = (self.humidity_baseline + offset) / self.humidity_baseline * weight
+        gas_score = min(gas / self.baseline, 1) * (100 - weight)
+        return max(0, humidity_score) + gas_score
+
+# What we last worked out for one station and sensor
+class Cached:
+    __slots__ = ('inputs', 'results', 'gas')
+
+    def __init__(self):
+        self.inputs = None
+        self.results = {}
+        self.gas = None
+
+class Deriver:
+    def __init__(self, altitude=0, altitudes=None, burn_in=300, humidity_baseline=40):
+        self.altitude = altitude
+        self.altitudes = altitudes or {}
+        self.burn_in = burn_in
+        self.humidity_baseline = humidity_baseline
+
+    # Work out what we can for a sample, given the stations.SensorState it
+    # was routed to and the wind speed (mph) if we know it.  Returns the
+    # sample with the derived values added.
+    def apply(self, state, data, wind_mph=None):
+        temperature = data.get('temperature_f')
+        humidity = data.get('humidity')
+        pressure = data.get('pressure')
+        gas = data.get('gas')
+
+        cached = state.derived
+        if cached is None:
+            cached = state.derived = Cached()
+
+        inputs = (temperature, humidity, pressure, wind_mph)
+        if inputs != cached.inputs:
+            results = {}
+            if temperature is not None and humidity is not None:
+                results['dewpoint_f'] = dewpoint_f(temperature, humidity)
+                results['heat_index_f'] = heat_index_f(temperature, humidity)
+            if temperature is not None and wind_mph is not None:
+                results['wind_chill_f'] = wind_chill_f(temperature, wind_mph)
+            if pressure is not None:
+                altitude = self.altitudes.get(state.station, self.altitude)
+                # Without a temperature, assume the standard atmosphere's 15C
+                results['sea_level_pressure'] = sea_level_pressure(
+                    pressure, altitude, temperature if temperature is not None else 59)
+            cached.inputs = inputs
+            cached.results = results
+
+        data = dict(data)
+        data.update(cached.results)
+
+        # The gas baseline moves with every reading, so it's never cached
+        if gas is not None and humidity is not None:
+            if cached.gas is None:
+                cached.gas = GasBaseline(self.burn_in, self.humidity_baseline)
+            t = data.get('ts')
+            if t is None:
+                t = time.time()
+            score = cached.gas.update(gas, humidity, t)
+            if score is not None:
+                data['iaq_score'] = score
+        return data
+
+# Derived values that can be worked out from archived columns, and the
+# columns they need
+SERIES = {
+    'dewpoint_f': (('temperature_f', 'humidity'), dewpoint_f),
+    'heat_index_f': (('temperature_f', 'humidity'), heat_index_f),
+}
+
+# Work out a SERIES value for every row of its input columns at once, NaN
+# where it can't be
+def series(name, *columns):
+    function = SERIES[name][1]
+    return array('d', [math.nan if value is None else value for value in map(function, *columns)])
+
+# altitudes is "station metres" per line
+def from_config(config):
+    altitudes = {}
+    for line in config.get('DERIVED', 'altitudes', fallback='').splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            altitudes[parts[0]] = float(parts[1])
+    return Deriver(
+        altitude=config.getfloat('DERIVED', 'altitude', fallback=0),
+        altitudes=altitudes,
+        burn_in=config.getfloat('DERIVED', 'gas_burn_in', fallback=300),
+        humidity_baseline=config.getfloat('DERIVED', 'humidity_baseline', fallback=40))
@@ -0,0 +1,90 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Keeps message handling off the awscrt event-loop thread.  The MQTT
+# callback only enqueues the raw payload; a small pool of worker threads
+# decodes and applies it.
+
+from prometheus_client import Counter, Gauge, Histogram
+import collections
+import threading
+import time
+
+ingest_queue_depth_gauge = Gauge('ingest_queue_depth', 'Messages waiting to be processed')
+ingest_dropped_counter = Counter('ingest_dropped', 'Messages dropped because the ingest queue was full')
+ingest_errors_counter = Counter('ingest_errors', 'Messages that raised an error while being processed')
+ingest_latency_histogram = Histogram('ingest_latency_seconds', 'Time from receiving a message to finishing processing it')
+ingest_processing_histogram = Histogram('ingest_processing_seconds', 'Time spent processing a message')
+
+DROP_OLDEST = 'drop-oldest'
+BLOCK = 'block'
+
+class IngestQueue:
+    def __init__(self, handler, maxsize=1000, workers=1, backpressure=DROP_OLDEST):
+        if backpressure not in (DROP_OLDEST, BLOCK):
+            raise ValueError("Unknown backpressure policy %s"% (backpressure,))
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.backpressure = backpressure
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.running = False
+
+    # Called from the connection's event-loop thread, so keep it cheap.
+    def submit(self, *args, **kwargs):
+        with self.condition:
+            while len(self.items) >= self.maxsize:
+                if self.backpressure == BLOCK:
+                    self.condition.wait()
+                else:
+                    self.items.popleft()
+                    ingest_dropped_counter.inc()
+            self.items.append((time.monotonic(), args, kwargs))
+            ingest_queue_depth_gauge.set(len(self.items))
+            self.condition.notify_all()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while self.running and not self.items:
+                    self.condition.wait()
+                if not self.items:
+                    return
+                received, args, kwargs = self.items.popleft()
+                ingest_queue_depth_gauge.set(len(self.items))
+                self.condition.notify_all()
+
+            started = time.monotonic()
+            try:
+                self.handler(*args, **kwargs)
+            except Exception as error:
+                ingest_errors_counter.inc()
+                print("Error processing message: %s"% (error,))
+            finished = time.monotonic()
+            ingest_processing_histogram.observe(finished - started)
+            ingest_latency_histogram.observe(finished - received)
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="ingest-%d"% (i,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Stop the workers once everything already queued has been processed.
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+def from_config(config, handler):
+    return IngestQueue(
+        handler,
+        maxsize=config.getint('SUBSCRIBER', 'queue_size', fallback=1000),
+        workers=config.getint('SUBSCRIBER', 'workers', fallback=1),
+        backpressure=config.get('SUBSCRIBER', 'backpressure', fallback=DROP_OLDEST))
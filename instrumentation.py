@@ -0,0 +1,102 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Timing for each stage of the publisher loop: reading the sensor,
+# serializing the payload and waiting for the broker to acknowledge it.
+# Served on an optional Prometheus port from [METRICS] in
+# weather-station.ini.
+#
+# There's also a sampling profiler that can be switched on and off while a
+# publisher is running with `kill -USR2 <pid>`.  When it's switched off the
+# samples are written out in collapsed-stack format, ready for flamegraph.pl
+# or speedscope.
+
+from prometheus_client import Counter, Histogram, start_http_server
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+sensor_read_histogram = Histogram('sensor_read_seconds', 'Time spent reading a sensor', ['sensor'])
+sensor_read_failures_counter = Counter('sensor_read_failures', 'Sensor reads that returned no data', ['sensor'])
+serialize_histogram = Histogram('publish_serialize_seconds', 'Time spent building a payload')
+publish_ack_histogram = Histogram('publish_ack_seconds', 'Time from publishing a message to the broker acknowledging it')
+publish_failures_counter = Counter('publish_failures', 'Publishes the broker did not acknowledge')
+publish_retries_counter = Counter('publish_retries', 'Queued messages published again after a failure or outage')
+
+# Read a sensor, timing it and counting reads that fail or come back empty
+def timed_read(sensor, read):
+    with sensor_read_histogram.labels(sensor).time():
+        try:
+            data = read()
+        except Exception:
+            sensor_read_failures_counter.labels(sensor).inc()
+            raise
+    if not data or all(value is None for value in data.values()):
+        sensor_read_failures_counter.labels(sensor).inc()
+    return data
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005, output_dir='.'):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.stacks = collections.Counter()
+        self.thread = None
+        self.running = False
+
+    def _sample(self):
+        me = threading.get_ident()
+        while self.running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s:%s"% (os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks.clear()
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self.thread.start()
+        print("Profiler started")
+
+    # Stop sampling and write the samples out, returning the file name
+    def stop(self):
+        if not self.running:
+            return None
+        self.running = False
+        self.thread.join()
+        path = os.path.join(self.output_dir, "profile-%d-%d.folded"% (os.getpid(), time.time()))
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write("%s %d\n"% (stack, count))
+        print("Profiler stopped, %d samples written to %s"% (sum(self.stacks.values()), path))
+        return path
+
+    def toggle(self, *args):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+profiler = SamplingProfiler()
+
+# Start the metrics endpoint and the profiler toggle for a publisher
+def start(config):
+    port = config.getint('METRICS', 'port', fallback=0)
+    if port:
+        start_http_server(port)
+        print("Serving metrics on port %d"% (port,))
+
+    profiler.interval = config.getfloat('METRICS', 'profile_interval', fallback=0.005)
+    profiler.output_dir = config.get('METRICS', 'profile_dir', fallback='.')
+    signal.signal(signal.SIGUSR2, profiler.toggle)
@@ -0,0 +1,326 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# The latest readings of every station and sensor, in a memory-mapped file
+# (under /dev/shm, so it never touches the disk) that any local process can
+# poll without asking the subscriber anything:
+#
+#   import latest
+#   reader = latest.LatestReader('/dev/shm/weather-station-latest')
+#   reader.get('home', 'outside', 'temperature_f')
+#
+# or from the shell:
+#
+#   python latest.py /dev/shm/weather-station-latest
+#
+# The layout is fixed, so a read is a few struct.unpack_from() calls on the
+# mapping and nothing is parsed:
+#
+#   header   magic, slots, fields, slot size, then fields names of 32 bytes
+#   slots    seq, generation, station, sensor, updated, then a double per
+#            field for its value and another for when it was received,
+#            NaN where there's nothing
+#
+# Each slot is guarded by a seqlock.  seq is odd while the subscriber is
+# writing the slot, so a reader takes seq, reads, and tries again if seq was
+# odd or has changed since.  generation changes whenever a slot is given to
+# a different station and sensor, so readers can cache where one lives.
+# Generations start from the clock, so they're never reused across
+# subscriber restarts either.
+#
+# A new subscriber with the same layout reuses the file in place and
+# clears each slot under its seqlock, so readers carry on.  If the layout
+# changed, a new file replaces the old one, since shrinking a file readers
+# have mapped would crash them; they need to be reopened to see it.
+
+from array import array
+import argparse
+import collections
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'WSLATST1'
+
+# magic, slots, fields, slot size, data offset
+HEADER = struct.Struct('<8sIIII')
+FIELD_NAME = struct.Struct('<32s')
+# seq, generation, station, sensor, updated
+SLOT_HEAD = struct.Struct('<QQ32s32sd')
+SEQ = struct.Struct('<Q')
+SEQ_GENERATION = struct.Struct('<QQ')
+DOUBLE = struct.Struct('<d')
+NAME_SIZE = 32
+
+# How many times a reader tries a slot the subscriber is busy writing.  A
+# write takes microseconds, so running out means the subscriber died
+# halfway through one.
+RETRIES = 100000
+
+def _align(size, to=64):
+    return (size + to - 1) // to * to
+
+def _name(value):
+    return value.encode('utf-8')[:NAME_SIZE]
+
+class LatestTable:
+    def __init__(self, path, fields, slots=1024):
+        self.path = path
+        self.fields = list(fields)
+        self.slots = slots
+        self.index = {field: i for i, field in enumerate(self.fields)}
+        self.body = struct.Struct('<%dd'% (2 * len(self.fields),))
+        self.slot_size = _align(SLOT_HEAD.size + self.body.size)
+        self.data_offset = _align(HEADER.size + FIELD_NAME.size * len(self.fields))
+        size = self.data_offset + self.slot_size * slots
+
+        self._map = self._open_existing(size)
+        if self._map is not None:
+            # Clear out whatever the last subscriber left
+            empty = [math.nan] * (2 * len(self.fields))
+            for slot in range(slots):
+                self._write(slot, 0, b'', b'', 0, empty)
+        else:
+            self._map = self._create(size)
+
+        # Slot by (station, sensor), least recently updated first
+        self.used = collections.OrderedDict()
+        self.free = list(range(slots - 1, -1, -1))
+        self.generation = time.time_ns()
+        self.lock = threading.Lock()
+
+    # The existing table at path, if it has the layout we want
+    def _open_existing(self, size):
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            return None
+        try:
+            if os.fstat(fd).st_size != size:
+                return None
+            table = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        fields = [FIELD_NAME.unpack_from(table, HEADER.size + FIELD_NAME.size * i)[0].rstrip(b'\0')
+                  for i in range(len(self.fields))]
+        if (HEADER.unpack_from(table, 0) != (MAGIC, self.slots, len(self.fields), self.slot_size, self.data_offset)
+                or fields != [_name(field) for field in self.fields]):
+            table.close()
+            return None
+        return table
+
+    # A new, empty table, swapped in for any old one
+    def _create(self, size):
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            table = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        for i, field in enumerate(self.fields):
+            FIELD_NAME.pack_into(table, HEADER.size + FIELD_NAME.size * i, _name(field))
+        HEADER.pack_into(table, 0, MAGIC, self.slots, len(self.fields), self.slot_size, self.data_offset)
+        os.replace(tmp, self.path)
+        return table
+
+    def _offset(self, slot):
+        return self.data_offset + self.slot_size * slot
+
+    def _write(self, slot, generation, station, sensor, updated, body):
+        offset = self._offset(slot)
+        seq, = SEQ.unpack_from(self._map, offset)
+        SEQ.pack_into(self._map, offset, seq + 1)
+        SLOT_HEAD.pack_into(self._map, offset, seq + 1, generation, station, sensor, updated)
+        self.body.pack_into(self._map, offset + SLOT_HEAD.size, *body)
+        SEQ.pack_into(self._map, offset, seq + 2)
+
+    # Write a stations.Snapshot into its slot
+    def update(self, snapshot):
+        body = array('d', [math.nan]) * (2 * len(self.fields))
+        count = len(self.fields)
+        for field, value in snapshot.values.items():
+            i = self.index.get(field)
+            if i is not None and isinstance(value, (int, float)):
+                body[i] = value
+                body[count + i] = snapshot.received[field]
+
+        key = (snapshot.station, snapshot.sensor)
+        with self.lock:
+            entry = self.used.get(key)
+            if entry is None:
+                if self.free:
+                    slot = self.free.pop()
+                else:
+                    # Full, so the quietest sensor gives up its slot
+                    old, (slot, generation) = self.used.popitem(last=False)
+                    print("Latest table is full, dropping %s/%s"% old)
+                self.generation += 1
+                entry = self.used[key] = (slot, self.generation)
+            else:
+                self.used.move_to_end(key)
+            slot, generation = entry
+            self._write(slot, generation, _name(snapshot.station), _name(snapshot.sensor), snapshot.updated, body)
+
+    def remove(self, station, sensor):
+        with self.lock:
+            entry = self.used.pop((station, sensor), None)
+            if entry is not None:
+                self._write(entry[0], 0, b'', b'', 0, [math.nan] * (2 * len(self.fields)))
+                self.free.append(entry[0])
+
+    # Clear out sensors that haven't been updated in stale_after seconds
+    def evict_stale(self, stale_after, now=None):
+        if now is None:
+            now = time.time()
+        offset = SLOT_HEAD.size - DOUBLE.size
+        with self.lock:
+            stale = []
+            for key, (slot, generation) in self.used.items():
+                updated, = DOUBLE.unpack_from(self._map, self._offset(slot) + offset)
+                if now - updated < stale_after:
+                    break
+                stale.append(key)
+        for station, sensor in stale:
+            self.remove(station, sensor)
+
+    def close(self):
+        with self.lock:
+            self._map.close()
+
+# Returns None when no path is configured.  Each of several subscriber
+# workers on a host gets its own table, with its index added to the path.
+def from_config(config, fields, worker=0, workers=1):
+    path = config.get('LATEST', 'path', fallback=None)
+    if not path:
+        return None
+    if workers > 1:
+        path = "%s.%d"% (path, worker)
+    return LatestTable(path, fields, slots=config.getint('LATEST', 'slots', fallback=1024))
+
+class LatestReader:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots, count, self.slot_size, self.data_offset = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s isn't a latest conditions table"% (path,))
+        self.fields = [
+            FIELD_NAME.unpack_from(self._map, HEADER.size + FIELD_NAME.size * i)[0].rstrip(b'\0').decode('utf-8')
+            for i in range(count)]
+        self.field_offsets = {field: SLOT_HEAD.size + DOUBLE.size * i for i, field in enumerate(self.fields)}
+        self.body = struct.Struct('<%dd'% (2 * count,))
+        # (slot, generation) by (station, sensor), checked on every read
+        self.cache = {}
+
+    def _offset(self, slot):
+        return self.data_offset + self.slot_size * slot
+
+    # A consistent copy of a slot's head and body
+    def _read_slot(self, slot):
+        offset = self._offset(slot)
+        for attempt in range(RETRIES):
+            seq, = SEQ.unpack_from(self._map, offset)
+            if seq & 1:
+                continue
+            head = SLOT_HEAD.unpack_from(self._map, offset)
+            body = self.body.unpack_from(self._map, offset + SLOT_HEAD.size)
+            if SEQ.unpack_from(self._map, offset)[0] == seq:
+                return head, body
+        raise RuntimeError("Slot %d of %s is stuck mid-write"% (slot, self.path))
+
+    def _find(self, station, sensor):
+        key = (_name(station), _name(sensor))
+        for slot in range(self.slots):
+            (seq, generation, slot_station, slot_sensor, updated), body = self._read_slot(slot)
+            if generation and (slot_station.rstrip(b'\0'), slot_sensor.rstrip(b'\0')) == key:
+                self.cache[(station, sensor)] = (slot, generation)
+                return slot, generation
+        return None, None
+
+    # The latest value of one field, or None
+    def get(self, station, sensor, field):
+        field_offset = self.field_offsets.get(field)
+        if field_offset is None:
+            return None
+        slot, generation = self.cache.get((station, sensor), (None, None))
+        for attempt in range(2):
+            if slot is None:
+                slot, generation = self._find(station, sensor)
+                if slot is None:
+                    return None
+            offset = self._offset(slot)
+            for retry in range(RETRIES):
+                seq, slot_generation = SEQ_GENERATION.unpack_from(self._map, offset)
+                if seq & 1:
+                    continue
+                value, = DOUBLE.unpack_from(self._map, offset + field_offset)
+                if SEQ.unpack_from(self._map, offset)[0] == seq:
+                    break
+            else:
+                raise RuntimeError("Slot %d of %s is stuck mid-write"% (slot, self.path))
+            if slot_generation == generation:
+                return None if math.isnan(value) else value
+            # The slot went to another sensor, look again
+            slot = None
+        return None
+
+    def _entry(self, head, body):
+        seq, generation, station, sensor, updated = head
+        count = len(self.fields)
+        return {
+            'station': station.rstrip(b'\0').decode('utf-8'),
+            'sensor': sensor.rstrip(b'\0').decode('utf-8'),
+            'updated': updated,
+            'values': {field: body[i] for i, field in enumerate(self.fields) if not math.isnan(body[i])},
+            'received': {field: body[count + i] for i, field in enumerate(self.fields) if not math.isnan(body[i])},
+        }
+
+    # Everything about one station and sensor, or None
+    def read(self, station, sensor):
+        slot, generation = self.cache.get((station, sensor), (None, None))
+        if slot is not None:
+            head, body = self._read_slot(slot)
+            if head[1] == generation:
+                return self._entry(head, body)
+        slot, generation = self._find(station, sensor)
+        if slot is None:
+            return None
+        return self._entry(*self._read_slot(slot))
+
+    # Everything in the table
+    def all(self):
+        entries = []
+        for slot in range(self.slots):
+            head, body = self._read_slot(slot)
+            if head[1]:
+                entries.append(self._entry(head, body))
+        return entries
+
+    def close(self):
+        self._map.close()
+
+def main():
+    import configparser
+    config = configparser.ConfigParser()
+    config.read('weather-station.ini')
+
+    parser = argparse.ArgumentParser(description="Show the latest readings the subscriber has")
+    parser.add_argument('paths', nargs='*', default=[config.get('LATEST', 'path', fallback=None) or '/dev/shm/weather-station-latest'],
+                        help="tables to read, one per subscriber worker")
+    args = parser.parse_args()
+
+    now = time.time()
+    for path in args.paths:
+        reader = LatestReader(path)
+        for entry in sorted(reader.all(), key=lambda entry: (entry['station'], entry['sensor'])):
+            values = ", ".join("%s %.2f"% item for item in sorted(entry['values'].items()))
+            print("%s/%s (%.0f s ago): %s"% (entry['station'], entry['sensor'], now - entry['updated'], values))
+        reader.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Latest observations from a nearby National Weather Service station, used
+# to fill in readings we don't measure ourselves.  Let's not kill the NWS:
+#
+#  - observations are cached for ttl seconds, and the cache is kept on disk
+#    so a restart doesn't mean a fresh request
+#  - refreshes are conditional GETs (ETag / Last-Modified), so an unchanged
+#    observation costs a 304 and no body
+#  - once the cache is stale we keep serving it while a background thread
+#    revalidates it, up to max_stale seconds old, and never wait on a request
+#  - requests go over one pooled keep-alive session with timeouts
+#  - after a failed request we back off exponentially, from retry_delay up
+#    to max_backoff seconds, before asking again
+
+from requests.adapters import HTTPAdapter
+import json
+import os
+import requests
+import threading
+import time
+
+OBSERVATION_URL = "https://api.weather.gov/stations/%s/observations/latest"
+
+def _value(properties, name):
+    return (properties.get(name) or {}).get('value')
+
+# Pull the fields we use out of an observation, skipping any NWS left empty
+def parse_observation(observation):
+    properties = observation.get('properties', {})
+    data = {}
+    dewpoint = _value(properties, 'dewpoint')
+    if dewpoint is not None:
+        data['dewpoint'] = dewpoint
+    pressure = _value(properties, 'barometricPressure')
+    if pressure is not None:
+        data['pressure'] = pressure / 100
+    wind_speed = _value(properties, 'windSpeed')
+    if wind_speed is not None:
+        data['windSpeed'] = wind_speed
+    wind_direction = _value(properties, 'windDirection')
+    if wind_direction is not None:
+        data['windDirection'] = wind_direction
+    wind_gust = _value(properties, 'windGust')
+    if wind_gust is not None:
+        data['windGust'] = wind_gust
+    return data
+
+class NWSClient:
+    def __init__(self, station_id, require_qc=False, ttl=600, max_stale=3600, cache_path='nws-cache.json',
+                 connect_timeout=3.05, read_timeout=10, user_agent='weather-station', retry_delay=60, max_backoff=1800):
+        self.url = OBSERVATION_URL % (station_id,)
+        self.params = {"require_qc": "true" if require_qc else "false"}
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.cache_path = cache_path
+        self.timeout = (connect_timeout, read_timeout)
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        # Failed requests in a row, and when we're allowed to try again
+        self.failures = 0
+        self.retry_at = 0
+
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        # api.weather.gov asks every client to identify itself
+        self.session.headers.update({"User-Agent": user_agent, "Accept": "application/geo+json"})
+
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.cache = self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            if cache.get('url') == self.url:
+                print("Loaded NWS observation cache from %s"% (self.cache_path,))
+                return cache
+        except (OSError, ValueError):
+            pass
+        return {"url": self.url, "fetched": 0, "etag": None, "last_modified": None, "data": {}}
+
+    def _save(self):
+        # Write then rename, so a crash never leaves half a cache behind
+        tmp = self.cache_path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.cache, f)
+        os.replace(tmp, self.cache_path)
+
+    # Fetch the latest observation if it has changed since we last saw it
+    def refresh(self):
+        headers = {}
+        if self.cache['etag']:
+            headers['If-None-Match'] = self.cache['etag']
+        if self.cache['last_modified']:
+            headers['If-Modified-Since'] = self.cache['last_modified']
+
+        try:
+            r = self.session.get(self.url, params=self.params, headers=headers, timeout=self.timeout)
+            if r.status_code == 200:
+                observation = parse_observation(r.json())
+        except (requests.RequestException, ValueError) as error:
+            print("Unable to get weather data from NWS: %s"% (error,))
+            return self._failed()
+
+        with self.lock:
+            if r.status_code == 304:
+                self.cache['fetched'] = time.time()
+            elif r.status_code == 200:
+                self.cache = {
+                    "url": self.url,
+                    "fetched": time.time(),
+                    "etag": r.headers.get('ETag'),
+                    "last_modified": r.headers.get('Last-Modified'),
+                    "data": observation,
+                }
+            else:
+                print("Unable to get weather data from NWS %d"% (r.status_code,))
+                return self._failed()
+            self.failures = 0
+            self._save()
+        return True
+
+    # Put off the next request, longer the more requests in a row have failed
+    def _failed(self):
+        delay = min(self.max_backoff, self.retry_delay * 2 ** self.failures)
+        self.failures += 1
+        self.retry_at = time.time() + delay
+        print("Asking NWS again in %d seconds"% (delay,))
+        return False
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            self.refreshing = False
+
+    # Return the cached NWS fields, refreshing them if they've expired
+    def get(self):
+        now = time.time()
+        age = now - self.cache['fetched']
+        if age < self.ttl:
+            return self.cache['data']
+
+        # Revalidate in the background, unless we're backing off after a
+        # failure.  Callers are upload threads, so they never wait on NWS.
+        if now >= self.retry_at:
+            with self.lock:
+                if not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+        # Serve what we have meanwhile, if it isn't too old to use
+        if age >= self.max_stale:
+            return {}
+        return self.cache['data']
+
+    # Whatever we have cached, without ever going to the network
+    def latest(self):
+        return self.cache['data']
+
+    def close(self):
+        self.session.close()
+
+# Returns None when no NWS station is configured
+def from_config(config):
+    station_id = config.get('NWS', 'station_id', fallback=None)
+    if not station_id:
+        return None
+    return NWSClient(
+        station_id,
+        require_qc=config.getboolean('NWS', 'require_qc', fallback=False),
+        ttl=config.getfloat('NWS', 'ttl', fallback=600),
+        max_stale=config.getfloat('NWS', 'max_stale', fallback=3600),
+        cache_path=config.get('NWS', 'cache_path', fallback='nws-cache.json'),
+        user_agent=config.get('NWS', 'user_agent', fallback='weather-station'),
+        retry_delay=config.getfloat('NWS', 'retry_delay', fallback=60),
+        max_backoff=config.getfloat('NWS', 'max_backoff', fallback=1800))
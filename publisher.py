@@ -5,28 +5,26 @@
 
 import configparser
 from awscrt import mqtt, http
-from awsiot import mqtt_connection_builder
 import sys
 import time
-import board
-import adafruit_dht
-import json
-import smbus2
-import bme280
+import wal
+import batching
+import deadband
+import instrumentation
+import signal
+import sensors
+import transport
 
 config = configparser.ConfigParser()
 config.read('weather-station.ini')
 
-endpoint=config['AWS']['endpoint']
-cert_filepath=config['AWS']['cert_filepath']
-pri_key_filepath=config['AWS']['pri_key_filepath']
-ca_filepath=config['AWS']['ca_filepath']
 clientId=config['AWS']['clientId']
 message_topic=config['AWS']['message_topic']
 
 # Callback when connection is accidentally lost.
 def on_connection_interrupted(connection, error, **kwargs):
     print("Connection interrupted. error: {}".format(error))
+    store.connection_interrupted()
 
 # Callback when an interrupted connection is re-established.
 def on_connection_resumed(connection, return_code, session_present, **kwargs):
@@ -39,6 +37,10 @@ def on_connection_resumed(connection, return_code, session_present, **kwargs):
         # Cannot synchronously wait for resubscribe result because we're on the connection's event-loop thread,
         # evaluate result with a callback instead.
         resubscribe_future.add_done_callback(on_resubscribe_complete)
+
+    if return_code == mqtt.ConnectReturnCode.ACCEPTED:
+        # Replay anything that was queued on disk while we were offline
+        store.connection_resumed()
     
 
 def on_resubscribe_complete(resubscribe_future):
@@ -64,88 +66,87 @@ def on_connection_failure(connection, callback_data):
 def on_connection_closed(connection, callback_data):
     print("Connection closed")
 
-dhtDevice = adafruit_dht.DHT22(board.D4)
+dht22 = sensors.DHT22Sensor(
+    config.get('DEVICES', 'dht_pin', fallback='D4'),
+    samples=config.getint('DEVICES', 'dht_samples', fallback=3),
+    budget=config.getfloat('DEVICES', 'dht_budget', fallback=4),
+    history=config.getint('DEVICES', 'dht_history', fallback=10))
 
 def get_temperature_and_humidity():
-    data = {
-        "temperature_f":  None,
-        "humidity":  None
-    }
-
-    try:
-        # Print the values to the serial port
-        temperature_c = dhtDevice.temperature
-        temperature_f = temperature_c * (9 / 5) + 32
-        humidity = dhtDevice.humidity
-        print(
-            "Temp: {:.1f} F / {:.1f} C    Humidity: {}% ".format(
-                temperature_f, temperature_c, humidity
-            )
-        )
-        data['temperature_f'] = temperature_f
-        data['humidity'] = humidity
-        return data
-
-    except RuntimeError as error:
-        # Errors happen fairly often, DHT's are hard to read, just keep going
-        print(error.args[0])
-        return data
-    except Exception as error:
-        dhtDevice.exit()
-        raise error
+    return instrumentation.timed_read('dht22', dht22.read)
 
 # BME280 sensor address (default address)
 address = config['DEVICES']['address']
 if address != "None":
-    bus = smbus2.SMBus(1)
-    calibration_params = bme280.load_calibration_params(bus, address)
+    bme280_sensor = sensors.BME280Sensor.from_config(config['DEVICES'])
 
-def celsius_to_fahrenheit(celsius):
-    return (celsius * 9/5) + 32
-
-def get_pressure():
-    data = bme280.sample(bus, address, calibration_params)
-    return data.pressure
+# Pressure, and whatever else bme280_fields asks for, from one measurement
+def get_bme280_data():
+    return instrumentation.timed_read('bme280', bme280_sensor.read)
 
 if __name__ == '__main__':
-    # Create a MQTT connection from the command line data
-    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-        endpoint=endpoint,
-        cert_filepath=cert_filepath,
-        pri_key_filepath=pri_key_filepath,
-        ca_filepath=ca_filepath,
+    # Connect to AWS IoT, the local broker, or both ([LOCAL] transport)
+    mqtt_connection = transport.from_config(
+        config,
+        clientId,
         on_connection_interrupted=on_connection_interrupted,
         on_connection_resumed=on_connection_resumed,
-        client_id=clientId,
-        clean_session=False,
-        keep_alive_secs=30,
         on_connection_success=on_connection_success,
         on_connection_failure=on_connection_failure,
         on_connection_closed=on_connection_closed)
 
+    # Every reading goes through the on-disk queue so nothing is lost during an outage
+    store = wal.from_config(config, mqtt_connection, message_topic, "%s.wal"% (clientId,))
+
     connect_future = mqtt_connection.connect()
 
     # Future.result() waits until a result is available
     connect_future.result()
     print("Connected!")
+    store.connection_resumed()
+
+    # Metrics endpoint and profiler toggle
+    instrumentation.start(config)
 
-    while True:
-        data = get_temperature_and_humidity()
-        if address != "None":
-            data['pressure'] = get_pressure()
-        message = json.dumps(data)
-        if data['temperature_f'] is not None:
-            print("Publishing message to topic '{}': {}".format(message_topic, message))
-            mqtt_connection.publish(
-                topic=message_topic,
-                payload=message,
-                qos=mqtt.QoS.AT_LEAST_ONCE)
-        else:
-            print("Failed to retrieve data from sensors")
-        time.sleep(5)
-
-    # Disconnect
-    print("Disconnecting...")
-    disconnect_future = mqtt_connection.disconnect()
-    disconnect_future.result()
-    print("Disconnected!")
+    batcher = batching.from_config(config)
+
+    # Only publish readings that have moved, sampling faster while they move quickly
+    changes = deadband.from_config(config, 5, dht22.min_interval)
+
+    # Stop cleanly on SIGTERM so a partial batch is flushed to the queue
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    next_cycle = time.monotonic()
+
+    try:
+        while True:
+            data = get_temperature_and_humidity()
+            if address != "None":
+                data.update(get_bme280_data())
+            if data['temperature_f'] is None:
+                print("Failed to retrieve data from sensors")
+                message = batcher.poll()
+            elif changes.check(data):
+                with instrumentation.serialize_histogram.time():
+                    message = batcher.add(data)
+            else:
+                message = batcher.poll()
+            if message is not None:
+                print("Publishing message to topic '{}': {}".format(message_topic, message))
+                store.publish(message)
+
+            # Keep a steady cadence however long the DHT22 sampling took
+            next_cycle = max(next_cycle + changes.next_interval(), time.monotonic())
+            time.sleep(max(0, next_cycle - time.monotonic()))
+    finally:
+        # Don't lose a partially filled batch on shutdown
+        message = batcher.flush()
+        if message is not None:
+            store.publish(message)
+
+        # Disconnect
+        print("Disconnecting...")
+        disconnect_future = mqtt_connection.disconnect()
+        disconnect_future.result()
+        print("Disconnected!")
+        store.wal.close()
@@ -0,0 +1,209 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# Based on AWS IOT SDK samples:
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0.
+
+# Runs every sensor configured in weather-station.ini from one process over
+# one MQTT connection.  Each [SENSOR:<name>] section is read on its own
+# schedule, on its own thread, so a slow sensor never delays another one.
+
+import asyncio
+import concurrent.futures
+import configparser
+from awscrt import mqtt, http
+import math
+import signal
+import sys
+import batching
+import deadband
+import functools
+import instrumentation
+import sensors
+import wal
+import transport
+
+config = configparser.ConfigParser()
+config.read('weather-station.ini')
+
+clientId=config['AWS']['clientId']
+message_topic=config['AWS']['message_topic']
+
+# Callback when connection is accidentally lost.
+def on_connection_interrupted(connection, error, **kwargs):
+    print("Connection interrupted. error: {}".format(error))
+    store.connection_interrupted()
+
+# Callback when an interrupted connection is re-established.
+def on_connection_resumed(connection, return_code, session_present, **kwargs):
+    print("Connection resumed. return_code: {} session_present: {}".format(return_code, session_present))
+
+    if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
+        print("Session did not persist. Resubscribing to existing topics...")
+        resubscribe_future, _ = connection.resubscribe_existing_topics()
+
+        # Cannot synchronously wait for resubscribe result because we're on the connection's event-loop thread,
+        # evaluate result with a callback instead.
+        resubscribe_future.add_done_callback(on_resubscribe_complete)
+
+    if return_code == mqtt.ConnectReturnCode.ACCEPTED:
+        # Replay anything that was queued on disk while we were offline
+        store.connection_resumed()
+
+def on_resubscribe_complete(resubscribe_future):
+    resubscribe_results = resubscribe_future.result()
+    print("Resubscribe results: {}".format(resubscribe_results))
+
+    for topic, qos in resubscribe_results['topics']:
+        if qos is None:
+            sys.exit("Server rejected resubscribe to topic: {}".format(topic))
+
+# Callback when the connection successfully connects
+def on_connection_success(connection, callback_data):
+    assert isinstance(callback_data, mqtt.OnConnectionSuccessData)
+    print("Connection Successful with return code: {} session present: {}".format(callback_data.return_code, callback_data.session_present))
+
+# Callback when a connection attempt fails
+def on_connection_failure(connection, callback_data):
+    assert isinstance(callback_data, mqtt.OnConnectionFailureData)
+    print("Connection failed with error code: {}".format(callback_data.error))
+
+# Callback when a connection has been disconnected or shutdown successfully
+def on_connection_closed(connection, callback_data):
+    print("Connection closed")
+
+# One [SENSOR:<name>] section. Its drivers are read together and their
+# readings merged into one message tagged with the section name.
+class SensorJob:
+    def __init__(self, name, drivers, interval):
+        self.name = name
+        self.drivers = drivers
+        min_interval = max([0] + [driver.min_interval for driver in drivers])
+        self.interval = max(interval, min_interval)
+        # Only publish readings that have moved, sampling faster while they move quickly
+        self.changes = deadband.from_config(config, self.interval, min_interval)
+        # A thread per driver, so a hung read only holds up its own sensor
+        self.executors = [
+            concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="%s-%d"% (name, i))
+            for i in range(len(drivers))]
+
+    async def read(self):
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *[loop.run_in_executor(executor, functools.partial(instrumentation.timed_read, "%s/%s"% (self.name, driver.name), driver.read))
+              for driver, executor in zip(self.drivers, self.executors)],
+            return_exceptions=True)
+
+        data = {}
+        for driver, result in zip(self.drivers, results):
+            if isinstance(result, Exception):
+                print("Error reading %s on %s: %s"% (driver.name, self.name, result))
+            else:
+                data.update(result)
+        data['device'] = self.name
+        return data
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False)
+        for driver in self.drivers:
+            driver.close()
+
+def load_jobs(config):
+    jobs = []
+    for name in config.sections():
+        if name.startswith('SENSOR:'):
+            section = config[name]
+            jobs.append(SensorJob(name[len('SENSOR:'):], sensors.from_config(section), section.getfloat('interval', 5)))
+    return jobs
+
+def publish(message):
+    if message is not None:
+        print("Publishing message to topic '{}': {}".format(message_topic, message))
+        store.publish(message)
+
+async def run_job(job, batcher):
+    loop = asyncio.get_running_loop()
+    # Line every sensor up on multiples of its interval on the monotonic clock,
+    # so sampling doesn't drift by however long each read took.
+    next_read = math.ceil(loop.time() / job.interval) * job.interval
+    await asyncio.sleep(next_read - loop.time())
+
+    while True:
+        data = await job.read()
+        if data.get('temperature_f') is None:
+            print("Failed to retrieve data from %s"% (job.name,))
+        elif job.changes.check(data):
+            with instrumentation.serialize_histogram.time():
+                message = batcher.add(data)
+            publish(message)
+
+        # Skip any ticks we overran rather than reading back to back
+        interval = job.changes.next_interval()
+        next_read += interval
+        if next_read < loop.time():
+            next_read += math.ceil((loop.time() - next_read) / interval) * interval
+        await asyncio.sleep(next_read - loop.time())
+
+async def flush_batches(batcher):
+    while True:
+        await asyncio.sleep(1)
+        publish(batcher.poll())
+
+async def run(jobs, batcher):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    tasks = [asyncio.create_task(run_job(job, batcher)) for job in jobs]
+    tasks.append(asyncio.create_task(flush_batches(batcher)))
+    await stop.wait()
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+if __name__ == '__main__':
+    jobs = load_jobs(config)
+    if not jobs:
+        sys.exit("No [SENSOR:<name>] sections in weather-station.ini")
+
+    # Connect to AWS IoT, the local broker, or both ([LOCAL] transport)
+    mqtt_connection = transport.from_config(
+        config,
+        clientId,
+        on_connection_interrupted=on_connection_interrupted,
+        on_connection_resumed=on_connection_resumed,
+        on_connection_success=on_connection_success,
+        on_connection_failure=on_connection_failure,
+        on_connection_closed=on_connection_closed)
+
+    # Every reading goes through the on-disk queue so nothing is lost during an outage
+    store = wal.from_config(config, mqtt_connection, message_topic, "%s.wal"% (clientId,))
+
+    connect_future = mqtt_connection.connect()
+
+    # Future.result() waits until a result is available
+    connect_future.result()
+    print("Connected!")
+    store.connection_resumed()
+
+    # Metrics endpoint and profiler toggle
+    instrumentation.start(config)
+
+    batcher = batching.from_config(config)
+
+    try:
+        asyncio.run(run(jobs, batcher))
+    finally:
+        # Don't lose a partially filled batch on shutdown
+        publish(batcher.flush())
+        for job in jobs:
+            job.close()
+
+    # Disconnect
+    print("Disconnecting...")
+    disconnect_future = mqtt_connection.disconnect()
+    disconnect_future.result()
+    print("Disconnected!")
+    store.wal.close()
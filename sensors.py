@@ -0,0 +1,333 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Drivers for the sensors the publishers read.  Each driver has a blocking
+# read() that returns a dict of readings, and a min_interval the sensor
+# needs between reads.  Hardware libraries are only imported when a driver
+# is created, so a process only needs the libraries for its own sensors.
+#
+# The Bosch sensors are read in bursts: one forced-mode conversion per
+# read(), with every field taken from that one measurement, so the fields
+# always belong together and the BME680 heater only runs once per cycle.
+
+import collections
+import derived
+import json
+import math
+import requests
+import time
+from requests.adapters import HTTPAdapter
+
+def celsius_to_fahrenheit(celsius):
+    return (celsius * 9/5) + 32
+
+# Median of a list of numbers
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+# Hampel filter: is value further from the median of window than n_sigmas
+# scaled median absolute deviations?  min_deviation stops a run of identical
+# readings (MAD of 0) from rejecting every change.
+def is_outlier(value, window, n_sigmas=3, min_deviation=0):
+    if len(window) < 3:
+        return False
+    center = median(window)
+    mad = median([abs(v - center) for v in window])
+    return abs(value - center) > max(n_sigmas * 1.4826 * mad, min_deviation)
+
+class DHT22Sensor:
+    name = 'dht22'
+    # The DHT22 can't be read more often than every 2 seconds
+    min_interval = 2
+
+    # Smallest jumps the outlier filter will ever reject, in C and %RH
+    MIN_DEVIATION = {'temperature_c': 1.0, 'humidity': 5.0}
+
+    # Take up to samples reads, spaced min_interval apart, within budget
+    # seconds, and publish the median of the ones that pass the outlier
+    # filter. history is how many recent good readings the filter compares
+    # against.
+    def __init__(self, pin='D4', samples=3, budget=4, history=10):
+        import board
+        import adafruit_dht
+        self.device = adafruit_dht.DHT22(getattr(board, pin))
+        self.samples = samples
+        self.budget = budget
+        self.recent = {
+            'temperature_c': collections.deque(maxlen=history),
+            'humidity': collections.deque(maxlen=history),
+        }
+        self.last_read = -self.min_interval
+
+    def _read_once(self):
+        wait = self.last_read + self.min_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            return {
+                'temperature_c': self.device.temperature,
+                'humidity': self.device.humidity,
+            }
+        finally:
+            self.last_read = time.monotonic()
+
+    def read(self):
+        data = {
+            "temperature_f":  None,
+            "humidity":  None
+        }
+
+        deadline = time.monotonic() + self.budget
+        readings = []
+        attempts = 0
+        while len(readings) < self.samples:
+            # Always try at least once, then only if the next read fits the budget
+            next_read = max(time.monotonic(), self.last_read + self.min_interval)
+            if attempts and next_read > deadline:
+                break
+            attempts += 1
+            try:
+                reading = self._read_once()
+            except RuntimeError as error:
+                # Errors happen fairly often, DHT's are hard to read, just keep going
+                print(error.args[0])
+                continue
+            except Exception as error:
+                self.device.exit()
+                raise error
+            if reading['temperature_c'] is not None and reading['humidity'] is not None:
+                readings.append(reading)
+
+        estimate = {}
+        accepted = 0
+        for field, recent in self.recent.items():
+            values = [r[field] for r in readings]
+            good = [v for v in values if not is_outlier(v, recent, min_deviation=self.MIN_DEVIATION[field])]
+            # Everything goes into the window, so a real step change is
+            # accepted once it persists
+            recent.extend(values)
+            if good:
+                estimate[field] = median(good)
+                accepted += len(good)
+
+        if len(estimate) < 2:
+            return data
+
+        temperature_c = estimate['temperature_c']
+        temperature_f = celsius_to_fahrenheit(temperature_c)
+        humidity = estimate['humidity']
+        print(
+            "Temp: {:.1f} F / {:.1f} C    Humidity: {}%    ({} of {} reads)".format(
+                temperature_f, temperature_c, humidity, len(readings), attempts
+            )
+        )
+        data['temperature_f'] = temperature_f
+        data['humidity'] = humidity
+        # Fraction of attempted reads that made it into the estimate
+        data['quality'] = round(accepted / (2 * attempts), 2)
+        return data
+
+    def close(self):
+        self.device.exit()
+
+    @classmethod
+    def from_config(cls, section):
+        return cls(
+            pin=section.get('pin', 'D4'),
+            samples=section.getint('samples', 3),
+            budget=section.getfloat('budget', 4),
+            history=section.getint('history', 10))
+
+# Oversampling settings the Bosch sensors take
+OVERSAMPLING = (0, 1, 2, 4, 8, 16)
+
+def check_oversampling(name, value):
+    if value not in OVERSAMPLING:
+        raise ValueError("%s must be one of %s, not %s"% (name, ", ".join(map(str, OVERSAMPLING)), value))
+    return value
+
+class BME280Sensor:
+    name = 'bme280'
+    min_interval = 1
+
+    # Everything a sample measures.  By default only pressure is published,
+    # since the DHT22 next to it does temperature and humidity; add the
+    # others to fields to publish them too.
+    FIELDS = ('pressure', 'temperature_f', 'humidity')
+
+    def __init__(self, address=0x77, bus=1, oversampling=1, fields=('pressure',)):
+        import smbus2
+        import bme280
+        self.bme280 = bme280
+        self.address = address
+        self.bus = smbus2.SMBus(bus)
+        self.calibration_params = bme280.load_calibration_params(self.bus, address)
+        check_oversampling('oversampling', oversampling)
+        # The library's oversampling.x1 .. x16
+        self.sampling = getattr(bme280.oversampling, 'x%d'% (max(oversampling, 1),))
+        for field in fields:
+            if field not in self.FIELDS:
+                raise ValueError("BME280 can't read %s, only %s"% (field, ", ".join(self.FIELDS)))
+        self.fields = tuple(fields)
+
+    # One forced measurement of all three
+    def read(self):
+        sample = self.bme280.sample(self.bus, self.address, self.calibration_params, self.sampling)
+        data = {
+            "pressure": sample.pressure,
+            "temperature_f": celsius_to_fahrenheit(sample.temperature),
+            "humidity": sample.humidity,
+        }
+        return {field: data[field] for field in self.fields}
+
+    def close(self):
+        self.bus.close()
+
+    @classmethod
+    def from_config(cls, section):
+        fields = [field.strip() for field in section.get('bme280_fields', 'pressure').split(',') if field.strip()]
+        return cls(
+            address=int(section.get('address', '0x77'), 0),
+            bus=section.getint('bus', 1),
+            oversampling=section.getint('bme280_oversampling', 1),
+            fields=fields)
+
+class BME680Sensor:
+    name = 'bme680'
+    # The gas heater needs time between measurements
+    min_interval = 3
+
+    # IIR filter sizes the BME680 takes
+    FILTER_SIZES = (0, 1, 3, 7, 15, 31, 63, 127)
+
+    # temperature_offset corrects for the sensor heating itself up (and the
+    # board it's on), which read about 5C high on the original station.
+    # sea_level_pressure only affects the altitude the library works out;
+    # the subscriber does the sea level correction for pressure.
+    # The heater is held at heater_temperature (C) for heater_duration (ms)
+    # for each gas measurement.  Lower oversampling and a shorter heater
+    # time make each read quicker, at the cost of noise.
+    def __init__(self, sea_level_pressure=derived.STANDARD_PRESSURE, temperature_offset=-5,
+                 temperature_oversample=8, humidity_oversample=2, pressure_oversample=4, filter_size=3,
+                 heater_temperature=320, heater_duration=150):
+        import board
+        import adafruit_bme680
+        # Create sensor object, communicating over the board's default I2C bus
+        i2c = board.I2C()   # uses board.SCL and board.SDA
+        self.device = adafruit_bme680.Adafruit_BME680_I2C(i2c)
+        # change this to match the location's pressure (hPa) at sea level
+        self.device.sea_level_pressure = sea_level_pressure
+        self.temperature_offset = temperature_offset
+
+        self.device.temperature_oversample = check_oversampling('temperature_oversample', temperature_oversample)
+        self.device.humidity_oversample = check_oversampling('humidity_oversample', humidity_oversample)
+        self.device.pressure_oversample = check_oversampling('pressure_oversample', pressure_oversample)
+        if filter_size not in self.FILTER_SIZES:
+            raise ValueError("filter_size must be one of %s, not %s"% (", ".join(map(str, self.FILTER_SIZES)), filter_size))
+        self.device.filter_size = filter_size
+        if hasattr(self.device, 'set_gas_heater'):
+            self.device.set_gas_heater(heater_temperature, heater_duration)
+        elif (heater_temperature, heater_duration) != (320, 150):
+            print("This adafruit_bme680 can't set the heater profile, using its default")
+
+        # Every property of the driver starts its own measurement, heater
+        # cycle and all, unless one was taken in the last _min_refresh_time
+        # seconds.  Make that forever, and start the one measurement a
+        # cycle ourselves in read().
+        self.device._min_refresh_time = math.inf
+
+    def read(self):
+        data = {
+            "temperature_f": None,
+            "gas": None,
+            "humidity": None,
+            "pressure": None
+            }
+
+        try:
+            self.device._last_reading = -math.inf
+            self.device._perform_reading()
+            temperature_c = self.device.temperature + self.temperature_offset
+            data['temperature_f'] = celsius_to_fahrenheit(temperature_c)
+            data['gas'] = self.device.gas
+            data['humidity'] = self.device.relative_humidity
+            data['pressure'] = self.device.pressure
+        except RuntimeError as error:
+            # If we get an error, let's log it and return empty data.
+            print(error.args[0])
+
+        return data
+
+    def close(self):
+        pass
+
+    @classmethod
+    def from_config(cls, section):
+        return cls(
+            sea_level_pressure=section.getfloat('sea_level_pressure', derived.STANDARD_PRESSURE),
+            temperature_offset=section.getfloat('temperature_offset', -5),
+            temperature_oversample=section.getint('temperature_oversample', 8),
+            humidity_oversample=section.getint('humidity_oversample', 2),
+            pressure_oversample=section.getint('pressure_oversample', 4),
+            filter_size=section.getint('filter_size', 3),
+            heater_temperature=section.getint('heater_temperature', 320),
+            heater_duration=section.getint('heater_duration', 150))
+
+class AwairSensor:
+    name = 'awair'
+    min_interval = 1
+
+    def __init__(self, url, timeout=2, session=None):
+        self.url = url
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session = session
+
+    def read(self):
+        data = {}
+
+        try:
+            r = self.session.get(self.url, timeout=self.timeout)
+        except requests.RequestException as error:
+            print("Got an error querying %s: %s"% (self.url, error))
+            return data
+
+        if r.status_code == 200:
+            data = json.loads(r.text)
+            data['temperature_f'] = celsius_to_fahrenheit(data['temp'])
+        else:
+            print("Got an error querying the web server %d"% (r.status_code))
+
+        return data
+
+    def close(self):
+        self.session.close()
+
+    @classmethod
+    def from_config(cls, section):
+        return cls(section['url'], timeout=section.getfloat('timeout', 2))
+
+DRIVERS = {
+    'dht22': DHT22Sensor,
+    'bme280': BME280Sensor,
+    'bme680': BME680Sensor,
+    'awair': AwairSensor,
+}
+
+# Create the drivers listed in a [SENSOR:<name>] section
+def from_config(section):
+    drivers = []
+    for name in section.get('drivers', '').split(','):
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name not in DRIVERS:
+            raise ValueError("Unknown sensor driver %s in [%s]"% (name, section.name))
+        drivers.append(DRIVERS[name].from_config(section))
+    return drivers
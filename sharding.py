@@ -0,0 +1,79 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Splits stations between subscriber workers, so ingest can run on more
+# than one core or host.  Every worker subscribes to everything and keeps
+# only the stations it owns, picked by consistent hashing of the station
+# name, so each station's state, history, archive and uploads live in
+# exactly one worker.  Adding or removing a worker only moves about 1/N of
+# the stations.
+#
+# A station named by the topic is dropped before it's queued.  One named in
+# the payload has to be decoded first.
+#
+# To see which worker owns a station:
+#
+#   python sharding.py --worker-count 4 home cabin
+
+from prometheus_client import Counter, Gauge
+import argparse
+import bisect
+import hashlib
+
+# Points on the ring per worker.  More spreads stations more evenly.
+VNODES = 160
+
+worker_gauge = Gauge('subscriber_worker', 'Always 1, labeled with this worker and how many there are', ['worker', 'workers'])
+skipped_counter = Counter('worker_skipped', 'Samples for stations another worker owns')
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+class Ownership:
+    def __init__(self, worker=0, workers=1, vnodes=VNODES, cache_size=10000):
+        if not 0 <= worker < workers:
+            raise ValueError("Worker %d isn't one of 0 to %d"% (worker, workers - 1))
+        self.worker = worker
+        self.workers = workers
+        ring = sorted((_hash("worker-%d-%d"% (w, v)), w) for w in range(workers) for v in range(vnodes))
+        self.points = [point for point, w in ring]
+        self.owners = [w for point, w in ring]
+        # Owner by station, so the hash is only worked out once per station
+        self.cache = {}
+        self.cache_size = cache_size
+        worker_gauge.labels(str(worker), str(workers)).set(1)
+
+    def owner(self, station):
+        if self.workers == 1:
+            return 0
+        owner = self.cache.get(station)
+        if owner is None:
+            owner = self.owners[bisect.bisect(self.points, _hash(station)) % len(self.points)]
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[station] = owner
+        return owner
+
+    def owns(self, station):
+        return self.workers == 1 or self.owner(station) == self.worker
+
+# worker and workers override [SUBSCRIBER] worker_index and worker_count
+def from_config(config, worker=None, workers=None):
+    if worker is None:
+        worker = config.getint('SUBSCRIBER', 'worker_index', fallback=0)
+    if workers is None:
+        workers = config.getint('SUBSCRIBER', 'worker_count', fallback=1)
+    return Ownership(worker, workers)
+
+def main():
+    parser = argparse.ArgumentParser(description="Show which subscriber worker owns each station")
+    parser.add_argument('--worker-count', type=int, required=True, help="number of workers")
+    parser.add_argument('stations', nargs='+')
+    args = parser.parse_args()
+
+    ownership = Ownership(0, args.worker_count)
+    for station in args.stations:
+        print("%s: worker %d"% (station, ownership.owner(station)))
+
+if __name__ == '__main__':
+    main()
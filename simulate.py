@@ -0,0 +1,154 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Runs subscriber.py against any number of simulated stations on an
+# ordinary Linux box.  The sensor libraries, awscrt and awsiot are replaced
+# by the fakes in simulation/fakes, and everything talks through the
+# in-process broker in simulation/broker.py.
+#
+#   python simulate.py --stations 200 --interval 1 --duration 30
+#
+# Set WEATHER_SIM_SEED for repeatable data, or WEATHER_SIM_REPLAY to a file
+# of recorded payloads to play those back.
+
+import argparse
+import contextlib
+import os
+import random
+import sys
+import threading
+import time
+
+# The fakes have to be found before any real hardware or awscrt modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulation', 'fakes'))
+
+from awscrt import mqtt
+from awsiot import mqtt_connection_builder
+from simulation.broker import default_broker
+import batching
+import sensors
+
+# A simulated station, publishing like one of the publisher scripts
+class Station(threading.Thread):
+    def __init__(self, name, kind, topic, interval, stop):
+        super().__init__(name=name, daemon=True)
+        self.kind = kind
+        self.topic = topic
+        self.interval = interval
+        self.stop = stop
+        self.published = 0
+        self.failed_reads = 0
+        if kind == 'inside':
+            self.drivers = [sensors.BME680Sensor()]
+        else:
+            # One read per cycle, and no 2 second DHT22 spacing, so stations
+            # can publish as fast as the load test asks
+            dht22 = sensors.DHT22Sensor(samples=1, budget=0)
+            dht22.min_interval = 0
+            self.drivers = [dht22]
+        # Stamps ts, seq and boot like the real publishers
+        self.batcher = batching.Batcher()
+        self.connection = mqtt_connection_builder.mtls_from_path(endpoint='simulated', client_id=name)
+        self.connection.connect().result()
+
+    def read(self):
+        data = {}
+        for driver in self.drivers:
+            data.update(driver.read())
+        return data
+
+    def run(self):
+        # Spread the stations out over the first interval
+        self.stop.wait(random.uniform(0, self.interval))
+        while not self.stop.is_set():
+            data = self.read()
+            if data.get('temperature_f') is not None:
+                data['sim_sent'] = time.monotonic()
+                self.connection.publish(
+                    topic=self.topic,
+                    payload=self.batcher.add(data),
+                    qos=mqtt.QoS.AT_LEAST_ONCE)
+                self.published += 1
+            else:
+                self.failed_reads += 1
+            self.stop.wait(self.interval)
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive subscriber.py with simulated stations")
+    parser.add_argument('--stations', type=int, default=10, help="number of simulated stations")
+    parser.add_argument('--interval', type=float, default=5, help="seconds between readings per station")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run for")
+    parser.add_argument('--inside', type=float, default=0.5, help="fraction of stations with a BME680 inside")
+    parser.add_argument('--verbose', action='store_true', help="show the subscriber and driver output")
+    args = parser.parse_args()
+
+    report = sys.stdout
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    with output:
+        import subscriber
+        subscriber.setup_worker()
+
+        # Time every sample from publish to the end of processing
+        latencies = []
+        handle_sample = subscriber.handle_sample
+        def timed_handle_sample(data, topic=''):
+            handle_sample(data, topic)
+            sent = data.get('sim_sent')
+            if sent is not None:
+                latencies.append(time.monotonic() - sent)
+        subscriber.handle_sample = timed_handle_sample
+
+        # Every station publishes on its own topic under one wildcard
+        topic_filter = "%s/+"% (subscriber.message_topic,)
+        subscriber.station_table = subscriber.stations.from_config(subscriber.config, topic_filter)
+
+        subscriber.ingest_queue.start()
+        connection = mqtt_connection_builder.mtls_from_path(endpoint='simulated', client_id='subscriber')
+        connection.connect().result()
+        connection.subscribe(
+            topic=topic_filter,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=subscriber.on_message_received)[0].result()
+
+        stop = threading.Event()
+        inside = int(args.stations * args.inside)
+        stations = [
+            Station("station-%d"% (i,), 'inside' if i < inside else 'outside',
+                    "%s/station-%d"% (subscriber.message_topic, i), args.interval, stop)
+            for i in range(args.stations)]
+
+        started = time.monotonic()
+        for station in stations:
+            station.start()
+        stop.wait(args.duration)
+        stop.set()
+        for station in stations:
+            station.join()
+
+        # Let everything in flight make it through
+        while default_broker.delivered < default_broker.published:
+            time.sleep(0.01)
+        subscriber.ingest_queue.stop()
+        elapsed = time.monotonic() - started
+        connection.disconnect()
+
+    published = sum(station.published for station in stations)
+    failed_reads = sum(station.failed_reads for station in stations)
+    latencies.sort()
+    print("Stations:          %d (%d inside, %d outside)"% (len(stations), inside, len(stations) - inside), file=report)
+    print("Published:         %d messages in %.1f s (%.1f msg/s)"% (published, elapsed, published / elapsed), file=report)
+    print("Processed:         %d samples (%.1f samples/s)"% (len(latencies), len(latencies) / elapsed), file=report)
+    print("Tracked sensors:   %d"% (len(subscriber.station_table.sensors),), file=report)
+    print("Failed reads:      %d"% (failed_reads,), file=report)
+    print("Latency p50:       %.3f ms"% (percentile(latencies, 0.50) * 1000,), file=report)
+    print("Latency p99:       %.3f ms"% (percentile(latencies, 0.99) * 1000,), file=report)
+    print("Latency max:       %.3f ms"% (percentile(latencies, 1.0) * 1000,), file=report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# A local, in-process stand-in for the AWS IoT broker.  Messages are
+# delivered to subscribers on a single delivery thread, the same way awscrt
+# calls us back on its event-loop thread.
+
+import collections
+import concurrent.futures
+import threading
+
+# Does an MQTT topic filter (with + and # wildcards) match a topic?
+def topic_matches(topic_filter, topic):
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    # Shared subscriptions look like $share/<group>/<filter>
+    if filter_parts[0] == '$share' and len(filter_parts) > 2:
+        filter_parts = filter_parts[2:]
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != '+' and part != topic_parts[i]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+class Broker:
+    def __init__(self):
+        self.subscriptions = []
+        self.share_counters = collections.Counter()
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.published = 0
+        self.delivered = 0
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.running = True
+                self.thread = threading.Thread(target=self._deliver, name="broker", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def subscribe(self, topic_filter, callback):
+        with self.condition:
+            self.subscriptions.append((topic_filter, callback))
+
+    def unsubscribe(self, topic_filter, callback=None):
+        with self.condition:
+            self.subscriptions = [
+                (f, c) for f, c in self.subscriptions
+                if f != topic_filter or (callback is not None and c != callback)]
+
+    # Returns a future that completes once the message has been handed to
+    # every matching subscriber, like a QoS1 PUBACK.
+    def publish(self, topic, payload, qos=1, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.published += 1
+            self.queue.append((topic, payload, qos, retain, future))
+            self.condition.notify()
+        self.start()
+        return future
+
+    def _deliver(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                topic, payload, qos, retain, future = self.queue.popleft()
+                subscriptions = list(self.subscriptions)
+
+            # Shared subscriptions deliver to one member of each group in turn
+            groups = {}
+            for topic_filter, callback in subscriptions:
+                if not topic_matches(topic_filter, topic):
+                    continue
+                if topic_filter.startswith('$share/'):
+                    groups.setdefault(topic_filter, []).append(callback)
+                    continue
+                self._call(callback, topic, payload, qos, retain)
+            for topic_filter, callbacks in groups.items():
+                self.share_counters[topic_filter] += 1
+                callback = callbacks[self.share_counters[topic_filter] % len(callbacks)]
+                self._call(callback, topic, payload, qos, retain)
+
+            self.delivered += 1
+            future.set_result({'packet_id': self.delivered})
+
+    def _call(self, callback, topic, payload, qos, retain):
+        try:
+            callback(topic=topic, payload=payload, dup=False, qos=qos, retain=retain)
+        except Exception as error:
+            print("Subscriber callback raised %s"% (error,))
+
+# The broker every fake connection in this process talks to
+default_broker = Broker()
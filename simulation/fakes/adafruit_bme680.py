@@ -0,0 +1,66 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Fake Adafruit BME680 driver.  Like the real one, every property takes a
+# new measurement unless one was taken in the last _min_refresh_time seconds.
+
+import time
+from simulation import weather
+
+class Adafruit_BME680:
+    def __init__(self, refresh_rate=10):
+        self.sea_level_pressure = 1013.25
+        self.pressure_oversample = 4
+        self.temperature_oversample = 8
+        self.humidity_oversample = 2
+        self.filter_size = 3
+        self.heater = (320, 150)
+        self._reading = None
+        self._last_reading = 0
+        self._min_refresh_time = 1 / refresh_rate
+        self.readings = 0
+
+    def set_gas_heater(self, heater_temp, heater_time):
+        self.heater = (heater_temp, heater_time)
+        return True
+
+    def _perform_reading(self):
+        if time.monotonic() - self._last_reading < self._min_refresh_time:
+            return
+        self.readings += 1
+        self._reading = weather.source().sample()
+        self._last_reading = time.monotonic()
+
+    @property
+    def temperature(self):
+        self._perform_reading()
+        return self._reading['temperature_c']
+
+    @property
+    def relative_humidity(self):
+        self._perform_reading()
+        return self._reading['humidity']
+
+    @property
+    def humidity(self):
+        return self.relative_humidity
+
+    @property
+    def pressure(self):
+        self._perform_reading()
+        return self._reading['pressure']
+
+    @property
+    def altitude(self):
+        return 44330 * (1.0 - ((self.pressure / self.sea_level_pressure) ** 0.1903))
+
+    @property
+    def gas(self):
+        self._perform_reading()
+        return int(self._reading['gas'])
+
+class Adafruit_BME680_I2C(Adafruit_BME680):
+    def __init__(self, i2c, address=0x77, debug=False, *, refresh_rate=10):
+        super().__init__(refresh_rate=refresh_rate)
+        self.i2c = i2c
+        self.address = address
@@ -0,0 +1,38 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Fake DHT22 that fails now and then the way a real one does.
+
+from simulation import weather
+
+# Real DHT22s fail a good fraction of reads
+FAILURE_RATE = 0.1
+
+class DHTBase:
+    def __init__(self, pin, use_pulseio=True):
+        self.pin = pin
+        self._reading = None
+
+    def measure(self):
+        if weather.source().chance(FAILURE_RATE):
+            raise RuntimeError("Checksum did not validate. Try again.")
+        self._reading = weather.source().sample()
+
+    @property
+    def temperature(self):
+        self.measure()
+        return round(self._reading['temperature_c'], 1)
+
+    @property
+    def humidity(self):
+        self.measure()
+        return round(self._reading['humidity'], 1)
+
+    def exit(self):
+        pass
+
+class DHT22(DHTBase):
+    pass
+
+class DHT11(DHTBase):
+    pass
@@ -0,0 +1,5 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Just enough of awscrt to run the publishers and subscriber against the
+# in-process broker in simulation/broker.py.
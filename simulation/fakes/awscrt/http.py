@@ -0,0 +1,7 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+class HttpProxyOptions:
+    def __init__(self, host_name=None, port=None):
+        self.host_name = host_name
+        self.port = port
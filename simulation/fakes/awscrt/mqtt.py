@@ -0,0 +1,108 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Fake awscrt.mqtt.Connection backed by the in-process broker.
+
+import concurrent.futures
+import enum
+import threading
+from simulation.broker import default_broker
+
+class QoS(enum.IntEnum):
+    AT_MOST_ONCE = 0
+    AT_LEAST_ONCE = 1
+    EXACTLY_ONCE = 2
+
+class ConnectReturnCode(enum.IntEnum):
+    ACCEPTED = 0
+    UNACCEPTABLE_PROTOCOL_VERSION = 1
+    IDENTIFIER_REJECTED = 2
+    SERVER_UNAVAILABLE = 3
+    BAD_USERNAME_OR_PASSWORD = 4
+    NOT_AUTHORIZED = 5
+
+class OnConnectionSuccessData:
+    def __init__(self, return_code=ConnectReturnCode.ACCEPTED, session_present=False):
+        self.return_code = return_code
+        self.session_present = session_present
+
+class OnConnectionFailureData:
+    def __init__(self, error=None):
+        self.error = error
+
+class OnConnectionClosedData:
+    pass
+
+def _done(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+class Connection:
+    def __init__(self, client_id=None, on_connection_interrupted=None, on_connection_resumed=None,
+                 on_connection_success=None, on_connection_failure=None, on_connection_closed=None,
+                 broker=None, **kwargs):
+        self.client_id = client_id
+        self.on_connection_interrupted = on_connection_interrupted
+        self.on_connection_resumed = on_connection_resumed
+        self.on_connection_success = on_connection_success
+        self.on_connection_failure = on_connection_failure
+        self.on_connection_closed = on_connection_closed
+        self.broker = broker or default_broker
+        self.subscriptions = {}
+        self.connected = False
+        self._packet_id = 0
+        self._lock = threading.Lock()
+
+    def _next_packet_id(self):
+        with self._lock:
+            self._packet_id += 1
+            return self._packet_id
+
+    def connect(self):
+        self.connected = True
+        if self.on_connection_success:
+            self.on_connection_success(self, OnConnectionSuccessData())
+        return _done({'return_code': ConnectReturnCode.ACCEPTED, 'session_present': False})
+
+    def disconnect(self):
+        self.connected = False
+        for topic, callback in self.subscriptions.items():
+            self.broker.unsubscribe(topic, callback)
+        if self.on_connection_closed:
+            self.on_connection_closed(self, OnConnectionClosedData())
+        return _done({})
+
+    # Simulate a network outage and recovery
+    def interrupt(self, error="simulated outage"):
+        self.connected = False
+        if self.on_connection_interrupted:
+            self.on_connection_interrupted(self, error)
+
+    def resume(self):
+        self.connected = True
+        if self.on_connection_resumed:
+            self.on_connection_resumed(self, ConnectReturnCode.ACCEPTED, True)
+
+    def publish(self, topic, payload, qos, retain=False):
+        packet_id = self._next_packet_id()
+        if not self.connected:
+            future = concurrent.futures.Future()
+            future.set_exception(ConnectionError("Not connected"))
+            return future, packet_id
+        return self.broker.publish(topic, payload, qos, retain), packet_id
+
+    def subscribe(self, topic, qos, callback=None):
+        self.subscriptions[topic] = callback
+        if callback is not None:
+            self.broker.subscribe(topic, callback)
+        return _done({'packet_id': self._next_packet_id(), 'topic': topic, 'qos': qos}), self._packet_id
+
+    def unsubscribe(self, topic):
+        callback = self.subscriptions.pop(topic, None)
+        self.broker.unsubscribe(topic, callback)
+        return _done({'packet_id': self._next_packet_id()}), self._packet_id
+
+    def resubscribe_existing_topics(self):
+        topics = [(topic, QoS.AT_LEAST_ONCE) for topic in self.subscriptions]
+        return _done({'packet_id': self._next_packet_id(), 'topics': topics}), self._packet_id
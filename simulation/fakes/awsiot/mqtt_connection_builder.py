@@ -0,0 +1,13 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Builds fake connections to the in-process broker instead of AWS IoT.
+# Certificates and endpoints are accepted and ignored.
+
+from awscrt import mqtt
+
+def mtls_from_path(cert_filepath=None, pri_key_filepath=None, **kwargs):
+    return mqtt.Connection(**kwargs)
+
+def mtls_from_bytes(cert_bytes=None, pri_key_bytes=None, **kwargs):
+    return mqtt.Connection(**kwargs)
@@ -0,0 +1,30 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Fake RPi.bme280 module.
+
+import datetime
+import uuid
+from simulation import weather
+
+class oversampling:
+    x1 = 1
+    x2 = 2
+    x4 = 3
+    x8 = 4
+    x16 = 5
+
+class compensated_readings:
+    def __init__(self, temperature, humidity, pressure):
+        self.id = uuid.uuid4()
+        self.timestamp = datetime.datetime.now()
+        self.temperature = temperature
+        self.humidity = humidity
+        self.pressure = pressure
+
+def load_calibration_params(bus, address=0x76):
+    return {'bus': bus, 'address': address}
+
+def sample(bus, address=0x76, compensation_params=None, sampling=oversampling.x1):
+    reading = weather.source().sample()
+    return compensated_readings(reading['temperature_c'], reading['humidity'], reading['pressure'])
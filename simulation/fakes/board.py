@@ -0,0 +1,24 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Fake Blinka board module for running the sensor code off a Raspberry Pi.
+# Any pin name (board.D4, board.SCL, ...) resolves to itself.
+
+SCL = 'SCL'
+SDA = 'SDA'
+
+def __getattr__(name):
+    if name.startswith('D') and name[1:].isdigit():
+        return name
+    raise AttributeError(name)
+
+class _I2C:
+    def __init__(self, scl=SCL, sda=SDA):
+        self.scl = scl
+        self.sda = sda
+
+    def deinit(self):
+        pass
+
+def I2C():
+    return _I2C()
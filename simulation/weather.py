@@ -0,0 +1,80 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Data source for the fake sensor drivers.  By default it makes up
+# plausible weather: a daily temperature cycle with humidity moving the
+# other way, slowly wandering pressure and a bit of sensor noise.  Set
+# WEATHER_SIM_REPLAY to a file of recorded JSON payloads (one per line) to
+# play those back instead, and WEATHER_SIM_SEED for repeatable runs.
+
+import json
+import math
+import os
+import random
+import threading
+import time
+
+class SyntheticWeather:
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pressure = 1013.25 + self.random.uniform(-10, 10)
+        self.gas = 50000 + self.random.uniform(-5000, 5000)
+        self.phase = self.random.uniform(0, 2 * math.pi)
+
+    def sample(self, t=None):
+        if t is None:
+            t = time.time()
+        with self.lock:
+            # Warmest mid afternoon, coolest just before dawn
+            day = 2 * math.pi * (t % 86400) / 86400 + self.phase
+            temperature = 15 + 8 * math.sin(day) + self.random.gauss(0, 0.2)
+            humidity = min(100, max(5, 60 - 20 * math.sin(day) + self.random.gauss(0, 1)))
+            self.pressure = min(1050, max(960, self.pressure + self.random.gauss(0, 0.05)))
+            self.gas = max(1000, self.gas + self.random.gauss(0, 200))
+            return {
+                "temperature_c": temperature,
+                "humidity": humidity,
+                "pressure": self.pressure + self.random.gauss(0, 0.1),
+                "gas": self.gas,
+            }
+
+    def chance(self, probability):
+        with self.lock:
+            return self.random.random() < probability
+
+# Plays recorded payloads back in a loop.  Temperatures are recorded in
+# fahrenheit, the drivers want celsius.
+class ReplayWeather(SyntheticWeather):
+    def __init__(self, path, seed=None):
+        super().__init__(seed)
+        with open(path) as f:
+            self.samples = [json.loads(line) for line in f if line.strip()]
+        if not self.samples:
+            raise ValueError("No samples in %s"% (path,))
+        self.position = 0
+
+    def sample(self, t=None):
+        with self.lock:
+            recorded = self.samples[self.position]
+            self.position = (self.position + 1) % len(self.samples)
+        synthetic = super().sample(t)
+        if recorded.get('temperature_f') is not None:
+            synthetic['temperature_c'] = (recorded['temperature_f'] - 32) * 5 / 9
+        for field in ('humidity', 'pressure', 'gas'):
+            if recorded.get(field) is not None:
+                synthetic[field] = recorded[field]
+        return synthetic
+
+_source = None
+
+def source():
+    global _source
+    if _source is None:
+        seed = os.environ.get('WEATHER_SIM_SEED')
+        replay = os.environ.get('WEATHER_SIM_REPLAY')
+        if replay:
+            _source = ReplayWeather(replay, seed)
+        else:
+            _source = SyntheticWeather(seed)
+    return _source
@@ -0,0 +1,283 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Everywhere the subscriber sends samples on to.  Each sink has its own
+# bounded queue and worker thread, so a slow or failing sink never holds up
+# ingest or any other sink: when its queue is full the oldest sample is
+# dropped.  A sink sends at most every min_interval seconds, up to
+# max_batch samples at a time, and a failed send is retried up to retries
+# times with jittered exponential backoff before those samples are dropped.
+# The backoff carries over to the next batch, up to max_backoff seconds, and
+# only resets once a send works, so a dead endpoint isn't hit every few
+# seconds forever.
+#
+# Sinks are [SINK:<name>] sections in weather-station.ini with a type:
+#
+#   wunderground  uploads the current outside conditions ([WU] is used if
+#                 there's no wunderground sink configured)
+#   pwsweather    the same, for PWSweather
+#   file          appends every sample to a JSON lines file
+#   archive       the columnar archive in archive.py (added for [ARCHIVE])
+#
+# Adding a new one means subclassing Sink, overriding send(), and adding it
+# to TYPES.
+
+from prometheus_client import Counter, Gauge, Histogram
+import collections
+import json
+import random
+import threading
+import time
+import wunderground
+
+queue_depth_gauge = Gauge('sink_queue_depth', 'Samples waiting for a sink', ['sink'])
+sent_counter = Counter('sink_sent', 'Samples a sink has sent', ['sink'])
+dropped_counter = Counter('sink_dropped', 'Samples a sink dropped, because its queue was full or it gave up retrying', ['sink'])
+failures_counter = Counter('sink_failures', 'Failed sends', ['sink'])
+retries_counter = Counter('sink_retries', 'Sends retried after a failure', ['sink'])
+send_histogram = Histogram('sink_send_seconds', 'Time spent in a successful send', ['sink'])
+healthy_gauge = Gauge('sink_healthy', '1 if the last send worked, 0 if it failed', ['sink'])
+last_success_gauge = Gauge('sink_last_success', 'Unix time of the last successful send', ['sink'])
+
+class Sink:
+    def __init__(self, name, queue_size=1000, min_interval=0, max_batch=1, retries=3, retry_delay=5, max_backoff=300):
+        self.name = name
+        self.queue_size = queue_size
+        self.min_interval = min_interval
+        self.max_batch = max_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+
+        # Failed sends in a row, and when the next send may be tried
+        self.failing = 0
+        self.retry_at = 0
+
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.running = False
+        self.thread = None
+
+        self.queue_depth = queue_depth_gauge.labels(name)
+        self.sent = sent_counter.labels(name)
+        self.dropped = dropped_counter.labels(name)
+        self.failures = failures_counter.labels(name)
+        self.retried = retries_counter.labels(name)
+        self.send_time = send_histogram.labels(name)
+        self.healthy = healthy_gauge.labels(name)
+        self.last_success = last_success_gauge.labels(name)
+        self.healthy.set(1)
+
+    # Does this sink want the sample at all?
+    def accepts(self, station, sensor, data):
+        return True
+
+    # Send a list of (station, sensor, data).  Raise to have it retried.
+    def send(self, items):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # Called on the ingest threads, so it never waits
+    def offer(self, station, sensor, data):
+        if not self.accepts(station, sensor, data):
+            return
+        with self.condition:
+            if len(self.items) >= self.queue_size:
+                self.items.popleft()
+                self.dropped.inc()
+            self.items.append((station, sensor, data))
+            self.queue_depth.set(len(self.items))
+            self.condition.notify()
+
+    def _work(self):
+        last_send = -self.min_interval
+        while True:
+            with self.condition:
+                while self.running and not self.items:
+                    self.condition.wait()
+                if not self.items:
+                    return
+
+            # Wait out the rate limit and any backoff before taking the
+            # batch, so it fills up
+            self.stopping.wait(max(last_send + self.min_interval, self.retry_at) - time.monotonic())
+
+            with self.condition:
+                batch = [self.items.popleft() for _ in range(min(self.max_batch, len(self.items)))]
+                self.queue_depth.set(len(self.items))
+            self._deliver(batch)
+            last_send = time.monotonic()
+
+    def _deliver(self, batch):
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                self.send(batch)
+            except Exception as error:
+                self.failures.inc()
+                self.healthy.set(0)
+                delay = min(self.max_backoff, self.retry_delay * 2 ** self.failing)
+                delay = random.uniform(delay / 2, delay)
+                self.failing += 1
+                if attempt >= self.retries or self.stopping.is_set():
+                    print("Sink %s giving up on %d samples: %s"% (self.name, len(batch), error))
+                    self.dropped.inc(len(batch))
+                    # Still failing, so the next batch waits too
+                    self.retry_at = time.monotonic() + delay
+                    return
+                attempt += 1
+                self.retried.inc()
+                print("Sink %s failed (%s), retrying in %.1f seconds"% (self.name, error, delay))
+                self.stopping.wait(delay)
+                continue
+
+            self.failing = 0
+            self.retry_at = 0
+            self.send_time.observe(time.monotonic() - started)
+            self.sent.inc(len(batch))
+            self.healthy.set(1)
+            self.last_success.set(time.time())
+            return
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._work, name="sink-%s"% (self.name,), daemon=True)
+        self.thread.start()
+
+    # Send whatever is queued, without waiting on rate limits or retries
+    def stop(self, timeout=10):
+        self.stopping.set()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.close()
+
+# Uploads the current conditions from get_observation().  Samples only say
+# something changed, so by default just the latest one is queued.
+class ObservationSink(Sink):
+    def __init__(self, name, uploader, get_observation, accepts, **options):
+        options.setdefault('queue_size', 1)
+        options.setdefault('min_interval', uploader.interval)
+        super().__init__(name, **options)
+        self.uploader = uploader
+        self.get_observation = get_observation
+        self._accepts = accepts
+
+    def accepts(self, station, sensor, data):
+        return self._accepts(station, sensor, data)
+
+    def send(self, items):
+        observation = self.get_observation()
+        if observation is not None:
+            self.uploader.send(observation)
+
+    def close(self):
+        self.uploader.close()
+
+class FileSink(Sink):
+    def __init__(self, name, path, **options):
+        options.setdefault('max_batch', 100)
+        super().__init__(name, **options)
+        self.path = path
+
+    def send(self, items):
+        with open(self.path, 'a') as f:
+            for station, sensor, data in items:
+                line = {"station": station, "sensor": sensor}
+                line.update(data)
+                f.write(json.dumps(line) + "\n")
+
+class ArchiveSink(Sink):
+    def __init__(self, name, archiver, **options):
+        options.setdefault('max_batch', 1000)
+        super().__init__(name, **options)
+        self.archiver = archiver
+        # Write the buffered rows out on the archive's own schedule too
+        threading.Thread(target=archiver.run, args=[self.stopping], daemon=True).start()
+
+    def send(self, items):
+        for station, sensor, data in items:
+            self.archiver.append(station, sensor, data)
+
+    def close(self):
+        self.archiver.close()
+
+class Sinks:
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def publish(self, station, sensor, data):
+        for sink in self.sinks:
+            sink.offer(station, sensor, data)
+
+    def start(self):
+        for sink in self.sinks:
+            print("Starting sink %s"% (sink.name,))
+            sink.start()
+
+    def stop(self):
+        for sink in self.sinks:
+            sink.stop()
+
+def _options(section):
+    options = {}
+    for option in ('queue_size', 'max_batch', 'retries'):
+        if option in section:
+            options[option] = section.getint(option)
+    for option in ('min_interval', 'retry_delay', 'max_backoff'):
+        if option in section:
+            options[option] = section.getfloat(option)
+    return options
+
+# RapidFire is a Wunderground thing, other services get the normal upload
+def _uploads(url, service, rapidfire=False):
+    def create(name, section, get_observation, accepts):
+        uploader = wunderground.WundergroundUploader(
+            section['station_id'],
+            section['station_pass'],
+            interval=section.getfloat('interval', 5),
+            connect_timeout=section.getfloat('connect_timeout', 3.05),
+            read_timeout=section.getfloat('read_timeout', 10),
+            heartbeat=section.getfloat('heartbeat', 300),
+            rapidfire=rapidfire and section.getboolean('rapidfire', False),
+            url=url,
+            service=service)
+        return ObservationSink(name, uploader, get_observation, accepts, **_options(section))
+    return create
+
+def _file(name, section, get_observation, accepts):
+    return FileSink(name, section['path'], **_options(section))
+
+TYPES = {
+    'wunderground': _uploads(wunderground.UPLOAD_URL, "Wunderground", rapidfire=True),
+    'pwsweather': _uploads(wunderground.PWSWEATHER_URL, "PWSweather"),
+    'file': _file,
+}
+
+# get_observation() returns the current conditions for the upload sinks,
+# and accepts(station, sensor, data) picks the samples that change them.
+def from_config(config, get_observation, accepts, archiver=None):
+    sinks = []
+    for name in config.sections():
+        if name.startswith('SINK:'):
+            section = config[name]
+            kind = section.get('type', '').lower()
+            if kind not in TYPES:
+                raise ValueError("Unknown sink type %s in [%s]"% (kind, name))
+            sinks.append(TYPES[kind](name[len('SINK:'):], section, get_observation, accepts))
+
+    # The original setup: [WU] on its own uploads to Wunderground
+    if config.has_section('WU') and not any(
+            config.get(name, 'type', fallback='').lower() == 'wunderground'
+            for name in config.sections() if name.startswith('SINK:')):
+        sinks.append(TYPES['wunderground']('wunderground', config['WU'], get_observation, accepts))
+
+    if archiver is not None:
+        sinks.append(ArchiveSink('archive', archiver))
+    return Sinks(sinks)
@@ -0,0 +1,224 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Per-station, per-sensor state for the subscriber.  Every sample is routed
+# to its (station, sensor) entry with one dict lookup, and each entry owns
+# its labeled Prometheus series.  Entries that stop reporting for
+# stale_after seconds are evicted along with their series, and the table
+# never holds more than max_sensors entries, so memory stays bounded no
+# matter how many stations come and go.
+#
+# The station is the topic level matched by the first wildcard of the
+# subscription (weather/+ makes weather/barn station "barn"), else a
+# "station" field in the payload (an AWS IoT rule can add one with
+# clientid()), else the topic itself.  The sensor is the payload's "device"
+# (the sensor_daemon section name), else "inside" for BME680 payloads and
+# "outside" for everything else, the way the original publishers split up.
+#
+# The latest readings of each entry are kept in an immutable Snapshot that's
+# replaced as a whole on every sample, so another thread reading
+# state.snapshot always gets values that belong together, without either
+# side taking a lock.  Each field carries the time it was last received, so
+# readers can tell a sensor that's gone quiet from one that hasn't changed.
+
+from prometheus_client import Counter, Gauge
+import collections
+import threading
+import time
+
+LABELS = ['station', 'sensor']
+
+# Readings we export, and the gauge each one goes into
+FIELDS = {
+    'temperature_f': Gauge('station_temperature', 'Temperature (f)', LABELS),
+    'humidity': Gauge('station_humidity', 'Humidity (%)', LABELS),
+    'pressure': Gauge('station_pressure', 'Air pressure (mb)', LABELS),
+    'gas': Gauge('station_gas', 'Gas resistance (ohms)', LABELS),
+    'co2': Gauge('station_co2', 'CO2 (ppm)', LABELS),
+    'voc': Gauge('station_voc', 'VOC (ppb)', LABELS),
+    'pm25': Gauge('station_pm25', 'PM2.5 (ug/m3)', LABELS),
+    'score': Gauge('station_score', 'Awair score', LABELS),
+    'dewpoint_f': Gauge('station_dewpoint', 'Dewpoint (f)', LABELS),
+    'heat_index_f': Gauge('station_heat_index', 'Heat index (f)', LABELS),
+    'wind_chill_f': Gauge('station_wind_chill', 'Wind chill (f)', LABELS),
+    'sea_level_pressure': Gauge('station_sea_level_pressure', 'Air pressure at sea level (mb)', LABELS),
+    'iaq_score': Gauge('station_iaq_score', 'Air quality from gas resistance, 0 to 100', LABELS),
+}
+
+last_seen_gauge = Gauge('station_last_seen', 'Unix time of the last sample', LABELS)
+tracked_gauge = Gauge('station_sensors', 'Station sensors being tracked')
+evicted_counter = Counter('station_sensors_evicted', 'Station sensors dropped after going quiet')
+
+# Which topic level the first wildcard of a subscription matches, or None
+def wildcard_level(topic_filter):
+    parts = topic_filter.split('/')
+    # Shared subscriptions look like $share/<group>/<filter>
+    if parts[0] == '$share' and len(parts) > 2:
+        parts = parts[2:]
+    for i, part in enumerate(parts):
+        if part in ('+', '#'):
+            return i
+    return None
+
+# The readings of one station and sensor at a point in time.  Never changed
+# once it's made, and neither are its dicts.
+class Snapshot:
+    __slots__ = ('station', 'sensor', 'values', 'received', 'updated')
+
+    def __init__(self, station, sensor, values, received, updated):
+        object.__setattr__(self, 'station', station)
+        object.__setattr__(self, 'sensor', sensor)
+        object.__setattr__(self, 'values', values)
+        object.__setattr__(self, 'received', received)
+        object.__setattr__(self, 'updated', updated)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshots can't be changed")
+
+    # Seconds since field was last received, or None if it never was
+    def age(self, field, now=None):
+        received = self.received.get(field)
+        if received is None:
+            return None
+        return (time.time() if now is None else now) - received
+
+    # The field's value, or None if it's missing or older than max_age
+    def get(self, field, max_age=None, now=None):
+        value = self.values.get(field)
+        if value is None or max_age is None:
+            return value
+        if self.age(field, now) > max_age:
+            return None
+        return value
+
+    # Which of fields are missing or older than max_age
+    def stale(self, fields, max_age, now=None):
+        if now is None:
+            now = time.time()
+        return [field for field in fields if self.get(field, max_age, now) is None]
+
+class SensorState:
+    __slots__ = ('station', 'sensor', 'snapshot', 'updated', 'gauges', 'last_seen', 'derived', 'alerts')
+
+    def __init__(self, station, sensor):
+        self.station = station
+        self.sensor = sensor
+        self.snapshot = Snapshot(station, sensor, {}, {}, 0)
+        self.updated = time.time()
+        # Children are bound on first use, so a DHT22 never gets a gas series
+        self.gauges = {}
+        self.last_seen = last_seen_gauge.labels(station, sensor)
+        # Cache for derived.py
+        self.derived = None
+        # What each alert rule in alerts.py knows about this sensor
+        self.alerts = None
+
+    # Only the ingest worker handling this sensor's sample updates it.  With
+    # more than one worker, two samples for the same sensor at once can
+    # lose a field until the next sample brings it back.
+    def update(self, data, now):
+        values = dict(self.snapshot.values)
+        received = dict(self.snapshot.received)
+        for field, value in data.items():
+            if value is None:
+                continue
+            values[field] = value
+            received[field] = now
+            gauge = self.gauges.get(field)
+            if gauge is None:
+                if field not in FIELDS:
+                    continue
+                gauge = self.gauges[field] = FIELDS[field].labels(self.station, self.sensor)
+            gauge.set(value)
+        # Readers see the old snapshot or the new one, never half of each
+        self.snapshot = Snapshot(self.station, self.sensor, values, received, now)
+        self.updated = now
+        self.last_seen.set(now)
+
+    def remove(self):
+        for field in self.gauges:
+            FIELDS[field].remove(self.station, self.sensor)
+        last_seen_gauge.remove(self.station, self.sensor)
+
+class StationTable:
+    def __init__(self, topic_filter='', stale_after=3600, max_sensors=10000):
+        self.station_level = wildcard_level(topic_filter)
+        self.stale_after = stale_after
+        self.max_sensors = max_sensors
+        # Least recently updated first, so eviction only looks at the front
+        self.sensors = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # Called with each SensorState as it's evicted
+        self.on_evict = None
+
+    # The station named by the topic, or None if it doesn't name one
+    def topic_station(self, topic):
+        if self.station_level is not None:
+            parts = topic.split('/')
+            if self.station_level < len(parts):
+                return parts[self.station_level]
+        return None
+
+    def station_for(self, topic, data):
+        station = self.topic_station(topic)
+        if station is not None:
+            return station
+        return data.get('station') or topic
+
+    def sensor_for(self, data):
+        device = data.get('device')
+        if device:
+            return device
+        return 'inside' if 'gas' in data else 'outside'
+
+    # Route a sample to its station and sensor, and return that entry
+    def lookup(self, topic, data):
+        key = (self.station_for(topic, data), self.sensor_for(data))
+        with self.lock:
+            state = self.sensors.get(key)
+            if state is None:
+                state = self.sensors[key] = SensorState(*key)
+                if len(self.sensors) > self.max_sensors:
+                    self._evict(self.sensors.popitem(last=False)[1])
+                tracked_gauge.set(len(self.sensors))
+            else:
+                self.sensors.move_to_end(key)
+        return state
+
+    # Every sensor being tracked, as a list that's safe to walk
+    def states(self):
+        with self.lock:
+            return list(self.sensors.values())
+
+    def update(self, topic, data, now=None):
+        if now is None:
+            now = time.time()
+        state = self.lookup(topic, data)
+        state.update(data, now)
+        return state
+
+    def _evict(self, state):
+        print("Evicting %s/%s, last seen %s"% (state.station, state.sensor, time.ctime(state.updated)))
+        state.remove()
+        if self.on_evict is not None:
+            self.on_evict(state)
+        evicted_counter.inc()
+
+    # Drop everything that hasn't reported in stale_after seconds
+    def evict_stale(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            while self.sensors:
+                state = next(iter(self.sensors.values()))
+                if now - state.updated < self.stale_after:
+                    break
+                del self.sensors[(state.station, state.sensor)]
+                self._evict(state)
+            tracked_gauge.set(len(self.sensors))
+
+def from_config(config, topic_filter):
+    return StationTable(
+        topic_filter,
+        stale_after=config.getfloat('SUBSCRIBER', 'stale_after', fallback=3600),
+        max_sensors=config.getint('SUBSCRIBER', 'max_sensors', fallback=10000))
@@ -4,90 +4,57 @@
 # SPDX-License-Identifier: Apache-2.0.
 
 from awscrt import mqtt, http
-from awsiot import mqtt_connection_builder
-from prometheus_client import start_http_server, Gauge
+from prometheus_client import start_http_server, Counter, Gauge
+import argparse
 import sys
 import threading
 import time
-import json
-import requests
 import configparser
+import ingest
+import timeseries
+import wunderground
+import nws
+import stations
+import delivery
+import codec
+import archive
+import derived
+import sinks
+import transport
+import sharding
+import latest
+import alerts
 
 config = configparser.ConfigParser()
 config.read('weather-station.ini')
 
-endpoint=config['AWS']['endpoint']
-cert_filepath=config['AWS']['cert_filepath']
-pri_key_filepath=config['AWS']['pri_key_filepath']
-ca_filepath=config['AWS']['ca_filepath']
 clientId=config['AWS']['clientId']
 message_topic=config['AWS']['message_topic']
-station_id=config['WU']['station_id']
-station_pass=config['WU']['station_pass']
 
 received_all_event = threading.Event()
 
-# These are the global variables we're exposing
-# We'll set them all to zero so that we don't send garbage numbers up the chain
-outside_temperature = 0
-outside_humidity = 0
-outside_pressure = 0
-inside_temperature = 0
-inside_humidity = 0
-inside_voc = 0
-
+# The legacy gauges for the home station's inside and outside sensors
 inside_temperature_gauge = Gauge('inside_temperature', 'Inside temperature (f)')
-inside_temperature_gauge.set(inside_temperature)
-
 inside_humidity_gauge = Gauge('inside_humidity', 'Inside humidity (%)')
-inside_humidity_gauge.set(inside_humidity)
-
 inside_voc_gauge = Gauge('inside_voc', 'Inside VOC')
-inside_voc_gauge.set(inside_voc)
-
 outside_temperature_gauge = Gauge('outside_temperature', 'Outside temperature (f)')
-outside_temperature_gauge.set(outside_temperature)
-
 outside_humidity_gauge = Gauge('outside_humidity', 'Outside humidity (%)')
-outside_humidity_gauge.set(outside_humidity)
-
 outside_pressure_gauge = Gauge('outside_pressure', 'Outside air pressure (mb)')
-outside_pressure_gauge.set(outside_pressure)
 
-# Let's not kill the National Weather Service
-nws_cooldown = 24
-nws_cache = {}
+stale_counter = Counter('observation_stale_fields', 'Readings left out of an upload because they were too old', ['field'])
 
-# Grab NWS data for pieces we're missing - unused for now.
-def get_nws_data():
-    station_id = config['NWS']['station_id']
-    require_qc = config['NWS']['require_qc']
-    
-    data = {}
-    if nws_cooldown == 24:
-        nws_cooldown = nws_cooldown - 1
-        r = requests.get("https://api.weather.gov/stations/%s/observations/latest?require_qc=%s"% (station_id, require_qc))
-        if r.status_code == 200:
-            d = json.loads(r.text)
-            nws_cache = d
-        else:
-            print("Unable to get weather data from NWS")
-            return data
-    else:
-        if nws_cooldown == 0:
-            nws_cooldown = 24
-        else:
-            nws_cooldown = nws_cooldown - 1
-        d = nws_cache
+# Recent history of every reading, served from the query endpoint
+history = timeseries.from_config(config)
 
-    try:
-        data['dewpoint'] = d['properties']['dewpoint']['value']
-        data['pressure'] = d['properties']['barometricPressure']['value'] / 100
-        data['windSpeed'] = d['properties']['windSpeed']['value']
-        data['windDirection'] = d['properties']['windDirection']['value']
-    except KeyError:
-        print("Couldn't load all the data from NWS: %s"% data)
-    return data
+# Fills in what we don't measure from the nearest NWS station, if one is
+# configured. It starts warm from its on-disk cache.
+nws_client = nws.from_config(config)
+
+# Grab NWS data for pieces we're missing
+def get_nws_data():
+    if nws_client is None:
+        return {}
+    return nws_client.get()
 
 # Callback when connection is accidentally lost.
 def on_connection_interrupted(connection, error, **kwargs):
@@ -113,68 +80,230 @@ def on_resubscribe_complete(resubscribe_future):
         if qos is None:
             sys.exit("Server rejected resubscribe to topic: {}".format(topic))
 
-def send_data_to_wunderground():
-    # Send data to Wunderground every 2 seconds
-    
-    while not received_all_event.is_set():
-        # do some conversions on the data
-        inches = float(outside_pressure) / 33.8639
-        # https://en.wikipedia.org/wiki/Dew_point#Simple_approximation
-        dewpoint = float(outside_temperature) - 9/25 * (100 - float(outside_humidity))
-        print("Sending temperature %s, humidity %s, pressure %s, calculated dewpoint %s"% (outside_temperature, outside_humidity, outside_pressure, dewpoint))
-        
-        # Make sure we have data. Outside humidity should never be 0
-        if (outside_humidity == 0):
-            print("Humidity is 0 - not sending data")
-        else:
-            r = requests.get("https://weatherstation.wunderground.com/weatherstation/updateweatherstation.php?ID=%s&PASSWORD=%s&dateutc=now&humidity=%s&tempf=%s&baromin=%s&dewptf=%s&action=updateraw"% (station_id, station_pass, outside_humidity, outside_temperature, inches, dewpoint))
-            if r.status_code == 200:
-                print("Uploaded data to Wunderground")
-            else:
-                print("Error uploading data to Wunderground %d"% (r.status_code,))
-        time.sleep(5)
-    
-
-# Callback when the subscribed topic receives a message
+# The latest snapshot of the home station's inside or outside sensor
+def home_snapshot(sensor):
+    state = home_sensors.get(sensor)
+    if state is None:
+        return stations.Snapshot(home_station, sensor, {}, {}, 0)
+    return state.snapshot
+
+# Build the current observation for Wunderground from the latest readings.
+# Each sensor's readings come from one snapshot, so they're all from the
+# same sample, and anything older than max_reading_age is left out rather
+# than uploaded forever after a sensor dies.
+def wunderground_observation():
+    now = time.time()
+    outside = home_snapshot('outside')
+    inside = home_snapshot('inside')
+
+    stale = outside.stale(('temperature_f', 'humidity'), max_reading_age, now)
+    if stale:
+        for field in stale:
+            stale_counter.labels(field).inc()
+        print("No recent outside %s - not sending data"% (" or ".join(stale),))
+        return None
+    temperature = outside.get('temperature_f')
+    humidity = outside.get('humidity')
+
+    # Make sure we have data. Outside humidity should never be 0
+    if (humidity == 0):
+        print("Humidity is 0 - not sending data")
+        return None
+
+    # Our own pressure from either sensor, else the NWS station's
+    pressure = (outside.get('sea_level_pressure', max_reading_age, now)
+                or inside.get('sea_level_pressure', max_reading_age, now))
+    if pressure is None and (outside.age('sea_level_pressure', now) is not None
+                             or inside.age('sea_level_pressure', now) is not None):
+        stale_counter.labels('sea_level_pressure').inc()
+        print("Pressure reading is stale, using NWS pressure")
+    nws_data = get_nws_data()
+    if pressure is None:
+        pressure = nws_data.get('pressure')
+
+    # Only use our dewpoint if it was worked out from these readings
+    dewpoint = outside.get('dewpoint_f')
+    if outside.received.get('dewpoint_f', 0) < max(outside.received['temperature_f'], outside.received['humidity']):
+        dewpoint = None
+
+    observation = wunderground.build_observation(
+        temperature, humidity, pressure,
+        wind_speed=nws_data.get('windSpeed'),
+        wind_direction=nws_data.get('windDirection'),
+        wind_gust=nws_data.get('windGust'),
+        dewpoint=dewpoint)
+    print("Sending temperature %s, humidity %s, pressure %s, calculated dewpoint %s"% (temperature, humidity, pressure, observation.get('dewptf')))
+    return observation
+
+# Is this the station that feeds the legacy gauges, history and
+# Wunderground?  Without a home_station that's any station, but only on
+# worker 0 so there's one upload however many workers there are.
+def is_home(station):
+    if home_station:
+        return station == home_station
+    return ownership.worker == 0
+
+# The samples that change what wunderground_observation() returns
+def is_home_outside(station, sensor, data):
+    return sensor == 'outside' and is_home(station)
+
+# Callback when the subscribed topic receives a message.  This runs on the
+# connection's event-loop thread, so just hand the payload to the workers.
 def on_message_received(topic, payload, dup, qos, retain, **kwargs):
+    # Leave stations other workers own to them, before queueing if the
+    # topic says which station it is
+    if ownership.workers > 1:
+        station = station_table.topic_station(topic)
+        if station is not None and not ownership.owns(station):
+            sharding.skipped_counter.inc()
+            return
+    ingest_queue.submit(topic, payload, dup, qos, retain)
+
+# Runs on an ingest worker thread
+def process_message(topic, payload, dup, qos, retain):
     print("Received message from topic '{}': {}".format(topic, payload))
-    global inside_temperature
-    global inside_humidity
-    global inside_voc
-    global outside_temperature
-    global outside_humidity
-    global outside_pressure
 
     try:
-        data = json.loads(payload)
-        print("Got payload %s"% (payload,))
-        temperature = data['temperature_f']
-        humidity = data['humidity']
-        pressure = data['pressure']
-        voc = data['gas']
-    except json.decoder.JSONDecodeError:
+        samples = codec.decode(payload)
+    except ValueError:
         print("Received malformed message %s"% (payload))
         return
-    except KeyError:
-        print("Received data %s"% (payload))
-
-    if 'pressure' in data.keys():
-        # This is from the bme688 inside the house
-        inside_temperature = temperature
-        inside_humidity = humidity
-        outside_pressure = pressure
-        inside_voc = voc
+
+    for sample in samples:
+        station = station_table.station_for(topic, sample)
+        if not ownership.owns(station):
+            sharding.skipped_counter.inc()
+            continue
+        # Drop anything we've already handled, like a QoS 1 redelivery
+        if deliveries.record(station, station_table.sensor_for(sample), sample, dup):
+            handle_sample(sample, topic)
+        else:
+            print("Dropping duplicate sample %s"% (sample,))
+
+# Which stations this worker handles, when there's more than one.  Set by
+# setup_worker() once we know which worker we are.
+ownership = None
+
+def setup_worker(worker=None, workers=None):
+    global ownership, latest_table
+    ownership = sharding.from_config(config, worker, workers)
+    latest_table = latest.from_config(config, stations.FIELDS, ownership.worker, ownership.workers)
+
+# Every station and sensor we hear from, with its own labeled series
+station_table = stations.from_config(config, message_topic)
+
+# Latency, loss and duplicates for every station's sensors
+deliveries = delivery.from_config(config)
+
+# Dewpoint, sea level pressure and friends, worked out once per sample
+deriver = derived.from_config(config)
+
+# Wunderground and anywhere else samples go, each on its own queue and
+# thread. That includes the archive on disk, if an archive path is set.
+sink_set = sinks.from_config(config, wunderground_observation, is_home_outside, archive.from_config(config))
+
+# The station that feeds the inside_ and outside_ gauges, the history and
+# Wunderground. Unset means whichever station reports.
+home_station = config.get('SUBSCRIBER', 'home_station', fallback=None)
+
+# The home station's sensors by name, for wunderground_observation()
+home_sensors = {}
+
+# The latest readings of every sensor in shared memory, for local readers.
+# Set by setup_worker() too, since each worker has its own.
+latest_table = None
+
+# Alert rules, checked against each sample's fields as it comes in
+alert_engine = alerts.from_config(config)
+
+# Let go of everything that refers to a sensor the station table evicts
+def forget_sensor(state):
+    if home_sensors.get(state.sensor) is state:
+        del home_sensors[state.sensor]
+    alert_engine.forget(state)
+
+station_table.on_evict = forget_sensor
+
+# Readings older than this aren't uploaded
+max_reading_age = config.getfloat('SUBSCRIBER', 'max_reading_age', fallback=600)
+
+def handle_sample(data, topic=''):
+    print("Got sample %s"% (data,))
+    state = station_table.lookup(topic, data)
+    data = deriver.apply(state, data, get_wind_mph(state))
+    state.update(data, time.time())
+    if latest_table is not None:
+        latest_table.update(state.snapshot)
+    alert_engine.evaluate(state, data)
+
+    if is_home(state.station):
+        home_sensors[state.sensor] = state
+        if state.sensor == 'inside':
+            update_inside(data)
+        elif state.sensor == 'outside':
+            update_outside(data)
+
+    sink_set.publish(state.station, state.sensor, data)
+
+# NWS wind for wind chill, but only where we are and only if it's already
+# cached. We never wait on the network here.
+def get_wind_mph(state):
+    if nws_client is None or state.sensor != 'outside':
+        return None
+    if not is_home(state.station):
+        return None
+    wind_speed = nws_client.latest().get('windSpeed')
+    if wind_speed is None:
+        return None
+    return wind_speed * 0.621371
+
+def update_inside(data):
+    # Batched samples carry the time they were taken
+    sample_time = data.get('ts')
+
+    # This is from the bme688 inside the house
+    temperature = data.get('temperature_f')
+    if temperature is not None:
         inside_temperature_gauge.set(temperature)
+        history.record('inside_temperature', temperature, sample_time)
+    humidity = data.get('humidity')
+    if humidity is not None:
         inside_humidity_gauge.set(humidity)
+        history.record('inside_humidity', humidity, sample_time)
+    pressure = data.get('pressure')
+    if pressure is not None:
         outside_pressure_gauge.set(pressure)
+        history.record('outside_pressure', pressure, sample_time)
+    voc = data.get('gas')
+    if voc is not None:
         inside_voc_gauge.set(voc)
-    else:
-        # This is from the DHT outside the house
-        outside_temperature = temperature
-        outside_humidity = humidity
+        history.record('inside_voc', voc, sample_time)
+
+def update_outside(data):
+    sample_time = data.get('ts')
+
+    # This is from the DHT outside the house, maybe with a BME280 next to it
+    temperature = data.get('temperature_f')
+    if temperature is not None:
         outside_temperature_gauge.set(temperature)
+        history.record('outside_temperature', temperature, sample_time)
+    humidity = data.get('humidity')
+    if humidity is not None:
         outside_humidity_gauge.set(humidity)
-    
+        history.record('outside_humidity', humidity, sample_time)
+    pressure = data.get('pressure')
+    if pressure is not None:
+        outside_pressure_gauge.set(pressure)
+        history.record('outside_pressure', pressure, sample_time)
+
+def evict_stale_stations():
+    while not received_all_event.wait(60):
+        station_table.evict_stale()
+        deliveries.evict_stale()
+        if latest_table is not None:
+            latest_table.evict_stale(station_table.stale_after)
+
+ingest_queue = ingest.from_config(config, process_message)
 
 # Callback when the connection successfully connects
 def on_connection_success(connection, callback_data):
@@ -191,20 +320,34 @@ def on_connection_closed(connection, callback_data):
     print("Connection closed")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Receive and process weather station readings")
+    parser.add_argument('--worker-index', type=int, default=None, help="this worker, from 0 (overrides [SUBSCRIBER] worker_index)")
+    parser.add_argument('--worker-count', type=int, default=None, help="how many workers share the stations (overrides [SUBSCRIBER] worker_count)")
+    args = parser.parse_args()
+    setup_worker(args.worker_index, args.worker_count)
+
+    # Every worker needs its own MQTT session and ports
+    if ownership.workers > 1:
+        clientId = "%s-%d"% (clientId, ownership.worker)
+        print("Worker %d of %d"% (ownership.worker, ownership.workers))
+        if home_station:
+            print("Home station %s belongs to worker %d"% (home_station, ownership.owner(home_station)))
+
     # Start the status page
-    start_http_server(8001)
-
-    # Create a MQTT connection from the command line data
-    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-        endpoint=endpoint,
-        cert_filepath=cert_filepath,
-        pri_key_filepath=pri_key_filepath,
-        ca_filepath=ca_filepath,
+    start_http_server(8001 + ownership.worker)
+
+    # And the history query endpoint, after every worker's status page
+    timeseries.start_query_server(history, config.getint('HISTORY', 'port', fallback=8002) + ownership.workers - 1 + ownership.worker)
+
+    # Start the workers before we subscribe so nothing waits on them
+    ingest_queue.start()
+
+    # Connect to AWS IoT, the local broker, or both ([LOCAL] transport)
+    mqtt_connection = transport.from_config(
+        config,
+        clientId,
         on_connection_interrupted=on_connection_interrupted,
         on_connection_resumed=on_connection_resumed,
-        client_id=clientId,
-        clean_session=False,
-        keep_alive_secs=30,
         on_connection_success=on_connection_success,
         on_connection_failure=on_connection_failure,
         on_connection_closed=on_connection_closed)
@@ -225,11 +368,20 @@ if __name__ == '__main__':
     subscribe_result = subscribe_future.result()
     print("Subscribed with {}".format(str(subscribe_result['qos'])))
 
-    # Send data to wunderground every 2 seconds:
-    wthread = threading.Thread(target=send_data_to_wunderground, args=[], kwargs={})
-    wthread.start()
-   
+    # Send data to Wunderground and the other sinks in the background
+    sink_set.start()
+    alert_engine.start()
+
+    # Notice sensors that have gone silent
+    threading.Thread(target=alert_engine.run, args=[received_all_event, station_table.states], daemon=True).start()
+
+    # Forget stations that have gone quiet
+    threading.Thread(target=evict_stale_stations, args=[], kwargs={}, daemon=True).start()
+
     received_all_event.wait()
+    ingest_queue.stop()
+    sink_set.stop()
+    alert_engine.stop()
 
     # Disconnect
     print("Disconnecting...")
@@ -0,0 +1,10 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+import os
+import sys
+
+# The modules live at the top of the repo, and the fakes stand in for the
+# hardware and AWS libraries
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'simulation', 'fakes')]
@@ -0,0 +1,25 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+import codec
+import pytest
+
+def test_json_sample():
+    assert codec.decode('{"temperature_f": 50}') == [{'temperature_f': 50}]
+
+def test_batched_samples():
+    assert codec.decode('{"samples": [{"seq": 1}, {"seq": 2}]}') == [{'seq': 1}, {'seq': 2}]
+
+@pytest.mark.parametrize('payload', ['5', '"x"', '[1, 2]', 'null', '{"samples": [{"seq": 1}, 3]}', '{"samples": 3}'])
+def test_samples_must_be_objects(payload):
+    with pytest.raises(ValueError):
+        codec.decode(payload)
+
+def test_binary_round_trip():
+    samples = [{'seq': 1, 'ts': 1.5, 'boot': 3, 'temperature_f': 50.25, 'device': 'porch'}]
+    assert codec.decode(codec.encode(samples)) == samples
+
+def test_unknown_binary_version():
+    payload = codec.encode([{'seq': 1, 'ts': 0, 'boot': 0}])
+    with pytest.raises(ValueError, match="Unsupported payload version"):
+        codec.decode(bytes([codec.VERSION + 1]) + payload[1:])
@@ -0,0 +1,17 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+import delivery
+
+def test_seq_without_boot():
+    tracker = delivery.DeliveryTracker()
+    assert tracker.record('home', 'outside', {'seq': 1})
+    assert tracker.record('home', 'outside', {'seq': 2})
+    assert not tracker.record('home', 'outside', {'seq': 2})
+    assert tracker.record('home', 'outside', {'seq': 4})
+
+def test_sensors_keep_their_own_sequence():
+    tracker = delivery.DeliveryTracker()
+    for seq in range(5):
+        assert tracker.record('home', 'inside', {'seq': seq, 'boot': 100})
+        assert tracker.record('home', 'outside', {'seq': seq, 'boot': 100})
@@ -0,0 +1,212 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Recent history for every reading the subscriber sees, kept in fixed size
+# ring buffers so memory use stays flat no matter how long we run.  Each
+# metric keeps the raw samples plus 1 minute and 1 hour min/max/mean
+# rollups, and a small HTTP endpoint serves range queries over them:
+#
+#   GET /query?metric=outside_temperature&start=<epoch>&end=<epoch>&step=raw|1m|1h
+#   GET /series
+
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import json
+import math
+import threading
+import time
+
+def _zeros(capacity):
+    return array('d', bytes(8 * capacity))
+
+# Raw samples, oldest first once the buffer has wrapped
+class RingSeries:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = _zeros(capacity)
+        self.values = _zeros(capacity)
+        self.count = 0
+        self.next = 0
+
+    def _index(self, i):
+        return (self.next - self.count + i) % self.capacity
+
+    def last_time(self):
+        if self.count == 0:
+            return -math.inf
+        return self.times[(self.next - 1) % self.capacity]
+
+    def append(self, t, value):
+        self.times[self.next] = t
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    # Index of the first sample at or after t
+    def _bisect(self, t):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[self._index(mid)] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start, end):
+        points = []
+        for i in range(self._bisect(start), self.count):
+            j = self._index(i)
+            if self.times[j] > end:
+                break
+            points.append((self.times[j], self.values[j]))
+        return points
+
+# Fixed width buckets with incrementally maintained min/max/sum/count
+class Rollup:
+    def __init__(self, width, capacity):
+        self.width = width
+        self.series = RingSeries(capacity)
+        self.mins = _zeros(capacity)
+        self.maxs = _zeros(capacity)
+        self.sums = _zeros(capacity)
+        self.counts = _zeros(capacity)
+
+    def add(self, t, value):
+        bucket = t - t % self.width
+        series = self.series
+        if series.count and series.last_time() == bucket:
+            j = (series.next - 1) % series.capacity
+            if value < self.mins[j]:
+                self.mins[j] = value
+            if value > self.maxs[j]:
+                self.maxs[j] = value
+            self.sums[j] += value
+            self.counts[j] += 1
+        else:
+            j = series.next
+            series.append(bucket, value)
+            self.mins[j] = value
+            self.maxs[j] = value
+            self.sums[j] = value
+            self.counts[j] = 1
+
+    def range(self, start, end):
+        series = self.series
+        points = []
+        for i in range(series._bisect(start - start % self.width), series.count):
+            j = series._index(i)
+            if series.times[j] > end:
+                break
+            points.append((series.times[j], self.mins[j], self.maxs[j], self.sums[j] / self.counts[j]))
+        return points
+
+class Metric:
+    def __init__(self, raw_capacity, minute_capacity, hour_capacity):
+        self.lock = threading.Lock()
+        self.raw = RingSeries(raw_capacity)
+        self.rollups = {
+            '1m': Rollup(60, minute_capacity),
+            '1h': Rollup(3600, hour_capacity),
+        }
+
+    def add(self, t, value):
+        with self.lock:
+            # Samples older than what we already have can't go in a ring
+            # buffer ordered by time, drop them.
+            if t < self.raw.last_time():
+                return False
+            self.raw.append(t, value)
+            for rollup in self.rollups.values():
+                rollup.add(t, value)
+            return True
+
+    def range(self, start, end, step='raw'):
+        with self.lock:
+            if step == 'raw':
+                return self.raw.range(start, end)
+            return self.rollups[step].range(start, end)
+
+class MetricStore:
+    # Defaults keep a day of 5 second samples, a week of minutes and 90 days of hours
+    def __init__(self, raw_capacity=17280, minute_capacity=10080, hour_capacity=2160):
+        self.raw_capacity = raw_capacity
+        self.minute_capacity = minute_capacity
+        self.hour_capacity = hour_capacity
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, value, t=None):
+        if value is None:
+            return
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(
+                    name, Metric(self.raw_capacity, self.minute_capacity, self.hour_capacity))
+        metric.add(time.time() if t is None else t, float(value))
+
+    def names(self):
+        return sorted(self.metrics.keys())
+
+    def query(self, name, start, end, step='raw'):
+        metric = self.metrics.get(name)
+        if metric is None:
+            raise KeyError(name)
+        return metric.range(start, end, step)
+
+def _make_handler(store):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if url.path == '/series':
+                self._reply(200, store.names())
+            elif url.path == '/query':
+                try:
+                    name = params['metric'][0]
+                    end = float(params.get('end', [time.time()])[0])
+                    start = float(params.get('start', [end - 3600])[0])
+                    step = params.get('step', ['raw'])[0]
+                    if step not in ('raw', '1m', '1h'):
+                        raise ValueError("step must be raw, 1m or 1h")
+                    points = store.query(name, start, end, step)
+                except KeyError as error:
+                    self._reply(404, {"error": "unknown metric %s"% (error,)})
+                    return
+                except ValueError as error:
+                    self._reply(400, {"error": str(error)})
+                    return
+                self._reply(200, {"metric": name, "step": step, "points": points})
+            else:
+                self._reply(404, {"error": "not found"})
+
+        # Keep the request log out of the console
+        def log_message(self, format, *args):
+            pass
+
+    return QueryHandler
+
+# Serve range queries from a background thread
+def start_query_server(store, port, addr='0.0.0.0'):
+    server = ThreadingHTTPServer((addr, port), _make_handler(store))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def from_config(config):
+    return MetricStore(
+        raw_capacity=config.getint('HISTORY', 'raw_samples', fallback=17280),
+        minute_capacity=config.getint('HISTORY', 'minutes', fallback=10080),
+        hour_capacity=config.getint('HISTORY', 'hours', fallback=2160))
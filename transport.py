@@ -0,0 +1,492 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Where the publishers and the subscriber send and receive readings:
+#
+#   aws     AWS IoT, as before
+#   local   an MQTT broker on the LAN (mosquitto or similar) through paho
+#   both    both of them.  Every reading is published to each, and counts
+#           as delivered once either broker has it, so the station keeps
+#           working on the LAN when the internet is down.  The subscriber
+#           listens to both and keeps whichever copy of a message arrives
+#           first, normally the local one.
+#
+# Whatever the mode, from_config() returns something that looks like an
+# awscrt mqtt.Connection (connect, publish, subscribe, disconnect,
+# resubscribe_existing_topics and the same callbacks), so the scripts and
+# wal.StoreAndForward don't care which one they have.
+#
+# With both, the durable path is the local broker: a reading the local
+# broker acknowledges is gone from the on-disk queue, and only reaches AWS
+# if awscrt gets it there (it holds publishes made while it's offline in
+# memory).
+
+from awscrt import mqtt
+from awsiot import mqtt_connection_builder
+from prometheus_client import Counter, Gauge
+import collections
+import concurrent.futures
+import threading
+import time
+
+MODES = ('aws', 'local', 'both')
+
+connected_gauge = Gauge('transport_connected', '1 while connected to the broker', ['transport'])
+published_counter = Counter('transport_published', 'Messages acknowledged by the broker', ['transport'])
+received_counter = Counter('transport_received', 'Messages received from the broker', ['transport'])
+duplicates_counter = Counter('transport_duplicates', 'Messages received from both brokers, second copy dropped')
+
+def _done(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+def _failed(error):
+    future = concurrent.futures.Future()
+    future.set_exception(error)
+    return future
+
+# A connection to a local broker through paho, behaving like an awscrt
+# mqtt.Connection.  paho reconnects on its own network thread, and the
+# callbacks are called on that thread.
+class LocalConnection:
+    def __init__(self, host, port=1883, client_id=None, username=None, password=None,
+                 ca_filepath=None, cert_filepath=None, pri_key_filepath=None, clean_session=False,
+                 keep_alive_secs=30, on_connection_interrupted=None, on_connection_resumed=None,
+                 on_connection_success=None, on_connection_failure=None, on_connection_closed=None):
+        import paho.mqtt.client as paho
+
+        self.host = host
+        self.port = port
+        self.keep_alive_secs = keep_alive_secs
+        self.on_connection_interrupted = on_connection_interrupted
+        self.on_connection_resumed = on_connection_resumed
+        self.on_connection_success = on_connection_success
+        self.on_connection_failure = on_connection_failure
+        self.on_connection_closed = on_connection_closed
+
+        self.client = paho.Client(paho.CallbackAPIVersion.VERSION2, client_id=client_id or '',
+                                  clean_session=clean_session)
+        if username:
+            self.client.username_pw_set(username, password)
+        if ca_filepath:
+            self.client.tls_set(ca_certs=ca_filepath, certfile=cert_filepath or None, keyfile=pri_key_filepath or None)
+        self.client.reconnect_delay_set(1, 60)
+        self.client.on_connect = self._on_connect
+        self.client.on_connect_fail = self._on_connect_fail
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.on_subscribe = self._on_subscribe
+
+        self.connected = False
+        self.closing = False
+        # Subscriptions by topic filter, as (qos, callback)
+        self.subscriptions = {}
+        # Futures waiting on the broker, by message id
+        self.pending = {}
+        # paho can call back before publish() returns, so acknowledgements
+        # that beat their future here wait for it.  They're only kept while
+        # a publish or subscribe is on its way in (issuing counts them), so
+        # an acknowledgement for a message paho resent after a reconnect,
+        # which nothing is waiting on, can't complete a later message that
+        # reuses its id.
+        self.early = {}
+        self.issuing = 0
+        self.lock = threading.Lock()
+        self.connect_future = None
+        self.disconnect_future = None
+        self.gauge = connected_gauge.labels('local')
+        self.published = published_counter.labels('local')
+        self.received = received_counter.labels('local')
+
+    def connect(self):
+        self.connect_future = concurrent.futures.Future()
+        self.client.connect_async(self.host, self.port, self.keep_alive_secs)
+        self.client.loop_start()
+        return self.connect_future
+
+    def disconnect(self):
+        self.closing = True
+        self.disconnect_future = concurrent.futures.Future()
+        if not self.connected:
+            self.client.loop_stop()
+            self._closed()
+        else:
+            self.client.disconnect()
+        return self.disconnect_future
+
+    def _closed(self):
+        if self.on_connection_closed:
+            self.on_connection_closed(self, mqtt.OnConnectionClosedData())
+        if not self.disconnect_future.done():
+            self.disconnect_future.set_result({})
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            self._on_connect_fail(client, userdata, reason_code)
+            return
+        self.connected = True
+        self.gauge.set(1)
+        session_present = bool(flags.session_present)
+        # Subscriptions made while we weren't connected, or that the broker
+        # forgot along with our session
+        if not session_present and self.subscriptions:
+            self.resubscribe_existing_topics()
+        if self.on_connection_success:
+            self.on_connection_success(self, mqtt.OnConnectionSuccessData(
+                return_code=mqtt.ConnectReturnCode.ACCEPTED, session_present=session_present))
+        if self.connect_future is not None and not self.connect_future.done():
+            self.connect_future.set_result({'return_code': mqtt.ConnectReturnCode.ACCEPTED, 'session_present': session_present})
+        elif self.on_connection_resumed:
+            self.on_connection_resumed(self, mqtt.ConnectReturnCode.ACCEPTED, session_present)
+
+    def _on_connect_fail(self, client, userdata, reason_code=None):
+        error = ConnectionError("Can't connect to %s:%d%s"% (self.host, self.port, reason_code and ": %s"% (reason_code,) or ''))
+        if self.on_connection_failure:
+            self.on_connection_failure(self, mqtt.OnConnectionFailureData(error=error))
+        # paho keeps trying, so connect() just waits for the broker to come up
+        print(error)
+
+    def _on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        was_connected = self.connected
+        self.connected = False
+        self.gauge.set(0)
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+            self.early.clear()
+        for future in pending:
+            future.set_exception(ConnectionError("Disconnected before the broker acknowledged it"))
+        if self.closing:
+            self.client.loop_stop()
+            self._closed()
+        elif was_connected and self.on_connection_interrupted:
+            self.on_connection_interrupted(self, "disconnected: %s"% (reason_code,))
+
+    # Called before handing paho a message, so an acknowledgement that
+    # arrives before we know its id is kept for _wait_for()
+    def _issuing(self):
+        with self.lock:
+            self.issuing += 1
+
+    # Call finish(future) once both the broker has answered message id mid
+    # and its future is registered, in whichever order they happen.  A
+    # future of None just means paho didn't take the message.
+    def _wait_for(self, mid, future):
+        with self.lock:
+            self.issuing -= 1
+            finish = self.early.pop(mid, None) if future is not None else None
+            if finish is None and future is not None:
+                self.pending[mid] = future
+            if not self.issuing:
+                # Nothing left that could claim these
+                self.early.clear()
+        if finish is not None:
+            finish(future)
+
+    def _complete(self, mid, finish):
+        with self.lock:
+            future = self.pending.pop(mid, None)
+            if future is None:
+                if self.issuing:
+                    self.early[mid] = finish
+                return
+        finish(future)
+
+    # paho takes its own locks here and holds them while calling back, so
+    # ours is never held around it
+    def publish(self, topic, payload, qos, retain=False):
+        if not self.connected:
+            return _failed(ConnectionError("Not connected")), 0
+        self._issuing()
+        try:
+            info = self.client.publish(topic, payload, qos=int(qos), retain=retain)
+        except Exception:
+            self._wait_for(0, None)
+            raise
+        if info.rc != 0:
+            self._wait_for(info.mid, None)
+            return _failed(ConnectionError("Publish failed with %d"% (info.rc,))), info.mid
+        future = concurrent.futures.Future()
+        self._wait_for(info.mid, future)
+        return future, info.mid
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        def finish(future):
+            self.published.inc()
+            future.set_result({'packet_id': mid})
+        self._complete(mid, finish)
+
+    def _subscribe(self, topics):
+        self._issuing()
+        try:
+            result, mid = self.client.subscribe([(topic, int(qos)) for topic, qos in topics])
+        except Exception:
+            self._wait_for(0, None)
+            raise
+        if result != 0:
+            self._wait_for(mid, None)
+            return _failed(ConnectionError("Subscribe failed with %d"% (result,))), mid
+        future = concurrent.futures.Future()
+        future.topics = topics
+        self._wait_for(mid, future)
+        return future, mid
+
+    def subscribe(self, topic, qos, callback=None):
+        self.subscriptions[topic] = (qos, callback)
+        if callback is not None:
+            self.client.message_callback_add(topic, self._wrap(callback))
+        if not self.connected:
+            # Made as soon as we connect
+            return _done({'packet_id': 0, 'topic': topic, 'qos': qos}), 0
+        future, mid = self._subscribe([(topic, qos)])
+        # Look like awscrt's single-topic result
+        single = concurrent.futures.Future()
+        def done(f):
+            error = f.exception()
+            if error is not None:
+                single.set_exception(error)
+            else:
+                single.set_result({'packet_id': mid, 'topic': topic, 'qos': f.result()['topics'][0][1]})
+        future.add_done_callback(done)
+        return single, mid
+
+    def resubscribe_existing_topics(self):
+        topics = [(topic, qos) for topic, (qos, callback) in self.subscriptions.items()]
+        if not topics:
+            return _done({'packet_id': 0, 'topics': []}), 0
+        return self._subscribe(topics)
+
+    def _on_subscribe(self, client, userdata, mid, reason_code_list, properties):
+        def finish(future):
+            topics = []
+            for (topic, qos), reason_code in zip(future.topics, reason_code_list):
+                topics.append((topic, None if reason_code.is_failure else mqtt.QoS(reason_code.value)))
+            future.set_result({'packet_id': mid, 'topics': topics})
+        self._complete(mid, finish)
+
+    def _wrap(self, callback):
+        def on_message(client, userdata, message):
+            self.received.inc()
+            callback(topic=message.topic, payload=message.payload, dup=message.dup,
+                     qos=message.qos, retain=message.retain)
+        return on_message
+
+# The same, for AWS IoT.  awscrt doesn't retry a first connect that fails,
+# so that's retried here until it works.
+class CloudConnection:
+    def __init__(self, connection, retry_delay=30):
+        self.connection = connection
+        self.retry_delay = retry_delay
+        self.published = published_counter.labels('aws')
+        self.received = received_counter.labels('aws')
+
+    def connect(self):
+        future = concurrent.futures.Future()
+        def attempt():
+            while True:
+                try:
+                    result = self.connection.connect().result()
+                except Exception as error:
+                    print("Can't connect to AWS IoT (%s), retrying in %d seconds"% (error, self.retry_delay))
+                    time.sleep(self.retry_delay)
+                    continue
+                future.set_result(result)
+                return
+        threading.Thread(target=attempt, name="aws-connect", daemon=True).start()
+        return future
+
+    def publish(self, topic, payload, qos, retain=False):
+        future, packet_id = self.connection.publish(topic=topic, payload=payload, qos=qos, retain=retain)
+        future.add_done_callback(lambda f: f.exception() is None and self.published.inc())
+        return future, packet_id
+
+    def subscribe(self, topic, qos, callback=None):
+        def on_message(**kwargs):
+            self.received.inc()
+            callback(**kwargs)
+        return self.connection.subscribe(topic=topic, qos=qos, callback=on_message if callback else None)
+
+    def resubscribe_existing_topics(self):
+        return self.connection.resubscribe_existing_topics()
+
+    def disconnect(self):
+        return self.connection.disconnect()
+
+# Publishes to both brokers and subscribes to both, preferring whichever
+# answers first.  The connection only counts as interrupted while neither
+# broker is reachable.
+class DualConnection:
+    def __init__(self, on_connection_interrupted=None, on_connection_resumed=None, window=1024):
+        self.on_connection_interrupted = on_connection_interrupted
+        self.on_connection_resumed = on_connection_resumed
+        # By transport name, set by from_config()
+        self.connections = {}
+        self.up = set()
+        self.lock = threading.Lock()
+        # Messages heard from one broker and not yet the other, oldest first
+        self.window = window
+        self.unmatched = collections.OrderedDict()
+
+    def _set_up(self, name, up):
+        with self.lock:
+            if up:
+                self.up.add(name)
+            else:
+                self.up.discard(name)
+            down = not self.up
+        connected_gauge.labels(name).set(1 if up else 0)
+        return down
+
+    # The interrupted and resumed callbacks for the named transport
+    def callbacks(self, name):
+        def interrupted(connection, error, **kwargs):
+            print("Connection to %s interrupted: %s"% (name, error))
+            if self._set_up(name, False) and self.on_connection_interrupted:
+                self.on_connection_interrupted(connection, error)
+        def resumed(connection, return_code, session_present, **kwargs):
+            if return_code == mqtt.ConnectReturnCode.ACCEPTED:
+                self._set_up(name, True)
+            if self.on_connection_resumed:
+                self.on_connection_resumed(connection, return_code, session_present)
+        return {'on_connection_interrupted': interrupted, 'on_connection_resumed': resumed}
+
+    # Done once either broker is connected.  The other keeps trying.
+    def connect(self):
+        future = concurrent.futures.Future()
+        failures = []
+        def done(f, name):
+            error = f.exception()
+            if error is None:
+                self._set_up(name, True)
+            with self.lock:
+                if future.done():
+                    return
+                if error is None:
+                    future.set_result(f.result())
+                    return
+                failures.append(error)
+                if len(failures) == len(self.connections):
+                    future.set_exception(failures[0])
+        for name, connection in self.connections.items():
+            connection.connect().add_done_callback(lambda f, name=name: done(f, name))
+        return future
+
+    # Acknowledged once either broker has it, failed only if both fail
+    def publish(self, topic, payload, qos, retain=False):
+        future = concurrent.futures.Future()
+        results = []
+        packet_id = 0
+        def done(f):
+            with self.lock:
+                results.append(f)
+                if future.done():
+                    return
+                if f.exception() is None:
+                    future.set_result(f.result())
+                elif len(results) == len(self.connections):
+                    future.set_exception(f.exception())
+        for connection in self.connections.values():
+            sent, packet_id = connection.publish(topic=topic, payload=payload, qos=qos, retain=retain)
+            sent.add_done_callback(done)
+        return future, packet_id
+
+    def subscribe(self, topic, qos, callback=None):
+        futures = []
+        for name, connection in self.connections.items():
+            on_message = None
+            if callback is not None:
+                on_message = lambda name=name, **kwargs: self._deliver(name, callback, **kwargs)
+            futures.append(connection.subscribe(topic=topic, qos=qos, callback=on_message)[0])
+        future = concurrent.futures.Future()
+        def done(f):
+            with self.lock:
+                if future.done():
+                    return
+                if f.exception() is None:
+                    future.set_result(f.result())
+                elif all(other.done() and other.exception() is not None for other in futures):
+                    future.set_exception(f.exception())
+        for f in futures:
+            f.add_done_callback(done)
+        return future, 0
+
+    # Pass on the first copy of each message and drop the second
+    def _deliver(self, name, callback, topic, payload, **kwargs):
+        key = (topic, bytes(payload))
+        with self.lock:
+            source = self.unmatched.get(key)
+            if source is not None and source != name:
+                del self.unmatched[key]
+                duplicates_counter.inc()
+                return
+            self.unmatched[key] = name
+            self.unmatched.move_to_end(key)
+            if len(self.unmatched) > self.window:
+                self.unmatched.popitem(last=False)
+        callback(topic=topic, payload=payload, **kwargs)
+
+    def resubscribe_existing_topics(self):
+        results = [connection.resubscribe_existing_topics() for connection in self.connections.values()]
+        return results[0]
+
+    def disconnect(self):
+        futures = [connection.disconnect() for connection in self.connections.values()]
+        future = concurrent.futures.Future()
+        def done(f):
+            if all(other.done() for other in futures) and not future.done():
+                future.set_result({})
+        for f in futures:
+            f.add_done_callback(done)
+        return future
+
+def _local(config, client_id, **callbacks):
+    return LocalConnection(
+        config.get('LOCAL', 'host', fallback='localhost'),
+        port=config.getint('LOCAL', 'port', fallback=1883),
+        client_id=client_id,
+        username=config.get('LOCAL', 'username', fallback=None),
+        password=config.get('LOCAL', 'password', fallback=None),
+        ca_filepath=config.get('LOCAL', 'ca_filepath', fallback=None),
+        cert_filepath=config.get('LOCAL', 'cert_filepath', fallback=None),
+        pri_key_filepath=config.get('LOCAL', 'pri_key_filepath', fallback=None),
+        clean_session=False,
+        keep_alive_secs=30,
+        **callbacks)
+
+def _aws(config, client_id, **callbacks):
+    return mqtt_connection_builder.mtls_from_path(
+        endpoint=config['AWS']['endpoint'],
+        cert_filepath=config['AWS']['cert_filepath'],
+        pri_key_filepath=config['AWS']['pri_key_filepath'],
+        ca_filepath=config['AWS']['ca_filepath'],
+        client_id=client_id,
+        clean_session=False,
+        keep_alive_secs=30,
+        **callbacks)
+
+# Takes the same callbacks as mqtt_connection_builder.mtls_from_path
+def from_config(config, client_id, on_connection_interrupted=None, on_connection_resumed=None,
+                on_connection_success=None, on_connection_failure=None, on_connection_closed=None):
+    mode = config.get('LOCAL', 'transport', fallback='aws').lower()
+    if mode not in MODES:
+        raise ValueError("Unknown transport %s, expected one of %s"% (mode, ", ".join(MODES)))
+
+    callbacks = dict(
+        on_connection_interrupted=on_connection_interrupted,
+        on_connection_resumed=on_connection_resumed,
+        on_connection_success=on_connection_success,
+        on_connection_failure=on_connection_failure,
+        on_connection_closed=on_connection_closed)
+    if mode == 'aws':
+        return _aws(config, client_id, **callbacks)
+    if mode == 'local':
+        return _local(config, client_id, **callbacks)
+
+    dual = DualConnection(on_connection_interrupted, on_connection_resumed)
+    # Local first, so it's the one that usually answers first
+    callbacks.update(dual.callbacks('local'))
+    dual.connections['local'] = _local(config, client_id, **callbacks)
+    callbacks.update(dual.callbacks('aws'))
+    dual.connections['aws'] = CloudConnection(_aws(config, client_id, **callbacks))
+    return dual
@@ -0,0 +1,237 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# A small memory-mapped ring buffer that the publishers append every reading
+# to before it goes out over MQTT.  Entries stay on disk until the broker
+# acknowledges them, so an outage costs neither RAM nor data.
+
+from awscrt import mqtt
+import instrumentation
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'WSWAL001'
+
+# magic, capacity, head, tail, used, head_seq, next_seq
+HEADER = struct.Struct('<8sQQQQQQ')
+HEADER_SIZE = 64
+
+# length, sequence number
+RECORD = struct.Struct('<IQ')
+WRAP = 0xFFFFFFFF
+
+class WriteAheadLog:
+    def __init__(self, path, size=4 * 1024 * 1024, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self._acked = set()
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < HEADER_SIZE + size:
+                os.ftruncate(fd, HEADER_SIZE + size)
+            self._map = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+
+        magic, capacity, head, tail, used, head_seq, next_seq = HEADER.unpack_from(self._map, 0)
+        if magic == MAGIC:
+            self.capacity = capacity
+            self._head, self._tail, self._used = head, tail, used
+            self._head_seq, self._next_seq = head_seq, next_seq
+            if self._next_seq > self._head_seq:
+                print("Recovered %d queued messages from %s"% (self._next_seq - self._head_seq, path))
+        else:
+            self.capacity = size
+            self._head = self._tail = self._used = 0
+            self._head_seq = self._next_seq = 0
+            self._write_header()
+
+    def __len__(self):
+        return self._next_seq - self._head_seq
+
+    def _write_header(self):
+        HEADER.pack_into(self._map, 0, MAGIC, self.capacity, self._head, self._tail,
+                         self._used, self._head_seq, self._next_seq)
+
+    def _sync(self):
+        self._write_header()
+        if self.fsync:
+            self._map.flush()
+
+    # Returns (offset, length, seq) of the record at offset, following wrap
+    # markers. length is None when the rest of the buffer is padding.
+    def _record_at(self, offset):
+        if self.capacity - offset < RECORD.size:
+            return 0, None, None
+        length, seq = RECORD.unpack_from(self._map, HEADER_SIZE + offset)
+        if length == WRAP:
+            return 0, None, None
+        return offset, length, seq
+
+    def _drop_oldest(self):
+        offset, length, seq = self._record_at(self._head)
+        if length is None:
+            # The rest of the buffer is padding, skip to the start
+            self._used -= self.capacity - self._head
+            self._head = 0
+            offset, length, seq = self._record_at(0)
+        self._head = offset + RECORD.size + length
+        self._used -= RECORD.size + length
+        if self._head == self.capacity:
+            self._head = 0
+        self._head_seq = seq + 1
+        self._acked.discard(seq)
+
+    # Append a payload and return its sequence number.  When the buffer is
+    # full the oldest entries are dropped to make room.
+    def append(self, payload):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        need = RECORD.size + len(payload)
+        if need > self.capacity:
+            raise ValueError("Message of %d bytes does not fit in a %d byte queue"% (len(payload), self.capacity))
+
+        with self.lock:
+            dropped = 0
+            while True:
+                if self._used == 0:
+                    self._head = self._tail = 0
+                if self._tail > self._head or self._used == 0:
+                    if self.capacity - self._tail >= need:
+                        break
+                    if self._head >= need:
+                        # Pad out the end of the buffer and wrap around
+                        if self.capacity - self._tail >= 4:
+                            struct.pack_into('<I', self._map, HEADER_SIZE + self._tail, WRAP)
+                        self._used += self.capacity - self._tail
+                        self._tail = 0
+                        break
+                elif self._tail < self._head and self._head - self._tail >= need:
+                    break
+                self._drop_oldest()
+                dropped += 1
+
+            seq = self._next_seq
+            RECORD.pack_into(self._map, HEADER_SIZE + self._tail, len(payload), seq)
+            start = HEADER_SIZE + self._tail + RECORD.size
+            self._map[start:start + len(payload)] = payload
+            self._tail += need
+            if self._tail == self.capacity:
+                self._tail = 0
+            self._used += need
+            self._next_seq += 1
+            self._sync()
+
+        if dropped:
+            print("Queue %s is full, dropped %d oldest messages"% (self.path, dropped))
+        return seq
+
+    # Yield (seq, payload) for every unacknowledged entry, oldest first.
+    def pending(self, start_seq=0):
+        with self.lock:
+            offset = self._head
+            remaining = self._next_seq - self._head_seq
+            entries = []
+            while remaining > 0:
+                offset, length, seq = self._record_at(offset)
+                if length is None:
+                    offset, length, seq = self._record_at(0)
+                if seq >= start_seq and seq not in self._acked:
+                    start = HEADER_SIZE + offset + RECORD.size
+                    entries.append((seq, bytes(self._map[start:start + length])))
+                offset += RECORD.size + length
+                if offset == self.capacity:
+                    offset = 0
+                remaining -= 1
+        return entries
+
+    # Mark an entry as delivered.  Space is reclaimed once every older entry
+    # has been acknowledged too.
+    def ack(self, seq):
+        with self.lock:
+            if seq < self._head_seq:
+                return
+            self._acked.add(seq)
+            while self._head_seq in self._acked and self._used > 0:
+                self._drop_oldest()
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            self._write_header()
+            self._map.flush()
+            self._map.close()
+
+# Sends queued entries to the broker while the connection is up, and replays
+# the backlog in order when it comes back.
+class StoreAndForward:
+    def __init__(self, wal, connection, topic, qos=mqtt.QoS.AT_LEAST_ONCE):
+        self.wal = wal
+        self.connection = connection
+        self.topic = topic
+        self.qos = qos
+        self.connected = False
+        self._inflight = set()
+        self._next_seq = 0
+        self._highest_sent = -1
+        self._send_lock = threading.Lock()
+
+    def publish(self, payload):
+        self.wal.append(payload)
+        if self.connected:
+            self.drain()
+
+    # Send everything that isn't already on the wire.
+    def drain(self):
+        with self._send_lock:
+            for seq, payload in self.wal.pending(self._next_seq):
+                if not self.connected:
+                    break
+                if seq in self._inflight:
+                    continue
+                self._inflight.add(seq)
+                self._next_seq = seq + 1
+                if seq <= self._highest_sent:
+                    instrumentation.publish_retries_counter.inc()
+                self._highest_sent = max(self._highest_sent, seq)
+                sent = time.monotonic()
+                publish_future, _ = self.connection.publish(
+                    topic=self.topic,
+                    payload=payload,
+                    qos=self.qos)
+                publish_future.add_done_callback(
+                    lambda future, seq=seq, sent=sent: self._on_publish_complete(seq, sent, future))
+
+    def _on_publish_complete(self, seq, sent, future):
+        self._inflight.discard(seq)
+        error = future.exception()
+        if error is None:
+            instrumentation.publish_ack_histogram.observe(time.monotonic() - sent)
+            self.wal.ack(seq)
+        else:
+            instrumentation.publish_failures_counter.inc()
+            print("Publish of queued message %d failed: %s"% (seq, error))
+            self._next_seq = min(self._next_seq, seq)
+
+    def connection_interrupted(self):
+        self.connected = False
+
+    # Replay the backlog off the connection's event-loop thread.
+    def connection_resumed(self):
+        self.connected = True
+        self._next_seq = 0
+        if len(self.wal) > 0:
+            print("Replaying %d queued messages"% (len(self.wal),))
+        threading.Thread(target=self.drain, daemon=True).start()
+
+def from_config(config, connection, topic, default_path):
+    wal = WriteAheadLog(
+        config.get('QUEUE', 'path', fallback=default_path),
+        size=config.getint('QUEUE', 'size', fallback=4 * 1024 * 1024),
+        fsync=config.getboolean('QUEUE', 'fsync', fallback=False))
+    return StoreAndForward(wal, connection, topic)
@@ -0,0 +1,121 @@
+# Copyright Michael Solberg <mpsolberg@gmail.com>
+# SPDX-License-Identifier: Apache-2.0.
+
+# Uploads observations to Weather Underground (or anywhere else that takes
+# the same updateweatherstation.php parameters, like PWSweather) over a
+# single keep-alive connection.  Observations that haven't changed since
+# the last upload are skipped, apart from a periodic heartbeat so the
+# station doesn't go offline.  Scheduling, rate limits and retries are up
+# to the sink that owns the uploader (see sinks.py).
+
+from requests.adapters import HTTPAdapter
+import derived
+import requests
+import time
+
+UPLOAD_URL = "https://weatherstation.wunderground.com/weatherstation/updateweatherstation.php"
+RAPIDFIRE_URL = "https://rtupdate.wunderground.com/weatherstation/updateweatherstation.php"
+PWSWEATHER_URL = "https://pwsupdate.pwsweather.com/api/v1/submitwx"
+
+class UploadError(Exception):
+    pass
+
+# Convert our readings into WU upload parameters, rounded to what WU displays
+# so that sensor noise doesn't count as a change.
+# Wind comes from NWS in km/h.  Pressure should be corrected to sea level.
+def build_observation(temperature, humidity, pressure, wind_speed=None, wind_direction=None, wind_gust=None,
+                      dewpoint=None):
+    observation = {
+        "tempf": round(float(temperature), 1),
+        "humidity": round(float(humidity)),
+    }
+    if pressure:
+        observation["baromin"] = round(float(pressure) / 33.8639, 2)
+    if dewpoint is None:
+        dewpoint = derived.dewpoint_f(float(temperature), float(humidity))
+    if dewpoint is not None:
+        observation["dewptf"] = round(dewpoint, 1)
+    if wind_speed is not None:
+        observation["windspeedmph"] = round(wind_speed * 0.621371, 1)
+    if wind_direction is not None:
+        observation["winddir"] = round(wind_direction)
+    if wind_gust is not None:
+        observation["windgustmph"] = round(wind_gust * 0.621371, 1)
+    return observation
+
+class WundergroundUploader:
+    def __init__(self, station_id, station_pass, interval=5, connect_timeout=3.05, read_timeout=10,
+                 heartbeat=300, rapidfire=False, url=UPLOAD_URL, service="Wunderground"):
+        self.station_id = station_id
+        self.station_pass = station_pass
+        self.interval = interval
+        self.timeout = (connect_timeout, read_timeout)
+        self.heartbeat = heartbeat
+        self.rapidfire = rapidfire
+        self.url = url
+        self.service = service
+
+        # One pooled keep-alive connection instead of a TLS handshake per upload
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+        self.last_observation = None
+        self.last_upload = 0
+
+    def changed(self, observation):
+        if observation != self.last_observation:
+            return True
+        return time.monotonic() - self.last_upload >= self.heartbeat
+
+    # Returns True if the observation was uploaded, False if it hadn't
+    # changed.  Raises UploadError if the upload failed.
+    def send(self, observation):
+        if not self.changed(observation):
+            return False
+
+        params = {
+            "ID": self.station_id,
+            "PASSWORD": self.station_pass,
+            "dateutc": "now",
+            "action": "updateraw",
+        }
+        params.update(observation)
+        url = self.url
+        if self.rapidfire:
+            url = RAPIDFIRE_URL
+            params["realtime"] = 1
+            params["rtfreq"] = self.interval
+
+        try:
+            r = self.session.get(url, params=params, timeout=self.timeout)
+        except requests.RequestException as error:
+            raise UploadError("Error uploading data to %s: %s"% (self.service, error))
+
+        if r.status_code != 200:
+            raise UploadError("Error uploading data to %s %d"% (self.service, r.status_code))
+
+        self.last_observation = observation
+        self.last_upload = time.monotonic()
+        print("Uploaded data to %s"% (self.service,))
+        return True
+
+    # Like send(), but a failure is printed and returns False
+    def upload(self, observation):
+        try:
+            return self.send(observation)
+        except UploadError as error:
+            print(error)
+            return False
+
+    def close(self):
+        self.session.close()
+
+def from_config(config):
+    return WundergroundUploader(
+        config['WU']['station_id'],
+        config['WU']['station_pass'],
+        interval=config.getfloat('WU', 'interval', fallback=5),
+        connect_timeout=config.getfloat('WU', 'connect_timeout', fallback=3.05),
+        read_timeout=config.getfloat('WU', 'read_timeout', fallback=10),
+        heartbeat=config.getfloat('WU', 'heartbeat', fallback=300),
+        rapidfire=config.getboolean('WU', 'rapidfire', fallback=False))